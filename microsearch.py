@@ -69,13 +69,42 @@ maintained in alphabetical order. They look something like::
     blob\t{'document-1523': [3]}\n
     text\t{'document-1523': [5, 10]}\n
 
+Only the ``text`` field is indexed by default. Other indexed fields (see the
+``fields`` option) store their terms with the field name as a prefix, like
+``subject:blob``.
+
+If all those little files are a problem (inodes, backups, etc.), the
+``SqliteMicrosearch`` subclass keeps the same data as rows in a single SQLite
+database instead::
+
+    ms = microsearch.SqliteMicrosearch('/tmp/microsearch')
+
 """
+import argparse
+import array
+import base64
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import copy
+import email.parser
+import email.policy
 import hashlib
+import heapq
+import itertools
 import json
 import math
 import os
+import queue
 import re
+import shutil
+import sqlite3
+import sys
 import tempfile
+import threading
+import time
+import zlib
 
 
 __author__ = 'Daniel Lindsley'
@@ -83,560 +112,6060 @@ __license__ = 'BSD'
 __version__ = (1, 0, 0)
 
 
-class Microsearch(object):
+class ProfilePhase(object):
     """
-    Controls the indexing/searching of documents.
+    Times a single phase of an operation, as a context manager.
+    """
+    __slots__ = ('profiler', 'name', 'start')
 
-    Typical usage::
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        timings = self.profiler.timings
+        timings[self.name] = timings.get(self.name, 0.0) + (time.time() - self.start)
+        return False
 
-        ms = microsearch.Microsearch('/tmp/microsearch')
-        ms.index('email_1', {'text': "This is a blob of text to be indexed."})
-        ms.search('blob')
 
+class NullPhase(object):
     """
-    # A fairly standard list of "stopwords", which are words that contribute little
-    # to relevance (since they are so common in English) & are to be ignored.
-    STOP_WORDS = set([
-        'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by',
-        'for', 'if', 'in', 'into', 'is', 'it',
-        'no', 'not', 'of', 'on', 'or', 's', 'such',
-        't', 'that', 'the', 'their', 'then', 'there', 'these',
-        'they', 'this', 'to', 'was', 'will', 'with'
-    ])
-    PUNCTUATION = re.compile('[~`!@#$%^&*()+={\[}\]|\\:;"\',<.>/?]')
+    A do-nothing stand-in for ``ProfilePhase``.
+    """
+    __slots__ = ()
 
-    def __init__(self, base_directory):
-        """
-        Sets up the object & the data directory.
+    def __enter__(self):
+        return self
 
-        Requires a ``base_directory`` parameter, which specifies the parent
-        directory the index/document/stats data will be kept in.
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
 
-        Example::
 
-            ms = microsearch.Microsearch('/var/my_index')
+class Profiler(object):
+    """
+    Collects per-phase timings & counters for a single ``search``/``index``.
 
-        """
-        self.base_directory = base_directory
-        self.index_path = os.path.join(self.base_directory, 'index')
-        self.docs_path = os.path.join(self.base_directory, 'documents')
-        self.stats_path = os.path.join(self.base_directory, 'stats.json')
-        self.setup()
+    Phases can nest (for instance, ``segment_io`` happens inside of
+    ``collect_results``), so the timings are inclusive. Example::
 
-    def setup(self):
-        """
-        Handles the creation of the various data directories.
+        profiler = Profiler()
 
-        If the paths do not exist, it will create them. As a side effect, you
-        must have read/write access to the location you're trying to create
-        the data at.
-        """
-        if not os.path.exists(self.base_directory):
-            os.makedirs(self.base_directory)
+        with profiler.phase('scoring'):
+            profiler.incr('docs_scored', 25)
 
-        if not os.path.exists(self.index_path):
-            os.makedirs(self.index_path)
+        profiler.as_dict()
+        # {'timings': {'scoring': 0.0012}, 'counters': {'docs_scored': 25}}
 
-        if not os.path.exists(self.docs_path):
-            os.makedirs(self.docs_path)
+    """
+    enabled = True
 
-        return True
+    def __init__(self):
+        self.timings = {}
+        self.counters = {}
 
-    def read_stats(self):
+    def phase(self, name):
         """
-        Reads the index-wide stats.
+        Returns a context manager that adds the time spent within it to the
+        ``name`` phase.
+        """
+        return ProfilePhase(self, name)
 
-        If the stats do not exist, it makes returns data with the current
-        version of ``microsearch`` & zero docs (used in scoring).
+    def incr(self, name, amount=1):
         """
-        if not os.path.exists(self.stats_path):
-            return {
-                'version': '.'.join([str(bit) for bit in __version__]),
-                'total_docs': 0,
-            }
+        Increments the ``name`` counter by ``amount``.
+        """
+        self.counters[name] = self.counters.get(name, 0) + amount
 
-        with open(self.stats_path, 'r') as stats_file:
-            return json.load(stats_file)
+    def as_dict(self):
+        return {
+            'timings': dict(self.timings),
+            'counters': dict(self.counters),
+        }
 
-    def write_stats(self, new_stats):
-        """
-        Writes the index-wide stats.
 
-        Takes a ``new_stats`` parameter, which should be a dictionary of
-        stat data. Example stat data::
+class NullProfiler(Profiler):
+    """
+    The profiler used when nobody's listening.
 
-            {
-                'version': '1.0.0',
-                'total_docs': 25,
-            }
-        """
-        with open(self.stats_path, 'w') as stats_file:
-            json.dump(new_stats, stats_file)
+    Everything is a no-op, so leaving the instrumentation in the hot paths
+    costs next to nothing.
+    """
+    enabled = False
+    null_phase = NullPhase()
 
-        return True
+    def phase(self, name):
+        return self.null_phase
 
-    def increment_total_docs(self):
-        """
-        Increments the total number of documents the index is aware of.
+    def incr(self, name, amount=1):
+        pass
 
-        This is important for scoring reasons & is typically called as part
-        of the indexing process.
-        """
-        current_stats = self.read_stats()
-        current_stats.setdefault('total_docs', 0)
-        current_stats['total_docs'] += 1
-        self.write_stats(current_stats)
 
-    def get_total_docs(self):
-        """
-        Returns the total number of documents the index is aware of.
-        """
-        current_stats = self.read_stats()
-        return int(current_stats.get('total_docs', 0))
+NULL_PROFILER = NullProfiler()
 
 
-    # ==============================
-    # Tokenization & Term Generation
-    # ==============================
+class DocSet(object):
+    """
+    A compressed set of document ordinals, loosely modeled on Roaring bitmaps.
 
-    def make_tokens(self, blob):
-        """
-        Given a string (``blob``) of text, this will return a list of tokens.
+    Ordinals are bucketed by their upper 16 bits. Each bucket (container)
+    holds the lower 16 bits either as a sorted ``array`` of 2-byte integers
+    (when sparse) or as an 8KB bitmap (when dense), so memory stays small
+    either way & membership checks are cheap.
 
-        This generally/loosely follows English sentence construction, replacing
-        most punctuation with spaces, splitting on whitespace & omitting any
-        tokens in ``self.STOP_WORDS``.
+    Example::
 
-        You can customize behavior by overriding ``STOP_WORDS`` or
-        ``PUNCTUATION`` in a subclass.
+        docs = DocSet([1, 5, 70000])
+        5 in docs
+        # True
+        len(docs & DocSet([5, 6]))
+        # 1
+
+    """
+    # Past this many entries, a bitmap is smaller than a sorted array.
+    MAX_ARRAY_SIZE = 4096
+    BITMAP_SIZE = 8192
+
+    def __init__(self, ordinals=None):
+        self.containers = {}
+
+        if ordinals is not None:
+            for ordinal in ordinals:
+                self.add(ordinal)
+
+    def add(self, ordinal):
+        high, low = ordinal >> 16, ordinal & 0xFFFF
+        container = self.containers.get(high)
+
+        if container is None:
+            self.containers[high] = array.array('H', [low])
+        elif isinstance(container, bytearray):
+            container[low >> 3] |= 1 << (low & 7)
+        elif low > container[-1]:
+            # The common case, since ordinals tend to get added in order.
+            container.append(low)
+            self.maybe_convert(high)
+        else:
+            position = bisect.bisect_left(container, low)
+
+            if position == len(container) or container[position] != low:
+                container.insert(position, low)
+                self.maybe_convert(high)
+
+    def maybe_convert(self, high):
         """
-        # Kill the punctuation.
-        blob = self.PUNCTUATION.sub(' ', blob)
-        tokens = []
+        Switches an array container over to a bitmap once it's big enough.
+        """
+        container = self.containers[high]
 
-        # Split on spaces.
-        for token in blob.split():
-            # Make sure everything is in lowercase & whitespace removed.
-            token = token.lower().strip()
+        if len(container) <= self.MAX_ARRAY_SIZE:
+            return
 
-            if not token in self.STOP_WORDS:
-                tokens.append(token)
+        bitmap = bytearray(self.BITMAP_SIZE)
 
-        return tokens
+        for low in container:
+            bitmap[low >> 3] |= 1 << (low & 7)
 
-    def make_ngrams(self, tokens, min_gram=3, max_gram=6):
-        """
-        Converts a iterable of ``tokens`` into n-grams.
+        self.containers[high] = bitmap
 
-        This assumes front grams (all grams made starting from the left side
-        of the token).
+    def __contains__(self, ordinal):
+        container = self.containers.get(ordinal >> 16)
 
-        Optionally accepts a ``min_gram`` parameter, which takes an integer &
-        controls the minimum gram length. Default is ``3``.
+        if container is None:
+            return False
 
-        Optionally accepts a ``max_gram`` parameter, which takes an integer &
-        controls the maximum gram length. Default is ``6``.
-        """
-        terms = {}
+        low = ordinal & 0xFFFF
 
-        for position, token in enumerate(tokens):
-            for window_length in range(min_gram, min(max_gram + 1, len(token) + 1)):
-                # Assuming "front" grams.
-                gram = token[:window_length]
-                terms.setdefault(gram, [])
+        if isinstance(container, bytearray):
+            return bool(container[low >> 3] & (1 << (low & 7)))
 
-                if not position in terms[gram]:
-                    terms[gram].append(position)
+        position = bisect.bisect_left(container, low)
+        return position < len(container) and container[position] == low
 
-        return terms
+    def __iter__(self):
+        for high in sorted(self.containers):
+            base = high << 16
 
+            for low in self.container_values(self.containers[high]):
+                yield base + low
 
-    # ================
-    # Segment Handling
-    # ================
+    def __len__(self):
+        total = 0
 
-    def hash_name(self, term, length=6):
-        """
-        Given a ``term``, hashes it & returns a string of the first N letters.
+        for container in self.containers.values():
+            if isinstance(container, bytearray):
+                total += sum([bin(byte).count('1') for byte in container if byte])
+            else:
+                total += len(container)
 
-        Optionally accepts a ``length`` parameter, which takes an integer &
-        controls how much of the hash is returned. Default is ``6``.
+        return total
 
-        This is usefully when writing files to the file system, as it helps
-        us keep from putting too many files in a given directory (~32K max
-        with the default).
+    def __and__(self, other):
         """
-        # Make sure it's ASCII to appease the hashlib gods.
-        term = term.encode('ascii', errors='ignore')
-        # We hash & slice the term to get a small-ish number of fields
-        # and good distribution between them.
-        hashed = hashlib.md5(term).hexdigest()
-        return hashed[:length]
-
-    def make_segment_name(self, term):
+        Returns the intersection of two ``DocSet`` objects.
         """
-        Given a ``term``, creates a segment filename based on the hash of the term.
+        result = DocSet()
 
-        Returns the full path to the segment.
-        """
-        return os.path.join(self.index_path, "{0}.index".format(self.hash_name(term)))
+        for high, container in self.containers.items():
+            if not high in other.containers:
+                continue
 
-    def parse_record(self, line):
-        """
-        Given a ``line`` from the segment file, this returns the term & its info.
+            base = high << 16
 
-        The term info is stored as serialized JSON. The default separator
-        between the term & info is the ``\t`` character, which would never
-        appear in a term due to the way tokenization is done.
-        """
-        return line.rstrip().split('\t', 1)
+            for low in DocSet.container_values(container):
+                if (base + low) in other:
+                    result.add(base + low)
 
-    def make_record(self, term, term_info):
+        return result
+
+    @staticmethod
+    def container_values(container):
         """
-        Given a ``term`` and a dict of ``term_info``, creates a line for
-        writing to the segment file.
+        Returns the (sorted) lower 16 bits stored in a ``container``.
         """
-        return "{0}\t{1}\n".format(term, json.dumps(term_info, ensure_ascii=False))
+        if isinstance(container, bytearray):
+            return [(byte_number << 3) + bit for byte_number, byte in enumerate(container) if byte for bit in range(8) if byte & (1 << bit)]
 
-    def update_term_info(self, orig_info, new_info):
-        """
-        Takes existing ``orig_info`` & ``new_info`` dicts & combines them
-        intelligently.
+        return container
 
-        Used for updating term_info within the segments.
-        """
-        # Updates are (sadly) not as simple as ``dict.update()``.
-        # Iterate through the keys (documents) & manually update.
-        for doc_id, positions in new_info.items():
-            if not doc_id in orig_info:
-                # Easy case; it's not there. Shunt it in wholesale.
-                orig_info[doc_id] = positions
-            else:
-                # Harder; it's there. Convert to sets, update then convert back
-                # to lists to accommodate ``json``.
-                orig_positions = set(orig_info.get(doc_id, []))
-                new_positions = set(positions)
-                orig_positions.update(new_positions)
-                orig_info[doc_id] = list(orig_positions)
 
-        return orig_info
+class LevenshteinAutomaton(object):
+    """
+    Matches strings within ``max_edits`` edits (insertions, deletions or
+    substitutions) of a ``word``.
 
-    def save_segment(self, term, term_info, update=False):
-        """
-        Writes out new index data to disk.
+    States are sparse rows of the classic edit distance table, keeping only
+    the positions still within ``max_edits``. Feeding a string through
+    ``step`` one character at a time, ``can_match`` says as soon as there's no
+    hope of a match, which is what lets ``Microsearch.fuzzy_expand`` skip
+    whole ranges of the term dictionary.
 
-        Takes a ``term`` string & ``term_info`` dict. It will
-        rewrite the segment in alphabetical order, adding in the data
-        where appropriate.
+    Example::
 
-        Optionally takes an ``update`` parameter, which is a boolean &
-        determines whether the provided ``term_info`` should overwrite or
-        update the data in the segment. Default is ``False`` (overwrite).
-        """
-        seg_name = self.make_segment_name(term)
-        new_seg_file = tempfile.NamedTemporaryFile(delete=False)
-        written = False
+        automaton = LevenshteinAutomaton('lumberg', 1)
+        state = automaton.start()
 
-        if not os.path.exists(seg_name):
-            # If it doesn't exist, touch it.
-            with open(seg_name, 'w') as seg_file:
-                seg_file.write('')
+        for character in 'lumbergh':
+            state = automaton.step(state, character)
 
-        with open(seg_name, 'r') as seg_file:
-            for line in seg_file:
-                seg_term, seg_term_info = self.parse_record(line)
+        automaton.is_match(state)
+        # True
 
-                if not written and seg_term > term:
-                    # We're at the alphabetical location & need to insert.
-                    new_line = self.make_record(term, term_info)
-                    new_seg_file.write(new_line.encode('utf-8'))
-                    written = True
-                elif seg_term == term:
-                    if not update:
-                        # Overwrite the line for the update.
-                        line = self.make_record(term, term_info)
-                    else:
-                        # Update the existing record.
-                        new_info = self.update_term_info(json.loads(seg_term_info), term_info)
-                        line = self.make_record(term, new_info)
+    """
+    def __init__(self, word, max_edits):
+        self.word = word
+        self.max_edits = max_edits
 
-                    written = True
+    def start(self):
+        positions = range(min(len(self.word), self.max_edits) + 1)
+        return (tuple(positions), tuple(positions))
 
-                # Either we haven't reached it alphabetically or we're well-past.
-                # Write the line.
-                new_seg_file.write(line.encode('utf-8'))
+    def step(self, state, character):
+        indices, values = state
+        new_indices = []
+        new_values = []
 
-            if not written:
-                line = self.make_record(term, term_info)
-                new_seg_file.write(line.encode('utf-8'))
+        if indices and indices[0] == 0 and values[0] < self.max_edits:
+            new_indices.append(0)
+            new_values.append(values[0] + 1)
 
-        # Atomically move it into place.
-        new_seg_file.close()
-        try:
-            os.rename(new_seg_file.name, seg_name)
-        except OSError:
-            os.remove(seg_name)
-            os.rename(new_seg_file.name, seg_name)
-        return True
+        for position, index in enumerate(indices):
+            if index == len(self.word):
+                break
 
-    def load_segment(self, term):
-        """
-        Given a ``term``, this will return the ``term_info`` associated with
-        the ``term``.
+            cost = 0 if self.word[index] == character else 1
+            value = values[position] + cost
 
-        If no index file exists or the term is not found, this returns an
-        empty dict.
-        """
-        seg_name = self.make_segment_name(term)
+            if new_indices and new_indices[-1] == index:
+                value = min(value, new_values[-1] + 1)
 
-        if not os.path.exists(seg_name):
-            return {}
+            if position + 1 < len(indices) and indices[position + 1] == index + 1:
+                value = min(value, values[position + 1] + 1)
 
-        with open(seg_name, 'r') as seg_file:
-            for line in seg_file:
-                seg_term, term_info = self.parse_record(line)
+            if value <= self.max_edits:
+                new_indices.append(index + 1)
+                new_values.append(value)
 
-                if seg_term == term:
-                    # Found it.
-                    return json.loads(term_info)
+        return (tuple(new_indices), tuple(new_values))
 
-        return {}
+    def is_match(self, state):
+        indices = state[0]
+        return bool(indices) and indices[-1] == len(self.word)
 
+    def can_match(self, state):
+        return bool(state[0])
 
-    # =================
-    # Document Handling
-    # =================
+
+class Postings(object):
+    """
+    The matches for a query, held compactly.
+
+    Every matching document gets a slot (numbered in the order they're first
+    seen), with their ``doc_ids`` kept in a list. Each term then has a pair of
+    parallel ``array('I')``s, holding the slots of the documents it's in &
+    the term frequency in each, rather than a dict per document.
+
+    Example::
+
+        postings = Postings()
+        postings.add('hello', 'doc-1', 4)
+        postings.add('world', 'doc-1', 1)
+        postings.add('hello', 'doc-2', 1)
+        postings.doc_ids
+        # ['doc-1', 'doc-2']
+        postings.doc_counts(0)
+        # {'hello': 4, 'world': 1}
+
+    """
+    __slots__ = ('doc_ids', 'slots', 'term_slots', 'term_freqs', 'field_norms')
+
+    def __init__(self):
+        self.doc_ids = []
+        self.slots = {}
+        self.term_slots = {}
+        self.term_freqs = {}
+        # Filled in by ``Microsearch.postings_norms`` as needed.
+        self.field_norms = {}
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def add(self, term, doc_id, term_freq):
+        slot = self.slots.get(doc_id)
+
+        if slot is None:
+            slot = self.slots[doc_id] = len(self.doc_ids)
+            self.doc_ids.append(doc_id)
+
+        if not term in self.term_slots:
+            self.term_slots[term] = array.array('I')
+            self.term_freqs[term] = array.array('I')
+
+        self.term_slots[term].append(slot)
+        self.term_freqs[term].append(term_freq)
+
+    def doc_counts(self, slot):
+        """
+        Returns a dict of the terms in the document in a given ``slot`` to
+        their frequencies (like a value from ``collect_results``).
+        """
+        counts = {}
+
+        for term, slots in self.term_slots.items():
+            try:
+                counts[term] = self.term_freqs[term][slots.index(slot)]
+            except ValueError:
+                pass
+
+        return counts
+
+
+class Hit(object):
+    """
+    A scored document, for the few that make it onto a page of results.
+    """
+    __slots__ = ('id', 'score')
+
+    def __init__(self, doc_id, score):
+        self.id = doc_id
+        self.score = score
+
+
+class DocumentCache(object):
+    """
+    Keeps recently loaded documents in memory, up to ``max_bytes`` (measured
+    by the size of their JSON).
+
+    The least recently used documents get evicted first. If there's a
+    ``compressed_bytes`` budget, they get ``zlib``-compressed into a second
+    tier instead of being thrown away, which holds several times as many &
+    is still much cheaper to load from than disk.
+
+    Documents go in & come back out as (deep) copies, so callers can change
+    them freely. It's safe to share between threads.
+
+    Example::
+
+        cache = DocumentCache(1024 * 1024, compressed_bytes=4 * 1024 * 1024)
+        cache.put('doc-1', {'text': 'Hello world'}, 23)
+        cache.get('doc-1')
+        # {'text': 'Hello world'}
+
+    """
+    def __init__(self, max_bytes, compressed_bytes=0):
+        self.max_bytes = max_bytes
+        self.compressed_bytes = compressed_bytes
+        self.lock = threading.RLock()
+        self.clear()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.documents) + len(self.compressed)
+
+    def __contains__(self, doc_id):
+        with self.lock:
+            return doc_id in self.documents or doc_id in self.compressed
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+
+    def clear(self):
+        with self.lock:
+            self.documents = collections.OrderedDict()
+            self.compressed = collections.OrderedDict()
+            self.size = 0
+            self.compressed_size = 0
+            self.hits = 0
+            self.compressed_hits = 0
+            self.misses = 0
+
+    def get(self, doc_id):
+        """
+        Returns a copy of the cached document for a ``doc_id``, or ``None`` if
+        it isn't cached.
+        """
+        with self.lock:
+            if doc_id in self.documents:
+                self.documents.move_to_end(doc_id)
+                self.hits += 1
+                return copy.deepcopy(self.documents[doc_id][0])
+
+            if doc_id in self.compressed:
+                blob = self.compressed.pop(doc_id)
+                self.compressed_size -= len(blob)
+                raw = zlib.decompress(blob).decode('utf-8')
+                document = json.loads(raw)
+                self.put(doc_id, document, len(raw))
+                self.compressed_hits += 1
+                return document
+
+            self.misses += 1
+            return None
+
+    def put(self, doc_id, document, size):
+        """
+        Caches a copy of a ``document`` (which is ``size`` bytes as JSON) for
+        a ``doc_id``, evicting others as needed.
+        """
+        document = copy.deepcopy(document)
+
+        with self.lock:
+            self.discard(doc_id)
+            self.documents[doc_id] = (document, size)
+            self.size += size
+            self.evict()
+
+    def discard(self, doc_id):
+        """
+        Removes a ``doc_id`` from the cache, if it's there.
+        """
+        with self.lock:
+            if doc_id in self.documents:
+                self.size -= self.documents.pop(doc_id)[1]
+
+            if doc_id in self.compressed:
+                self.compressed_size -= len(self.compressed.pop(doc_id))
+
+    def resize(self, max_bytes, compressed_bytes=None):
+        """
+        Changes the budget(s), evicting documents if they've shrunk.
+        """
+        with self.lock:
+            self.max_bytes = max_bytes
+
+            if compressed_bytes is not None:
+                self.compressed_bytes = compressed_bytes
+
+            self.evict()
+
+    def evict(self):
+        with self.lock:
+            while self.size > self.max_bytes:
+                doc_id, (document, size) = self.documents.popitem(last=False)
+                self.size -= size
+
+                if self.compressed_bytes:
+                    blob = zlib.compress(json.dumps(document, ensure_ascii=False).encode('utf-8'))
+                    self.compressed[doc_id] = blob
+                    self.compressed_size += len(blob)
+
+            while self.compressed_size > self.compressed_bytes:
+                self.compressed_size -= len(self.compressed.popitem(last=False)[1])
+
+
+class Similarity(object):
+    """
+    Decides how the documents matching a query get scored (see the
+    ``similarity`` option of ``Microsearch``).
+
+    Subclasses work out anything that only depends on the query (like the
+    IDF of each term) once up front in ``score_postings``, leaving a plain
+    multiply-add per posting. Ones that set ``uses_norms`` get each
+    document's (quantized) field lengths, which are recorded at index time
+    (see ``Microsearch.save_norms``).
+    """
+    uses_norms = False
+
+    def idf(self, term_docs, total_docs):
+        """
+        Returns the inverse document frequency of a term found in
+        ``term_docs`` of the ``total_docs``.
+        """
+        raise NotImplementedError()
+
+    def score_postings(self, ms, terms, per_term_docs, postings, total_docs):
+        """
+        Scores every document in the ``postings`` for a query of ``terms``
+        against the ``ms`` index.
+
+        Returns an ``array('d')`` of the scores, indexed by slot.
+        """
+        raise NotImplementedError()
+
+    def explain(self, ms, terms, per_term_docs, postings, slot, total_docs):
+        """
+        Breaks down the score of the document in a given ``slot`` of the
+        ``postings``.
+
+        Returns a dict, with the ``terms`` as keys & their share of the score
+        as values.
+        """
+        raise NotImplementedError()
+
+
+class BM25Similarity(Similarity):
+    """
+    The classic ``microsearch`` scoring (see ``Microsearch.bm25_relevance``),
+    without document length normalization. This is the default.
+
+    Term frequencies are small integers, so each term's contribution for a
+    given frequency only gets worked out once per query.
+    """
+    def __init__(self, k=1.2):
+        self.k = k
+
+    def idf(self, term_docs, total_docs):
+        return math.log((total_docs - term_docs + 1.0) / term_docs) / math.log(1.0 + total_docs)
+
+    def score_postings(self, ms, terms, per_term_docs, postings, total_docs):
+        sums = array.array('d', bytes(8 * len(postings)))
+        k = self.k
+
+        for term in terms:
+            if not per_term_docs.get(term) or not term in postings.term_slots:
+                continue
+
+            idf = self.idf(per_term_docs[term], total_docs)
+            boost = ms.term_boost(term)
+            contributions = {}
+
+            for slot, tf in zip(postings.term_slots[term], postings.term_freqs[term]):
+                contribution = contributions.get(tf)
+
+                if contribution is None:
+                    contribution = contributions[tf] = boost * tf * idf / (tf + k)
+
+                sums[slot] = sums[slot] + contribution
+
+        divisor = 2 * len(terms)
+        return array.array('d', [0.5 + score / divisor for score in sums])
+
+    def explain(self, ms, terms, per_term_docs, postings, slot, total_docs):
+        return ms.bm25_explain(terms, per_term_docs, postings.doc_counts(slot), total_docs, k=self.k)
+
+
+class TFIDFSimilarity(Similarity):
+    """
+    Lucene-style TF-IDF: the square root of the term frequency, times the
+    IDF squared, divided by the square root of the field's length.
+    """
+    uses_norms = True
+
+    def idf(self, term_docs, total_docs):
+        return 1.0 + math.log(total_docs / (term_docs + 1.0))
+
+    def term_weights(self, ms, terms, per_term_docs, total_docs):
+        weights = {}
+
+        for term in terms:
+            if per_term_docs.get(term):
+                weights[term] = ms.term_boost(term) * self.idf(per_term_docs[term], total_docs) ** 2
+
+        return weights
+
+    def norm_table(self, ms, field):
+        """
+        Returns a list of the length normalization factor for each norm byte
+        of a ``field``. Documents without a norm get the average length's.
+        """
+        table = [1.0 / math.sqrt(max(length, 1.0)) for length in ms.NORM_LENGTHS]
+        table[0] = 1.0 / math.sqrt(max(ms.get_average_field_length(field), 1.0))
+        return table
+
+    def score_postings(self, ms, terms, per_term_docs, postings, total_docs):
+        sums = array.array('d', bytes(8 * len(postings)))
+        tf_factors = [math.sqrt(tf) for tf in range(64)]
+
+        for term, weight in self.term_weights(ms, terms, per_term_docs, total_docs).items():
+            if not term in postings.term_slots:
+                continue
+
+            field = ms.split_field_term(term)[0]
+            norms = ms.postings_norms(postings, field)
+            table = self.norm_table(ms, field)
+
+            for slot, tf in zip(postings.term_slots[term], postings.term_freqs[term]):
+                tf_factor = tf_factors[tf] if tf < 64 else math.sqrt(tf)
+                sums[slot] = sums[slot] + weight * tf_factor * table[norms[slot]]
+
+        return sums
+
+    def explain(self, ms, terms, per_term_docs, postings, slot, total_docs):
+        contributions = {}
+        counts = postings.doc_counts(slot)
+
+        for term, weight in self.term_weights(ms, terms, per_term_docs, total_docs).items():
+            if counts.get(term):
+                field = ms.split_field_term(term)[0]
+                norm = ms.postings_norms(postings, field)[slot]
+                contributions[term] = weight * math.sqrt(counts[term]) * self.norm_table(ms, field)[norm]
+
+        return contributions
+
+
+class BM25FSimilarity(Similarity):
+    """
+    BM25F: the frequencies of a word across all the fields are normalized
+    by each field's length (relative to its average), weighted by the
+    field's boost & summed, before being saturated (by ``k``) just once.
+
+    Unlike ``BM25Similarity``, a word that's in both a short ``subject`` &
+    a long ``text`` doesn't count (nearly) twice.
+    """
+    uses_norms = True
+
+    def __init__(self, k=1.2, b=0.75):
+        self.k = k
+        self.b = b
+
+    def idf(self, term_docs, total_docs):
+        return math.log(1.0 + (total_docs - term_docs + 0.5) / (term_docs + 0.5))
+
+    def word_terms(self, ms, terms):
+        """
+        Groups the (field-prefixed) ``terms`` by the word they're for.
+        """
+        words = collections.OrderedDict()
+
+        for term in terms:
+            field, word = ms.split_field_term(term)
+            words.setdefault(word, []).append((term, field))
+
+        return words
+
+    def norm_table(self, ms, field):
+        """
+        Returns a list of the length normalization factor for each norm byte
+        of a ``field``. Documents without a norm count as average length.
+        """
+        average = ms.get_average_field_length(field) or 1.0
+        table = [1.0 / (1.0 - self.b + self.b * length / average) for length in ms.NORM_LENGTHS]
+        table[0] = 1.0
+        return table
+
+    def weighted_freqs(self, ms, word_terms, postings):
+        """
+        Returns an ``array('d')`` of the length-normalized, boosted
+        frequencies of a word in each slot.
+        """
+        freqs = array.array('d', bytes(8 * len(postings)))
+
+        for term, field in word_terms:
+            if not term in postings.term_slots:
+                continue
+
+            boost = ms.term_boost(term)
+            norms = ms.postings_norms(postings, field)
+            table = [boost * factor for factor in self.norm_table(ms, field)]
+
+            for slot, tf in zip(postings.term_slots[term], postings.term_freqs[term]):
+                freqs[slot] = freqs[slot] + tf * table[norms[slot]]
+
+        return freqs
+
+    def score_postings(self, ms, terms, per_term_docs, postings, total_docs):
+        sums = array.array('d', bytes(8 * len(postings)))
+        k = self.k
+
+        for word, word_terms in self.word_terms(ms, terms).items():
+            term_docs = max([per_term_docs.get(term, 0) for term, field in word_terms])
+
+            if not term_docs:
+                continue
+
+            idf = self.idf(term_docs, total_docs)
+
+            for slot, freq in enumerate(self.weighted_freqs(ms, word_terms, postings)):
+                if freq:
+                    sums[slot] = sums[slot] + idf * freq / (k + freq)
+
+        return sums
+
+    def explain(self, ms, terms, per_term_docs, postings, slot, total_docs):
+        contributions = {}
+
+        for word, word_terms in self.word_terms(ms, terms).items():
+            term_docs = max([per_term_docs.get(term, 0) for term, field in word_terms])
+            freq = self.weighted_freqs(ms, word_terms, postings)[slot]
+
+            if term_docs and freq:
+                contributions[word] = self.idf(term_docs, total_docs) * freq / (self.k + freq)
+
+        return contributions
+
+
+class Microsearch(object):
+    """
+    Controls the indexing/searching of documents.
+
+    Typical usage::
+
+        ms = microsearch.Microsearch('/tmp/microsearch')
+        ms.index('email_1', {'text': "This is a blob of text to be indexed."})
+        ms.search('blob')
+
+    """
+    # A fairly standard list of "stopwords", which are words that contribute little
+    # to relevance (since they are so common in English) & are to be ignored.
+    STOP_WORDS = set([
+        'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by',
+        'for', 'if', 'in', 'into', 'is', 'it',
+        'no', 'not', 'of', 'on', 'or', 's', 'such',
+        't', 'that', 'the', 'their', 'then', 'there', 'these',
+        'they', 'this', 'to', 'was', 'will', 'with'
+    ])
+    PUNCTUATION = re.compile('[~`!@#$%^&*()+={\[}\]|\\:;"\',<.>/?]')
+    # Matches a field-scoped chunk of a query, like ``subject:audit``.
+    FIELD_QUERY = re.compile(r'^(\w+):(.+)$')
+    # Matches a fuzzy chunk of a query, like ``lumberg~`` or ``lumberg~2``.
+    FUZZY_QUERY = re.compile(r'^(.+)~([12])?$')
+    # The field whose terms are stored without a field prefix.
+    DEFAULT_FIELD = 'text'
+
+    # Temporary files in the index directories start with this, so they're
+    # easy to tell apart from the real ones.
+    TEMP_PREFIX = '.tmp-'
+    SNAPSHOT_FORMAT = 'microsearch-snapshot'
+    # How many whole segments a reader (see ``refresh``) keeps in memory.
+    SEGMENT_CACHE_SIZE = 1024
+    # How big the query log gets (in bytes) before it's rotated.
+    QUERY_LOG_SIZE = 16 * 1024 * 1024
+    # How big the commit log gets (in bytes) before it's started over.
+    COMMITS_LOG_SIZE = 1024 * 1024
+    # Whether the postings are spread over many segment files, which can be
+    # tidied one at a time (see ``MergeScheduler``).
+    SEGMENT_FILES = True
+    # How each kind of doc values column is stored & what marks a missing value.
+    COLUMN_TYPES = {
+        'numeric': ('d', float('nan')),
+        'keyword': ('i', -1),
+    }
+    # The (approximate) field length each norm byte stands for (see
+    # ``encode_norm``).
+    NORM_LENGTHS = [2 ** (norm / 16.0) - 1 for norm in range(256)]
+
+    def __init__(self, base_directory, *, fields=None, doc_values=None, filter_cache_size=64, query_log=False, warmup=False, segment_buckets=None, metrics_sink=None, refresh_interval=None, document_cache_size=0, compressed_cache_size=0, similarity=None):
+        """
+        Sets up the object & the data directory.
+
+        Requires a ``base_directory`` parameter, which specifies the parent
+        directory the index/document/stats data will be kept in.
+
+        The rest of the options are keyword-only, so new ones can be added
+        without breaking existing callers.
+
+        Optionally accepts a ``fields`` parameter, which declares the fields
+        that get indexed. It can be a list of field names or a dict, with the
+        field names as keys & their boosts (used in scoring) as values.
+        Default is ``None`` (only the ``text`` field, with a boost of
+        ``1.0``).
+
+        Optionally accepts a ``doc_values`` parameter, which declares the
+        fields that get a column in the doc values store (used for sorting,
+        filtering & faceting). It should be a dict, with the field names as
+        keys & either ``numeric`` or ``keyword`` as values. Default is
+        ``None`` (no columns).
+
+        Optionally accepts a ``filter_cache_size`` parameter, which is an
+        integer of how many filters (see ``search``) to keep cached. The least
+        recently used ones get evicted first. Default is ``64``.
+
+        Optionally accepts a ``query_log`` parameter, which is a boolean. If
+        ``True``, the terms of every search get logged, so the hottest ones
+        can be included in a warmup snapshot (see
+        ``write_warmup_snapshot``). Only the most recent searches are kept
+        (see ``log_query``). Default is ``False``.
+
+        Optionally accepts a ``warmup`` parameter, which is a boolean. If
+        ``True`` & there's a warmup snapshot, it gets loaded right away (see
+        ``warmup``). Default is ``False``.
+
+        Optionally accepts a ``segment_buckets`` parameter, which is an
+        integer of how many segment files the terms get spread over (using a
+        fast hash of the whole term, see ``segment_bucket``). The number is
+        recorded in the stats, so it only needs providing when creating the
+        index. Default is ``None`` (use the recorded number, or the classic
+        MD5-based segment names for a new index).
+
+        Optionally accepts a ``metrics_sink`` parameter, which should be a
+        callable. If provided, every ``search``/``index``/``bulk_index`` call
+        gets profiled & the sink is called with the name of the operation &
+        the profile data (see ``Profiler``). Default is ``None``.
+
+        Optionally accepts a ``refresh_interval`` parameter, which is a number
+        of seconds. If provided, this object acts as a reader of an index
+        being written to elsewhere: the stats & segments it reads are kept in
+        memory, giving searches a stable view, & ``search`` picks up new
+        commits (see ``refresh``) once they're this old. Default is ``None``
+        (always read from disk).
+
+        Optionally accepts a ``document_cache_size`` parameter, which is an
+        integer of how many bytes of loaded documents to keep in memory (see
+        ``DocumentCache``), so the ones that turn up in results over & over
+        don't need reading each time. Documents changed by other processes
+        are dropped from it when ``search`` sees a new generation. Default is
+        ``0`` (no cache).
+
+        Optionally accepts a ``compressed_cache_size`` parameter, which is an
+        integer of how many bytes of compressed documents to keep, once
+        they've been evicted from the document cache. Default is ``0`` (none).
+
+        Optionally accepts a ``similarity`` parameter, which is a
+        ``Similarity`` deciding how results get scored (like
+        ``BM25FSimilarity()`` or ``TFIDFSimilarity()``). Default is ``None``
+        (``BM25Similarity()``).
+
+        Example::
+
+            ms = microsearch.Microsearch('/var/my_index')
+
+        """
+        self.base_directory = base_directory
+        self.index_path = os.path.join(self.base_directory, 'index')
+        self.docs_path = os.path.join(self.base_directory, 'documents')
+        self.stats_path = os.path.join(self.base_directory, 'stats.json')
+        self.routing_path = os.path.join(self.base_directory, 'routing.json')
+
+        if fields is None:
+            fields = [self.DEFAULT_FIELD]
+
+        if not hasattr(fields, 'items'):
+            fields = dict([(field, 1.0) for field in fields])
+
+        self.fields = fields
+        self.ordinals_path = os.path.join(self.base_directory, 'ordinals.txt')
+        self.term_dictionary_path = os.path.join(self.base_directory, 'terms.txt')
+        self.query_log_path = os.path.join(self.base_directory, 'queries.log')
+        self.warmup_path = os.path.join(self.base_directory, 'warmup.snapshot')
+        self.values_path = os.path.join(self.base_directory, 'values')
+        self.impacts_path = os.path.join(self.base_directory, 'impacts')
+        self.norms_path = os.path.join(self.base_directory, 'norms')
+        self.generation_path = os.path.join(self.base_directory, 'generation')
+        self.commits_path = os.path.join(self.base_directory, 'commits.log')
+        self.doc_values = doc_values or {}
+
+        for field, kind in self.doc_values.items():
+            if not kind in self.COLUMN_TYPES:
+                raise ValueError("The '{0}' doc values field must be one of: {1}.".format(field, ', '.join(sorted(self.COLUMN_TYPES))))
+
+        self.filter_cache_size = filter_cache_size
+        self.similarity = similarity or BM25Similarity()
+        self.document_cache = None
+
+        if document_cache_size:
+            self.document_cache = DocumentCache(document_cache_size, compressed_bytes=compressed_cache_size)
+
+        self.clear_caches()
+        self.query_log = query_log
+        self.metrics_sink = metrics_sink
+        # Each thread gets its own profiler (see ``profiling``).
+        self.profilers = threading.local()
+        self.refresh_interval = refresh_interval
+        # Held for the duration of every write, so that a snapshot sees
+        # either all of an ``index``/``bulk_index`` call or none of it.
+        self.write_lock = threading.RLock()
+        self.setup()
+        self.load_routing(segment_buckets)
+        self.generation = self.read_generation()
+        self.commits_size = 0
+        self.commits_inode = None
+        # Commits held back until the end of a ``batch``.
+        self.batch_depth = 0
+        self.pending_commits = []
+
+        if os.path.exists(self.commits_path):
+            commits_stat = os.stat(self.commits_path)
+            self.commits_size = commits_stat.st_size
+            self.commits_inode = commits_stat.st_ino
+
+        self.refreshed_at = time.time()
+
+        if refresh_interval is not None:
+            self.stats_cache = self.read_stats()
+
+        if warmup and os.path.exists(self.warmup_path):
+            self.warmup()
+
+    def setup(self):
+        """
+        Handles the creation of the various data directories.
+
+        If the paths do not exist, it will create them. As a side effect, you
+        must have read/write access to the location you're trying to create
+        the data at.
+        """
+        if not os.path.exists(self.base_directory):
+            os.makedirs(self.base_directory)
+
+        if not os.path.exists(self.index_path):
+            os.makedirs(self.index_path)
+
+        if not os.path.exists(self.docs_path):
+            os.makedirs(self.docs_path)
+
+        return True
+
+    def close(self):
+        """
+        Releases any open handles.
+
+        The file-based index doesn't keep any open, so there's nothing to do.
+        """
+        pass
+
+    def __getstate__(self):
+        # Locks & thread-locals can't be pickled (shards may get sent to
+        # other processes), so the copy gets fresh ones instead.
+        state = self.__dict__.copy()
+        del state['write_lock']
+        del state['profilers']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.write_lock = threading.RLock()
+        self.profilers = threading.local()
+
+    def clear_caches(self):
+        """
+        Throws away everything that's been loaded into memory, so it gets
+        read fresh from disk as needed.
+        """
+        # In-memory copies of the ordinals & doc values, loaded as needed.
+        self.ordinals = {}
+        self.ordinal_doc_ids = []
+        self.ordinals_size = 0
+        self.columns = {}
+        self.column_keys = {}
+        self.norms = {}
+        self.term_dictionary = []
+        self.term_dictionary_set = set()
+        self.term_dictionary_size = 0
+        # Whether ``term_dictionary`` needs re-sorting from the set.
+        self.term_dictionary_stale = False
+        self.filter_cache = collections.OrderedDict()
+        # The version (see ``file_version``) of each segment that's been seen
+        # to be in order, so reads of it can stop early.
+        self.sorted_segments = {}
+        # Populated by ``warmup``.
+        self.stats_cache = None
+        self.postings_cache = {}
+        # Whole segments (as raw records), only kept by readers (see
+        # ``refresh``).
+        self.segment_cache = collections.OrderedDict()
+        # The generation, terms & ``term_info`` fetched by the last
+        # ``shard_stats``, for ``shard_search`` to reuse.
+        self.shard_terms = None
+
+        if self.document_cache is not None:
+            self.document_cache.clear()
+
+    @property
+    def profiler(self):
+        """
+        The current thread's profiler (``NULL_PROFILER`` unless inside
+        ``profiling``).
+        """
+        return getattr(self.profilers, 'profiler', NULL_PROFILER)
+
+    @profiler.setter
+    def profiler(self, profiler):
+        self.profilers.profiler = profiler
+
+    @contextlib.contextmanager
+    def profiling(self, operation, enabled=False, attach_to=None):
+        """
+        A context manager that profiles the enclosed ``operation``.
+
+        Only does any work if ``enabled`` is ``True`` or there's a
+        ``metrics_sink``. While active, the profiler is available as
+        ``self.profiler`` to all the methods involved, in the same thread
+        only, so concurrent searches each get their own.
+
+        Optionally accepts an ``attach_to`` parameter, which is a dict the
+        profile data gets added to (as ``profile``) when ``enabled``.
+        """
+        if not enabled and self.metrics_sink is None:
+            yield self.profiler
+            return
+
+        profiler = Profiler()
+        previous_profiler = self.profiler
+        self.profiler = profiler
+
+        try:
+            with profiler.phase('total'):
+                yield profiler
+        finally:
+            self.profiler = previous_profiler
+
+        profile_data = profiler.as_dict()
+
+        if enabled and attach_to is not None:
+            attach_to['profile'] = profile_data
+
+        if self.metrics_sink is not None:
+            self.metrics_sink(operation, profile_data)
+
+    def read_stats(self):
+        """
+        Reads the index-wide stats.
+
+        If the stats do not exist, it makes returns data with the current
+        version of ``microsearch`` & zero docs (used in scoring).
+
+        Once warmed up (see ``warmup``), the stats come from memory instead.
+        """
+        if self.stats_cache is not None:
+            return json.loads(json.dumps(self.stats_cache))
+
+        if not os.path.exists(self.stats_path):
+            return {
+                'version': '.'.join([str(bit) for bit in __version__]),
+                'total_docs': 0,
+            }
+
+        with open(self.stats_path, 'r') as stats_file:
+            return json.load(stats_file)
+
+    def write_stats(self, new_stats):
+        """
+        Writes the index-wide stats.
+
+        Takes a ``new_stats`` parameter, which should be a dictionary of
+        stat data. Example stat data::
+
+            {
+                'version': '1.0.0',
+                'total_docs': 25,
+            }
+        """
+        # Swapped in all at once, so readers never see a half-written file.
+        new_stats_file = tempfile.NamedTemporaryFile(mode='w', delete=False, dir=self.base_directory, prefix=self.TEMP_PREFIX)
+
+        with new_stats_file:
+            json.dump(new_stats, new_stats_file)
+
+        os.rename(new_stats_file.name, self.stats_path)
+
+        if self.stats_cache is not None:
+            self.stats_cache = new_stats
+
+        return True
+
+    def increment_total_docs(self):
+        """
+        Increments the total number of documents the index is aware of.
+
+        This is important for scoring reasons & is typically called as part
+        of the indexing process.
+        """
+        self.add_to_stats(1)
+
+    def add_to_stats(self, doc_count, field_lengths=None):
+        """
+        Adds newly indexed documents to the index-wide stats.
+
+        Requires a ``doc_count`` parameter, which is an integer of how many
+        documents were indexed.
+
+        Optionally accepts a ``field_lengths`` parameter, which should be a
+        dict, with field names as keys & lists of the new documents' token
+        counts for that field as values. Default is ``None``.
+        """
+        current_stats = self.read_stats()
+        current_stats.setdefault('total_docs', 0)
+        current_stats['total_docs'] += doc_count
+
+        if field_lengths:
+            current_stats.setdefault('field_lengths', {})
+            current_stats.setdefault('field_docs', {})
+
+            for field, lengths in field_lengths.items():
+                current_stats['field_lengths'][field] = current_stats['field_lengths'].get(field, 0) + sum(lengths)
+                current_stats['field_docs'][field] = current_stats['field_docs'].get(field, 0) + len(lengths)
+
+        self.write_stats(current_stats)
+
+    def get_total_docs(self):
+        """
+        Returns the total number of documents the index is aware of.
+        """
+        current_stats = self.read_stats()
+        return int(current_stats.get('total_docs', 0))
+
+    def get_average_field_length(self, field):
+        """
+        Returns the average number of tokens in a given ``field``, across the
+        documents that have it.
+        """
+        current_stats = self.read_stats()
+        field_docs = current_stats.get('field_docs', {}).get(field, 0)
+
+        if not field_docs:
+            return 0.0
+
+        return current_stats['field_lengths'][field] / float(field_docs)
+
+
+    # ==============================
+    # Tokenization & Term Generation
+    # ==============================
+
+    def make_tokens(self, blob):
+        """
+        Given a string (``blob``) of text, this will return a list of tokens.
+
+        This generally/loosely follows English sentence construction, replacing
+        most punctuation with spaces, splitting on whitespace & omitting any
+        tokens in ``self.STOP_WORDS``.
+
+        You can customize behavior by overriding ``STOP_WORDS`` or
+        ``PUNCTUATION`` in a subclass.
+        """
+        # Kill the punctuation.
+        blob = self.PUNCTUATION.sub(' ', blob)
+        tokens = []
+
+        # Split on spaces.
+        for token in blob.split():
+            # Make sure everything is in lowercase & whitespace removed.
+            token = token.lower().strip()
+
+            if not token in self.STOP_WORDS:
+                tokens.append(token)
+
+        return tokens
+
+    def make_ngrams(self, tokens, min_gram=3, max_gram=6):
+        """
+        Converts a iterable of ``tokens`` into n-grams.
+
+        This assumes front grams (all grams made starting from the left side
+        of the token).
+
+        Optionally accepts a ``min_gram`` parameter, which takes an integer &
+        controls the minimum gram length. Default is ``3``.
+
+        Optionally accepts a ``max_gram`` parameter, which takes an integer &
+        controls the maximum gram length. Default is ``6``.
+        """
+        terms = {}
+
+        for position, token in enumerate(tokens):
+            for window_length in range(min_gram, min(max_gram + 1, len(token) + 1)):
+                # Assuming "front" grams.
+                gram = token[:window_length]
+                terms.setdefault(gram, [])
+
+                if not position in terms[gram]:
+                    terms[gram].append(position)
+
+        return terms
+
+
+    # ================
+    # Segment Handling
+    # ================
+
+    def hash_name(self, term, length=6):
+        """
+        Given a ``term``, hashes it & returns a string of the first N letters.
+
+        Optionally accepts a ``length`` parameter, which takes an integer &
+        controls how much of the hash is returned. Default is ``6``.
+
+        This is usefully when writing files to the file system, as it helps
+        us keep from putting too many files in a given directory (~32K max
+        with the default).
+        """
+        # Make sure it's ASCII to appease the hashlib gods.
+        term = term.encode('ascii', errors='ignore')
+        # We hash & slice the term to get a small-ish number of fields
+        # and good distribution between them.
+        hashed = hashlib.md5(term).hexdigest()
+        return hashed[:length]
+
+    def load_routing(self, segment_buckets=None):
+        """
+        Loads how terms get routed to segments: the number of buckets (see
+        ``segment_bucket``) & any terms that have been moved to a segment of
+        their own (see ``rebalance_segments``).
+
+        Optionally accepts a ``segment_buckets`` parameter, which sets the
+        number of buckets for a new index. Raises a ``ValueError`` if the
+        index already has documents routed differently.
+        """
+        stats = self.read_stats()
+        existing = stats.get('segment_buckets')
+
+        if segment_buckets is not None and segment_buckets != existing:
+            if stats.get('total_docs'):
+                raise ValueError("This index was created with {0} segment buckets, not {1}.".format(existing or 'hashed', segment_buckets))
+
+            stats['segment_buckets'] = segment_buckets
+            self.write_stats(stats)
+            existing = segment_buckets
+
+        self.segment_buckets = existing
+        self.segment_routes = {}
+        self.routing_version = self.read_routing_version()
+
+        if self.routing_version is not None:
+            with open(self.routing_path, 'r') as routing_file:
+                self.segment_routes = json.load(routing_file)
+
+    def read_routing_version(self):
+        """
+        Returns something that changes whenever ``routing.json`` gets
+        replaced (or ``None`` if there isn't one).
+        """
+        if not os.path.exists(self.routing_path):
+            return None
+
+        return self.file_version(os.stat(self.routing_path))
+
+    def check_routing(self):
+        """
+        Reloads the routing if another instance (or process) has rebalanced
+        the segments since it was loaded. Called before every search &
+        write, so nothing goes to (or gets looked for in) the old segment.
+
+        Returns ``True`` if it was reloaded, ``False`` otherwise.
+        """
+        if self.read_routing_version() == self.routing_version:
+            return False
+
+        self.load_routing()
+        return True
+
+    def segment_bucket(self, term):
+        """
+        Given a ``term``, returns the name of the bucket it's routed to.
+
+        Uses CRC32 (much cheaper than a cryptographic hash) over the full
+        UTF-8 term, so non-ASCII terms spread out as evenly as any others.
+        """
+        return "{0:05x}".format(zlib.crc32(term.encode('utf-8')) % self.segment_buckets)
+
+    def make_segment_name(self, term):
+        """
+        Given a ``term``, creates a segment filename based on the hash of the term.
+
+        If the index was created with ``segment_buckets``, the name comes
+        from ``segment_bucket`` instead. Either way, terms moved by
+        ``rebalance_segments`` go where they've been moved to.
+
+        Returns the full path to the segment.
+        """
+        if term in self.segment_routes:
+            name = self.segment_routes[term]
+        elif self.segment_buckets:
+            name = self.segment_bucket(term)
+        else:
+            name = self.hash_name(term)
+
+        return os.path.join(self.index_path, "{0}.index".format(name))
+
+    def file_version(self, file_stat):
+        """
+        Given the ``os.stat`` of a file, returns something that changes
+        whenever the file gets rewritten or replaced.
+        """
+        return (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino)
+
+    def parse_record(self, line):
+        """
+        Given a ``line`` from the segment file, this returns the term & its info.
+
+        The term info is stored as serialized JSON. The default separator
+        between the term & info is the ``\t`` character, which would never
+        appear in a term due to the way tokenization is done.
+        """
+        return line.rstrip().split('\t', 1)
+
+    def make_record(self, term, term_info):
+        """
+        Given a ``term`` and a dict of ``term_info``, creates a line for
+        writing to the segment file.
+        """
+        return "{0}\t{1}\n".format(term, json.dumps(term_info, ensure_ascii=False))
+
+    def update_term_info(self, orig_info, new_info):
+        """
+        Takes existing ``orig_info`` & ``new_info`` dicts & combines them
+        intelligently.
+
+        Used for updating term_info within the segments.
+        """
+        # Updates are (sadly) not as simple as ``dict.update()``.
+        # Iterate through the keys (documents) & manually update.
+        for doc_id, positions in new_info.items():
+            if not doc_id in orig_info:
+                # Easy case; it's not there. Shunt it in wholesale.
+                orig_info[doc_id] = positions
+            else:
+                # Harder; it's there. Convert to sets, update then convert back
+                # to lists to accommodate ``json``.
+                orig_positions = set(orig_info.get(doc_id, []))
+                new_positions = set(positions)
+                orig_positions.update(new_positions)
+                orig_info[doc_id] = list(orig_positions)
+
+        return orig_info
+
+    def save_segment(self, term, term_info, update=False):
+        """
+        Writes out new index data to disk.
+
+        Takes a ``term`` string & ``term_info`` dict. It will
+        rewrite the segment in alphabetical order, adding in the data
+        where appropriate.
+
+        Optionally takes an ``update`` parameter, which is a boolean &
+        determines whether the provided ``term_info`` should overwrite or
+        update the data in the segment. Default is ``False`` (overwrite).
+        """
+        seg_name = self.make_segment_name(term)
+        # Kept next to the segments (rather than in ``/tmp``), so the rename
+        # stays on one filesystem & any leftovers from a crash are easy to
+        # find (see ``check_index``).
+        new_seg_file = tempfile.NamedTemporaryFile(delete=False, dir=self.index_path, prefix=self.TEMP_PREFIX)
+        written = False
+        self.postings_cache.pop(term, None)
+        self.segment_cache.pop(seg_name, None)
+
+        if not os.path.exists(seg_name):
+            # If it doesn't exist, touch it.
+            with open(seg_name, 'w') as seg_file:
+                seg_file.write('')
+
+        previous = None
+        in_order = True
+
+        with open(seg_name, 'r') as seg_file:
+            for line in seg_file:
+                seg_term, seg_term_info = self.parse_record(line)
+
+                if previous is not None and seg_term <= previous:
+                    in_order = False
+
+                previous = seg_term
+
+                if not written and seg_term > term:
+                    # We're at the alphabetical location & need to insert.
+                    new_line = self.make_record(term, term_info)
+                    new_seg_file.write(new_line.encode('utf-8'))
+                    written = True
+                elif seg_term == term:
+                    if not update:
+                        # Overwrite the line for the update.
+                        line = self.make_record(term, term_info)
+                    else:
+                        # Update the existing record.
+                        new_info = self.update_term_info(json.loads(seg_term_info), term_info)
+                        line = self.make_record(term, new_info)
+
+                    written = True
+
+                # Either we haven't reached it alphabetically or we're well-past.
+                # Write the line.
+                new_seg_file.write(line.encode('utf-8'))
+
+            if not written:
+                line = self.make_record(term, term_info)
+                new_seg_file.write(line.encode('utf-8'))
+
+        # Atomically move it into place.
+        new_seg_file.close()
+        try:
+            os.rename(new_seg_file.name, seg_name)
+        except OSError:
+            os.remove(seg_name)
+            os.rename(new_seg_file.name, seg_name)
+
+        # Inserting into an ordered segment keeps it in order.
+        if in_order:
+            self.sorted_segments[seg_name] = self.file_version(os.stat(seg_name))
+        else:
+            self.sorted_segments.pop(seg_name, None)
+
+        return True
+
+    def load_segment(self, term):
+        """
+        Given a ``term``, this will return the ``term_info`` associated with
+        the ``term``.
+
+        Warmed up terms (see ``warmup``) come from memory, everything else
+        via ``read_segment``.
+
+        If no index file exists or the term is not found, this returns an
+        empty dict.
+        """
+        if term in self.postings_cache:
+            self.profiler.incr('postings_cache_hits')
+            return self.postings_cache[term]
+
+        return self.read_segment(term)
+
+    def read_segment(self, term):
+        """
+        Given a ``term``, reads the ``term_info`` associated with it from its
+        segment file (see ``read_segment_terms``).
+
+        If no index file exists or the term is not found, this returns an
+        empty dict.
+        """
+        return self.read_segment_terms(self.make_segment_name(term), [term]).get(term, {})
+
+    def read_segment_terms(self, seg_name, terms):
+        """
+        Given a ``seg_name`` & a list of ``terms`` routed to it, reads all of
+        their ``term_info`` in a single pass over the segment.
+
+        Segments are written in order, so once this instance has seen that a
+        segment is (see ``sorted_segments``), the pass stops as soon as it's
+        past the last of the ``terms``. Otherwise, it reads to the end.
+
+        Readers (see ``refresh``) go through ``load_segment_records`` instead,
+        so the whole segment stays in memory.
+
+        Returns a dict of the terms that were found to their ``term_info``.
+        """
+        profiler = self.profiler
+        wanted = set(terms)
+        last_term = max(wanted)
+        found = {}
+
+        if self.refresh_interval is not None:
+            records = self.load_segment_records(seg_name)
+            raw_infos = [(term, records[term]) for term in wanted if term in records]
+        else:
+            raw_infos = []
+
+            with profiler.phase('segment_io'):
+                if not os.path.exists(seg_name):
+                    return found
+
+                profiler.incr('segments_opened')
+                bytes_read = 0
+                previous = None
+                in_order = True
+                finished = True
+
+                with open(seg_name, 'rb') as seg_file:
+                    version = self.file_version(os.fstat(seg_file.fileno()))
+                    known_sorted = self.sorted_segments.get(seg_name) == version
+
+                    for line in seg_file:
+                        bytes_read += len(line)
+                        seg_term, term_info = self.parse_record(line.decode('utf-8'))
+
+                        if previous is not None and seg_term <= previous:
+                            in_order = False
+
+                        previous = seg_term
+
+                        if seg_term in wanted:
+                            raw_infos.append((seg_term, term_info))
+
+                            if len(raw_infos) == len(wanted):
+                                finished = False
+                                break
+                        elif known_sorted and seg_term > last_term:
+                            finished = False
+                            break
+
+                if finished and in_order:
+                    self.sorted_segments[seg_name] = version
+
+                profiler.incr('bytes_read', bytes_read)
+
+        for term, term_info in raw_infos:
+            with profiler.phase('json_decode'):
+                found[term] = json.loads(term_info)
+
+            profiler.incr('postings_decoded', len(found[term]))
+
+        return found
+
+    def load_segments(self, terms, term_timings=None):
+        """
+        Given a list of ``terms``, returns a dict of each of them to its
+        ``term_info`` (like ``load_segment``, with an empty dict for missing
+        terms).
+
+        Warmed up terms come from memory. The rest are grouped by segment, so
+        each segment gets read just once (see ``read_segment_terms``), however
+        many of the terms it holds.
+
+        Optionally accepts a ``term_timings`` parameter, which is a dict. If
+        provided, the time spent reading each segment gets recorded in it,
+        split evenly between its terms.
+        """
+        term_infos = {}
+        by_segment = collections.OrderedDict()
+
+        for term in terms:
+            if term in term_infos:
+                continue
+
+            if term in self.postings_cache:
+                self.profiler.incr('postings_cache_hits')
+                term_infos[term] = self.postings_cache[term]
+                continue
+
+            term_infos[term] = {}
+            by_segment.setdefault(self.make_segment_name(term), []).append(term)
+
+        for seg_name, seg_terms in by_segment.items():
+            start_time = time.time()
+            term_infos.update(self.read_segment_terms(seg_name, seg_terms))
+
+            if term_timings is not None:
+                elapsed = (time.time() - start_time) / len(seg_terms)
+
+                for term in seg_terms:
+                    term_timings[term] = term_timings.get(term, 0.0) + elapsed
+
+        return term_infos
+
+
+    # =================
+    # Document Handling
+    # =================
 
     def make_document_name(self, doc_id):
         """
-        Given a ``doc_id``, this constructs a path where the document should
-        be stored.
+        Given a ``doc_id``, this constructs a path where the document should
+        be stored.
+
+        It uses a similar hashing mechanism as ``make_segment_name``, using
+        the hash fragment to control the directory structure instead of the
+        filename.
+
+        Returns the full filepath to the document.
+        """
+        # Builds a path like ``BASE_DIR/documents/5d4140/hello.json``.
+        return os.path.join(self.docs_path, self.hash_name(doc_id), "{0}.json".format(doc_id))
+
+    def save_document(self, doc_id, document):
+        """
+        Given a ``doc_id`` string & a ``document`` dict, writes the document to
+        disk.
+
+        Uses JSON as the serialization format.
+        """
+        doc_path = self.make_document_name(doc_id)
+        base_path = os.path.dirname(doc_path)
+
+        if not os.path.exists(base_path):
+            os.makedirs(base_path)
+
+        with open(doc_path, 'w') as doc_file:
+            doc_file.write(json.dumps(document, ensure_ascii=False))
+
+        if self.document_cache is not None:
+            self.document_cache.discard(doc_id)
+
+        return True
+
+    def document_exists(self, doc_id):
+        """
+        Returns ``True`` if the document with the given ``doc_id`` is stored.
+        """
+        return os.path.exists(self.make_document_name(doc_id))
+
+    def count_documents(self):
+        """
+        Returns how many documents are actually stored, by counting them.
+        """
+        count = 0
+
+        for directory, dirnames, filenames in os.walk(self.docs_path):
+            count += len([filename for filename in filenames if filename.endswith('.json')])
+
+        return count
+
+    def load_document(self, doc_id):
+        """
+        Given a ``doc_id`` string, loads a given document, from the document
+        cache if possible (see the ``document_cache_size`` option) &
+        otherwise via ``read_document``.
+
+        Raises an exception if the document no longer exists.
+
+        Returns the document data as a dict.
+        """
+        cache = self.document_cache
+
+        with self.profiler.phase('hydration'):
+            if cache is not None:
+                data = cache.get(doc_id)
+
+                if data is not None:
+                    self.profiler.incr('document_cache_hits')
+                    self.profiler.incr('docs_hydrated')
+                    return data
+
+            raw = self.read_document(doc_id)
+            data = json.loads(raw)
+
+            if cache is not None:
+                cache.put(doc_id, data, len(raw))
+
+        self.profiler.incr('docs_hydrated')
+        return data
+
+    def read_document(self, doc_id):
+        """
+        Given a ``doc_id`` string, reads the raw JSON of a document from disk.
+        """
+        with open(self.make_document_name(doc_id), 'r') as doc_file:
+            return doc_file.read()
+
+
+    # ======
+    # Warmup
+    # ======
+
+    def log_query(self, terms):
+        """
+        Appends the ``terms`` of a search to the query log.
+
+        Once the log grows past ``QUERY_LOG_SIZE`` bytes, it's rotated to
+        ``queries.log.1`` (replacing the previous one), so at most two logs'
+        worth of searches are kept.
+        """
+        with open(self.query_log_path, 'a') as log_file:
+            log_file.write("{0}\n".format(json.dumps(sorted(terms), ensure_ascii=False)))
+            rotate = log_file.tell() > self.QUERY_LOG_SIZE
+
+        if rotate:
+            os.replace(self.query_log_path, "{0}.1".format(self.query_log_path))
+
+    def get_hot_terms(self, top_n=1000):
+        """
+        Returns the ``top_n`` most searched-for terms in the query log, most
+        popular first.
+        """
+        counts = collections.Counter()
+
+        for log_path in ["{0}.1".format(self.query_log_path), self.query_log_path]:
+            if os.path.exists(log_path):
+                with open(log_path, 'r') as log_file:
+                    for line in log_file:
+                        counts.update(json.loads(line))
+
+        return [term for term, count in counts.most_common(top_n)]
+
+    def write_warmup_snapshot(self, top_n=1000):
+        """
+        Writes out everything a fresh process needs to be fast from its first
+        query: the stats, the term dictionary & the postings of the ``top_n``
+        hottest terms from the query log.
+
+        It's all one file, so ``warmup`` can load it in a single sequential
+        read rather than opening lots of segments.
+
+        Returns the number of terms whose postings were included.
+        """
+        dictionary = self.load_term_dictionary()
+        hot_terms = self.get_hot_terms(top_n)
+        header = {
+            'generation': self.read_generation(),
+            'stats': self.read_stats(),
+            'term_dictionary_size': self.term_dictionary_size,
+            'terms': len(dictionary),
+            'postings': len(hot_terms),
+        }
+        new_snapshot_file = tempfile.NamedTemporaryFile(delete=False, dir=self.base_directory, prefix=self.TEMP_PREFIX)
+
+        with new_snapshot_file:
+            new_snapshot_file.write("{0}\n".format(json.dumps(header)).encode('utf-8'))
+
+            for token in dictionary:
+                new_snapshot_file.write("{0}\n".format(token).encode('utf-8'))
+
+            for term in hot_terms:
+                new_snapshot_file.write(self.make_record(term, self.read_segment(term)).encode('utf-8'))
+
+        os.rename(new_snapshot_file.name, self.warmup_path)
+        return len(hot_terms)
+
+    def warmup(self):
+        """
+        Loads the warmup snapshot (see ``write_warmup_snapshot``) into memory.
+
+        Afterward, the stats, term dictionary & hot postings get served from
+        memory. Writes made through this instance keep them up to date &
+        commits by others get picked up before the next search (see
+        ``maybe_refresh``). If there have been commits since the snapshot was
+        written, only the term dictionary gets used.
+
+        Returns the number of postings loaded.
+        """
+        with open(self.warmup_path, 'rb') as snapshot_file:
+            header = json.loads(snapshot_file.readline().decode('utf-8'))
+            dictionary = []
+            postings = {}
+
+            for i in range(header['terms']):
+                dictionary.append(snapshot_file.readline().decode('utf-8').rstrip('\n'))
+
+            for i in range(header['postings']):
+                term, term_info = self.parse_record(snapshot_file.readline().decode('utf-8'))
+                postings[term] = json.loads(term_info)
+
+        self.term_dictionary = dictionary
+        self.term_dictionary_set = set(dictionary)
+        self.term_dictionary_size = header['term_dictionary_size']
+        self.term_dictionary_stale = False
+
+        if header.get('generation') != self.read_generation():
+            return 0
+
+        self.generation = header['generation']
+        self.stats_cache = header['stats']
+        self.postings_cache = postings
+        return len(postings)
+
+
+    # =======
+    # Refresh
+    # =======
+
+    def read_generation(self):
+        """
+        Returns the generation of the index, which goes up by one with every
+        commit (see ``commit``). A new index is at generation ``0``.
+        """
+        if not os.path.exists(self.generation_path):
+            return 0
+
+        with open(self.generation_path, 'r') as generation_file:
+            return int(generation_file.read().strip() or 0)
+
+    def commit(self, segments=None, doc_ids=None, reset=False):
+        """
+        Records that the index has changed, so readers know what to reload
+        (see ``refresh``).
+
+        Optionally accepts a ``segments`` parameter, which is a list of the
+        segment paths that were written to. Default is ``None`` (any of them
+        may have changed).
+
+        Optionally accepts a ``doc_ids`` parameter, which is a list of the
+        documents that were saved. Default is ``None``.
+
+        Optionally accepts a ``reset`` parameter, which is a boolean. If
+        ``True``, the commit log is started over, rather than appended to.
+        Default is ``False``.
+
+        Inside a ``batch``, the commit is held back & merged with the rest of
+        the batch's, so it returns ``None``.
+
+        Returns the new generation.
+        """
+        with self.write_lock:
+            if self.commits_deferred():
+                self.pending_commits.append((segments, doc_ids, reset))
+                return None
+
+            return self.write_commit(segments, doc_ids, reset)
+
+    def write_commit(self, segments=None, doc_ids=None, reset=False):
+        """
+        Writes a commit (see ``commit``) out.
+
+        The commit gets appended to ``commits.log`` before the new
+        ``generation`` is (atomically) written, so a reader that sees the new
+        generation can always find out what it covers.
+
+        Once the log would grow past ``COMMITS_LOG_SIZE`` bytes, it's started
+        over with a new file instead, which readers that are behind notice
+        (see ``read_commits``) & reload everything for.
+
+        Returns the new generation.
+        """
+        generation = self.read_generation() + 1
+
+        if segments is not None:
+            segments = sorted(set([os.path.basename(seg_name) for seg_name in segments]))
+
+        entry = {
+            'generation': generation,
+            'segments': segments,
+            'docs': list(doc_ids or []),
+        }
+        line = json.dumps(entry) + '\n'
+
+        if os.path.exists(self.commits_path) and os.path.getsize(self.commits_path) + len(line) > self.COMMITS_LOG_SIZE:
+            reset = True
+
+        if reset:
+            new_commits_file = tempfile.NamedTemporaryFile(mode='w', delete=False, dir=self.base_directory, prefix=self.TEMP_PREFIX)
+
+            with new_commits_file:
+                new_commits_file.write(line)
+
+            os.rename(new_commits_file.name, self.commits_path)
+        else:
+            with open(self.commits_path, 'a') as commits_file:
+                commits_file.write(line)
+
+        new_generation_file = tempfile.NamedTemporaryFile(mode='w', delete=False, dir=self.base_directory, prefix=self.TEMP_PREFIX)
+
+        with new_generation_file:
+            new_generation_file.write(str(generation))
+
+        os.rename(new_generation_file.name, self.generation_path)
+        self.generation = generation
+        return generation
+
+    def commits_deferred(self):
+        """
+        Returns ``True`` if commits are being held back (see ``batch``).
+        """
+        return self.batch_depth > 0
+
+    def flush_commits(self):
+        """
+        Writes out the commits held back by a ``batch``, merged into one.
+
+        Returns the new generation (or ``None`` if there weren't any).
+        """
+        pending_commits, self.pending_commits = self.pending_commits, []
+
+        if not pending_commits:
+            return None
+
+        segments = set()
+        doc_ids = []
+        reset = False
+
+        for commit_segments, commit_doc_ids, commit_reset in pending_commits:
+            if segments is not None:
+                segments = None if commit_segments is None else segments | set(commit_segments)
+
+            doc_ids.extend(commit_doc_ids or [])
+            reset = reset or commit_reset
+
+        return self.write_commit(segments, doc_ids, reset)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        A context manager that groups all the writes inside it into a single
+        commit (see ``commit``), rather than one per ``index`` call. Readers
+        see the whole batch at once & the commit log grows by one entry.
+
+        Holds the write lock throughout. These nest, with only the outermost
+        one committing.
+        """
+        with self.write_lock:
+            self.batch_depth += 1
+
+            try:
+                yield
+            finally:
+                self.batch_depth -= 1
+
+                if not self.commits_deferred():
+                    self.flush_commits()
+
+    def read_commits(self):
+        """
+        Reads any commits appended to ``commits.log`` since last time.
+
+        Returns a list of the commit entries (see ``commit``), newest last. If
+        the log has been started over, an entry with no ``segments`` comes
+        first, as there's no telling what changed in between.
+        """
+        if not os.path.exists(self.commits_path):
+            return []
+
+        entries = []
+
+        with open(self.commits_path, 'rb') as commits_file:
+            commits_stat = os.fstat(commits_file.fileno())
+
+            if self.commits_inode is None:
+                # There wasn't a log before, so this is its beginning.
+                self.commits_inode = commits_stat.st_ino
+            elif commits_stat.st_ino != self.commits_inode or commits_stat.st_size < self.commits_size:
+                entries.append({'generation': None, 'segments': None, 'docs': []})
+                self.commits_size = 0
+                self.commits_inode = commits_stat.st_ino
+
+            commits_file.seek(self.commits_size)
+
+            for line in commits_file:
+                # Don't go past a commit that's still being written.
+                if not line.endswith(b'\n'):
+                    break
+
+                self.commits_size += len(line)
+                entries.append(json.loads(line.decode('utf-8')))
+
+        return entries
+
+    def refresh(self):
+        """
+        Brings a reader (see the ``refresh_interval`` option) up to date with
+        the latest commit.
+
+        Only the cached segments (& warmed up postings) that were written to
+        since the last refresh get thrown away. Everything else stays cached,
+        so refreshing after a small commit is cheap. If it's unclear what
+        changed (after a ``compact``, say), everything gets reloaded.
+
+        Segments that aren't cached yet are read as they are on disk, so a
+        search may see some of a commit that's in progress.
+
+        Returns ``True`` if there was anything new, ``False`` otherwise.
+        """
+        self.refreshed_at = time.time()
+        generation = self.read_generation()
+
+        if generation == self.generation:
+            return False
+
+        entries = self.read_commits()
+        changed = set()
+        everything = False
+
+        for entry in entries:
+            if entry['segments'] is None:
+                everything = True
+            else:
+                changed.update(entry['segments'])
+
+        if self.stats_cache is not None:
+            self.stats_cache = None
+            self.stats_cache = self.read_stats()
+
+        if self.document_cache is not None:
+            if everything:
+                self.document_cache.clear()
+            else:
+                for entry in entries:
+                    for doc_id in entry['docs']:
+                        self.document_cache.discard(doc_id)
+
+        if everything:
+            self.segment_cache.clear()
+            self.postings_cache = {}
+            self.load_routing()
+        else:
+            for seg_name in list(self.segment_cache):
+                if os.path.basename(seg_name) in changed:
+                    del self.segment_cache[seg_name]
+
+            for term in list(self.postings_cache):
+                if os.path.basename(self.make_segment_name(term)) in changed:
+                    del self.postings_cache[term]
+
+        self.generation = generation
+        self.profiler.incr('refreshes')
+        return True
+
+    def maybe_refresh(self):
+        """
+        Calls ``refresh`` if this is a reader & it's been at least
+        ``refresh_interval`` seconds since the last one.
+
+        Warmed up instances (see ``warmup``) & ones with a document cache
+        that aren't readers check for new commits every time, so they never
+        serve stale stats, postings or documents written by other processes.
+        """
+        if self.refresh_interval is None:
+            if (self.stats_cache is not None or self.document_cache is not None) and self.read_generation() != self.generation:
+                return self.refresh()
+
+            return False
+
+        if time.time() - self.refreshed_at < self.refresh_interval:
+            return False
+
+        return self.refresh()
+
+    def load_segment_records(self, seg_name):
+        """
+        Given a ``seg_name``, returns a dict of every term in the segment to
+        its raw (still JSON-encoded) ``term_info``.
+
+        The most recently used ``SEGMENT_CACHE_SIZE`` segments are kept in
+        memory, until a commit touches them (see ``refresh``).
+        """
+        profiler = self.profiler
+
+        if seg_name in self.segment_cache:
+            self.segment_cache.move_to_end(seg_name)
+            profiler.incr('segment_cache_hits')
+            return self.segment_cache[seg_name]
+
+        records = {}
+
+        with profiler.phase('segment_io'):
+            if os.path.exists(seg_name):
+                profiler.incr('segments_opened')
+                bytes_read = 0
+
+                with open(seg_name, 'rb') as seg_file:
+                    for line in seg_file:
+                        bytes_read += len(line)
+                        seg_term, term_info = self.parse_record(line.decode('utf-8'))
+                        records[seg_term] = term_info
+
+                profiler.incr('bytes_read', bytes_read)
+
+        self.segment_cache[seg_name] = records
+
+        while len(self.segment_cache) > self.SEGMENT_CACHE_SIZE:
+            self.segment_cache.popitem(last=False)
+
+        return records
+
+
+    # =========
+    # Snapshots
+    # =========
+
+    def snapshot_files(self):
+        """
+        Returns a sorted list of the paths (relative to the
+        ``base_directory``) of every file that makes up the index.
+        """
+        paths = []
+
+        for directory, dirnames, filenames in os.walk(self.base_directory):
+            dirnames[:] = [dirname for dirname in dirnames if not dirname.startswith(self.TEMP_PREFIX)]
+
+            for filename in filenames:
+                if filename.startswith(self.TEMP_PREFIX):
+                    continue
+
+                path = os.path.join(directory, filename)
+                paths.append(os.path.relpath(path, self.base_directory).replace(os.sep, '/'))
+
+        return sorted(paths)
+
+    def snapshot(self, target, chunk_size=1024 * 1024):
+        """
+        Writes a point-in-time copy of the whole index to ``target``, as one
+        sequential archive.
+
+        ``target`` can be either a path or a binary file-like object (like a
+        pipe or socket), since the archive is only ever written front to back.
+        Writes through this instance are held off until it's done, so the
+        archive is consistent. The lock is per instance though, so writers in
+        other processes (or other instances) aren't held off.
+
+        The archive is a header line, then for each file a JSON line (with
+        the ``path`` & ``size``), the raw contents & a JSON line with the
+        ``crc32`` of the contents. A final line marks the end.
+
+        Optionally accepts a ``chunk_size`` parameter, which is how many bytes
+        to copy at a time. Default is ``1048576`` (1Mb).
+
+        Returns the number of files in the snapshot.
+        """
+        if not hasattr(target, 'write'):
+            with open(target, 'wb') as target_file:
+                return self.snapshot(target_file, chunk_size=chunk_size)
+
+        def write_line(data):
+            target.write("{0}\n".format(json.dumps(data, ensure_ascii=False)).encode('utf-8'))
+
+        with self.write_lock:
+            paths = self.snapshot_files()
+            write_line({
+                'format': self.SNAPSHOT_FORMAT,
+                'version': '.'.join([str(bit) for bit in __version__]),
+            })
+
+            for path in paths:
+                full_path = os.path.join(self.base_directory, *path.split('/'))
+                checksum = 0
+                write_line({'path': path, 'size': os.path.getsize(full_path)})
+
+                with open(full_path, 'rb') as source_file:
+                    while True:
+                        chunk = source_file.read(chunk_size)
+
+                        if not chunk:
+                            break
+
+                        checksum = zlib.crc32(chunk, checksum)
+                        target.write(chunk)
+
+                write_line({'crc32': checksum})
+
+            write_line({'end': True, 'files': len(paths)})
+
+        target.flush()
+        return len(paths)
+
+    def restore(self, source, chunk_size=1024 * 1024):
+        """
+        Loads a snapshot (see ``snapshot``) into the ``base_directory``.
+
+        ``source`` can be either a path or a binary file-like object (like a
+        pipe), since the archive is only ever read front to back. The index
+        being restored into must be empty.
+
+        Everything gets unpacked & checked in a temporary directory next to
+        the ``base_directory`` first, then renamed into place, so a damaged
+        archive leaves the index as it was.
+
+        Raises a ``ValueError`` if the archive is damaged.
+
+        Returns the number of files restored.
+        """
+        if not hasattr(source, 'read'):
+            with open(source, 'rb') as source_file:
+                return self.restore(source_file, chunk_size=chunk_size)
+
+        with self.write_lock:
+            if self.get_total_docs():
+                raise ValueError("Can not restore into '{0}', as it already has documents in it.".format(self.base_directory))
+
+            base_directory = os.path.abspath(self.base_directory)
+            restore_directory = tempfile.mkdtemp(dir=os.path.dirname(base_directory), prefix=self.TEMP_PREFIX)
+
+            try:
+                count = self.unpack_snapshot(source, restore_directory, chunk_size)
+            except:
+                shutil.rmtree(restore_directory, ignore_errors=True)
+                raise
+
+            self.close()
+            old_directory = "{0}-old".format(restore_directory)
+
+            try:
+                os.rename(base_directory, old_directory)
+                os.rename(restore_directory, base_directory)
+                shutil.rmtree(old_directory, ignore_errors=True)
+            finally:
+                self.setup()
+                self.clear_caches()
+                self.load_routing()
+                self.commit(reset=True)
+
+        return count
+
+    def unpack_snapshot(self, source, directory, chunk_size=1024 * 1024):
+        """
+        Given a ``source`` (a binary file-like object) holding a snapshot,
+        writes its files out under ``directory``, checking each as it goes.
+
+        Raises a ``ValueError`` if the archive is damaged.
+
+        Returns the number of files unpacked.
+        """
+        def read_line():
+            line = source.readline()
+
+            if not line.endswith(b'\n'):
+                raise ValueError('The snapshot is truncated.')
+
+            try:
+                data = json.loads(line.decode('utf-8'))
+            except ValueError:
+                data = None
+
+            if not isinstance(data, dict):
+                raise ValueError('The snapshot is damaged.')
+
+            return data
+
+        header = read_line()
+
+        if header.get('format') != self.SNAPSHOT_FORMAT:
+            raise ValueError('This is not a microsearch snapshot.')
+
+        count = 0
+
+        while True:
+            section = read_line()
+
+            if section.get('end'):
+                break
+
+            if not isinstance(section.get('path'), str) or not isinstance(section.get('size'), int):
+                raise ValueError('The snapshot is damaged.')
+
+            bits = section['path'].split('/')
+
+            if section['path'].startswith('/') or '..' in bits:
+                raise ValueError("Refusing to restore '{0}' outside of the index.".format(section['path']))
+
+            full_path = os.path.join(directory, *bits)
+            remaining = section['size']
+            checksum = 0
+
+            if not os.path.exists(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
+
+            with open(full_path, 'wb') as restored_file:
+                while remaining > 0:
+                    chunk = source.read(min(chunk_size, remaining))
+
+                    if not chunk:
+                        raise ValueError('The snapshot is truncated.')
+
+                    checksum = zlib.crc32(chunk, checksum)
+                    restored_file.write(chunk)
+                    remaining -= len(chunk)
+
+            if read_line().get('crc32') != checksum:
+                raise ValueError("The checksum for '{0}' doesn't match.".format(section['path']))
+
+            count += 1
+
+        if section.get('files') != count:
+            raise ValueError('Expected {0} files in the snapshot, found {1}.'.format(section.get('files'), count))
+
+        return count
+
+
+    # =========
+    # Integrity
+    # =========
+
+    def segment_names(self):
+        """
+        Returns a sorted list of the full paths to every segment.
+        """
+        if not os.path.exists(self.index_path):
+            return []
+
+        return sorted([
+            os.path.join(self.index_path, filename)
+            for filename in os.listdir(self.index_path)
+            if filename.endswith('.index')
+        ])
+
+    def temp_file_names(self):
+        """
+        Returns a sorted list of the full paths to any temporary files left
+        behind (by a crash in the middle of a write, for instance).
+        """
+        temp_files = []
+
+        for directory in (self.base_directory, self.index_path):
+            if not os.path.exists(directory):
+                continue
+
+            for filename in os.listdir(directory):
+                if filename.startswith(self.TEMP_PREFIX):
+                    temp_files.append(os.path.join(directory, filename))
+
+        return sorted(temp_files)
+
+    def remove_temp_files(self):
+        """
+        Removes any leftover temporary files (see ``temp_file_names``).
+
+        Returns a list of what was removed.
+        """
+        temp_files = self.temp_file_names()
+
+        for temp_name in temp_files:
+            if os.path.isdir(temp_name):
+                shutil.rmtree(temp_name)
+            else:
+                os.remove(temp_name)
+
+        return temp_files
+
+    def iter_segment_records(self, seg_name):
+        """
+        Given a ``seg_name``, yields the raw ``(term, term_info)`` records in
+        it, in the order they're stored.
+        """
+        with open(seg_name, 'r') as seg_file:
+            for line in seg_file:
+                yield tuple(self.parse_record(line))
+
+    def check_segment(self, seg_name, known_docs=None):
+        """
+        Given a ``seg_name``, reads through the whole segment & returns a list
+        of any problems with it.
+
+        Checks that every record parses, that the terms are in order with no
+        duplicates, that every term is in the segment it hashes to & that
+        every posting references a stored document.
+
+        Optionally accepts a ``known_docs`` parameter, which is a dict used
+        to remember which documents exist between calls.
+        """
+        if known_docs is None:
+            known_docs = {}
+
+        problems = []
+        last_term = None
+
+        def problem(message, *args):
+            problems.append({'segment': seg_name, 'problem': message.format(*args)})
+
+        for line_number, record in enumerate(self.iter_segment_records(seg_name), 1):
+            if len(record) != 2:
+                problem('Line {0} is not a valid record.', line_number)
+                continue
+
+            term, term_info = record
+
+            try:
+                term_info = json.loads(term_info)
+            except ValueError:
+                term_info = None
+
+            if not hasattr(term_info, 'items'):
+                problem("The postings for '{0}' can not be parsed.", term)
+                continue
+
+            if term == last_term:
+                problem("'{0}' appears more than once.", term)
+            elif last_term is not None and term < last_term:
+                problem("'{0}' is out of order.", term)
+            else:
+                last_term = term
+
+            if self.make_segment_name(term) != seg_name:
+                problem("'{0}' belongs in a different segment.", term)
+
+            for doc_id in term_info:
+                if not doc_id in known_docs:
+                    known_docs[doc_id] = self.document_exists(doc_id)
+
+                if not known_docs[doc_id]:
+                    problem("'{0}' references the missing document '{1}'.", term, doc_id)
+
+        return problems
+
+    def write_segment(self, seg_name, term_infos):
+        """
+        Given a ``seg_name`` & a dict of ``term_infos``, replaces the entire
+        contents of the segment with them (in order).
+        """
+        new_seg_file = tempfile.NamedTemporaryFile(delete=False, dir=self.index_path, prefix=self.TEMP_PREFIX)
+        self.segment_cache.pop(seg_name, None)
+
+        with new_seg_file:
+            for term in sorted(term_infos):
+                new_seg_file.write(self.make_record(term, term_infos[term]).encode('utf-8'))
+
+        os.rename(new_seg_file.name, seg_name)
+        self.sorted_segments[seg_name] = self.file_version(os.stat(seg_name))
+        return True
+
+    def rebuild_segment(self, seg_name, known_docs=None):
+        """
+        Given a ``seg_name``, rewrites the segment with all the problems
+        ``check_segment`` looks for fixed (see ``tidy_segment``).
+
+        Optionally accepts a ``known_docs`` parameter, which is a dict used
+        to remember which documents exist between calls.
+
+        Returns ``True`` on success.
+        """
+        term_infos, misplaced = self.tidy_segment(seg_name, known_docs)
+        self.write_segment(seg_name, term_infos)
+
+        for term, term_info in misplaced.items():
+            self.save_segment(term, term_info, update=True)
+
+        return True
+
+    def tidy_segment(self, seg_name, known_docs=None):
+        """
+        Given a ``seg_name``, reads the segment & works out its tidied
+        contents, without writing anything.
+
+        Unparseable records & postings for missing documents get dropped,
+        duplicates get merged & terms in the wrong segment get set aside.
+
+        Optionally accepts a ``known_docs`` parameter, which is a dict used
+        to remember which documents exist between calls.
+
+        Returns a tuple of a dict of the ``term_infos`` that belong in the
+        segment & a dict of the misplaced ones.
+        """
+        if known_docs is None:
+            known_docs = {}
+
+        term_infos = {}
+        misplaced = {}
+
+        for record in self.iter_segment_records(seg_name):
+            if len(record) != 2:
+                continue
+
+            try:
+                term_info = json.loads(record[1])
+            except ValueError:
+                continue
+
+            if not hasattr(term_info, 'items'):
+                continue
+
+            term = record[0]
+
+            for doc_id in term_info:
+                if not doc_id in known_docs:
+                    known_docs[doc_id] = self.document_exists(doc_id)
+
+            term_info = dict([(doc_id, positions) for doc_id, positions in term_info.items() if known_docs[doc_id]])
+
+            if not term_info:
+                continue
+
+            if self.make_segment_name(term) != seg_name:
+                target = misplaced
+            else:
+                target = term_infos
+
+            target[term] = self.update_term_info(target.get(term, {}), term_info)
+
+        return term_infos, misplaced
+
+    def check_index(self, repair=False, workers=None):
+        """
+        Checks the whole index for damage, like the kind a crash or a bug can
+        leave behind.
+
+        The segments get read in parallel (see ``check_segment``). Also
+        checks for leftover temporary files & that the ``total_docs`` in the
+        stats matches the number of documents actually stored.
+
+        Optionally accepts a ``repair`` parameter, which is a boolean. If
+        ``True``, the temporary files get removed, the damaged segments get
+        rebuilt (see ``rebuild_segment``) & the stats get corrected. Default
+        is ``False``.
+
+        Optionally accepts a ``workers`` parameter, which is how many
+        segments to check at once. Default is ``None`` (let
+        ``concurrent.futures`` decide).
+
+        Returns a dict with ``segments`` (the number checked), ``problems`` (a
+        list of dicts, each with the ``segment`` & ``problem``) & ``repaired``
+        (a list of what got fixed).
+        """
+        with self.write_lock:
+            seg_names = self.segment_names()
+            known_docs = {}
+            report = {
+                'segments': len(seg_names),
+                'problems': [],
+                'repaired': [],
+            }
+
+            for temp_name in self.temp_file_names():
+                report['problems'].append({'segment': temp_name, 'problem': 'Leftover temporary file.'})
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                for problems in executor.map(lambda seg_name: self.check_segment(seg_name, known_docs), seg_names):
+                    report['problems'].extend(problems)
+
+            total_docs = self.get_total_docs()
+            stored_docs = self.count_documents()
+
+            if total_docs != stored_docs:
+                report['problems'].append({
+                    'segment': None,
+                    'problem': 'The stats say there are {0} documents, but {1} are stored.'.format(total_docs, stored_docs),
+                })
+
+            if not repair:
+                return report
+
+            report['repaired'].extend(self.remove_temp_files())
+
+            damaged = sorted(set([problem['segment'] for problem in report['problems'] if problem['segment'] in seg_names]))
+
+            for seg_name in damaged:
+                self.rebuild_segment(seg_name)
+                report['repaired'].append(seg_name)
+
+            if total_docs != stored_docs:
+                stats = self.read_stats()
+                stats['total_docs'] = stored_docs
+                self.write_stats(stats)
+                report['repaired'].append('stats')
+
+            self.clear_caches()
+
+            if report['repaired']:
+                self.commit()
+
+        return report
+
+    def compact(self):
+        """
+        Rewrites every segment in its tidiest form (see ``rebuild_segment``),
+        removing any that end up empty, along with leftover temporary files.
+
+        Returns the number of segments rewritten.
+        """
+        with self.write_lock:
+            self.remove_temp_files()
+            seg_names = self.segment_names()
+            # Nothing can be indexed meanwhile, so which documents exist can
+            # be remembered across every segment.
+            known_docs = {}
+
+            for seg_name in seg_names:
+                self.rebuild_segment(seg_name, known_docs)
+
+                if os.path.getsize(seg_name) == 0:
+                    os.remove(seg_name)
+
+            self.clear_caches()
+            # Everything's been rewritten, so the log can start over.
+            self.commit(reset=True)
+
+        return len(seg_names)
+
+    def rebalance_segments(self, factor=4.0):
+        """
+        Evens out the segment sizes by moving the biggest terms out of any
+        segment that's more than ``factor`` times the average size, each into
+        a segment of its own.
+
+        Common terms can make a handful of segments far bigger than the
+        rest, which makes every lookup that lands in them slow. The moves are
+        recorded in ``routing.json``, which other instances pick up before
+        their next search or write (see ``check_routing``).
+
+        Returns a sorted list of the terms that were moved.
+        """
+        moved = []
+
+        with self.write_lock:
+            self.check_routing()
+            seg_names = self.segment_names()
+
+            if not seg_names:
+                return moved
+
+            sizes = dict([(seg_name, os.path.getsize(seg_name)) for seg_name in seg_names])
+            limit = factor * sum(sizes.values()) / len(sizes)
+            new_routes = {}
+            moved_infos = {}
+            kept_infos = {}
+
+            for seg_name in seg_names:
+                if sizes[seg_name] <= limit:
+                    continue
+
+                term_infos = {}
+                record_sizes = []
+
+                for term, term_info in self.iter_segment_records(seg_name):
+                    term_infos[term] = json.loads(term_info)
+                    record_sizes.append((len(term_info), term))
+
+                size = sizes[seg_name]
+
+                for record_size, term in sorted(record_sizes, reverse=True):
+                    if size <= limit or len(term_infos) <= 1:
+                        break
+
+                    new_routes[term] = "t{0:08x}".format(zlib.crc32(term.encode('utf-8')))
+                    moved_infos[term] = term_infos.pop(term)
+                    size -= record_size + len(term) + 2
+                    moved.append(term)
+
+                kept_infos[seg_name] = term_infos
+
+            if not moved:
+                return moved
+
+            # In an order that's safe to stop at any point: until the routing
+            # is replaced, the terms are still read from where they were &
+            # afterward, any copies left behind are just misplaced (see
+            # ``check_segment``).
+            routes = dict(self.segment_routes)
+            routes.update(new_routes)
+            new_segments = {}
+
+            for term, name in new_routes.items():
+                new_segments.setdefault(os.path.join(self.index_path, "{0}.index".format(name)), {})[term] = moved_infos[term]
+
+            for seg_name, term_infos in new_segments.items():
+                if os.path.exists(seg_name):
+                    for term, term_info in self.iter_segment_records(seg_name):
+                        term_infos.setdefault(term, json.loads(term_info))
+
+                self.write_segment(seg_name, term_infos)
+
+            new_routing_file = tempfile.NamedTemporaryFile(mode='w', delete=False, dir=self.base_directory, prefix=self.TEMP_PREFIX)
+
+            with new_routing_file:
+                json.dump(routes, new_routing_file)
+
+            os.rename(new_routing_file.name, self.routing_path)
+            self.load_routing()
+
+            for seg_name, term_infos in kept_infos.items():
+                self.write_segment(seg_name, term_infos)
+
+            self.postings_cache = {}
+            self.commit()
+
+        return sorted(moved)
+
+
+    # ===============
+    # Term Dictionary
+    # ===============
+
+    def load_term_dictionary(self):
+        """
+        Returns a sorted list of every (whole, not n-grammed) token that's
+        been indexed, with field prefixes (see ``make_field_term``).
+
+        New tokens get appended to ``terms.txt`` as they're indexed, so only
+        new lines need reading. The list only gets re-sorted when it's asked
+        for after a change, not on every ``index``.
+        """
+        self.read_term_dictionary()
+
+        if self.term_dictionary_stale:
+            self.term_dictionary = sorted(self.term_dictionary_set)
+            self.term_dictionary_stale = False
+
+        return self.term_dictionary
+
+    def read_term_dictionary(self):
+        """
+        Reads any tokens appended to ``terms.txt`` (by this or another
+        process) into ``term_dictionary_set``.
+        """
+        if not os.path.exists(self.term_dictionary_path):
+            return
+
+        size = os.path.getsize(self.term_dictionary_path)
+
+        if size < self.term_dictionary_size:
+            self.term_dictionary = []
+            self.term_dictionary_set = set()
+            self.term_dictionary_size = 0
+            self.term_dictionary_stale = True
+
+        if size > self.term_dictionary_size:
+            with open(self.term_dictionary_path, 'rb') as terms_file:
+                terms_file.seek(self.term_dictionary_size)
+
+                for line in terms_file:
+                    self.term_dictionary_set.add(line.decode('utf-8').rstrip('\n'))
+
+            self.term_dictionary_size = size
+            self.term_dictionary_stale = True
+
+    def add_to_term_dictionary(self, tokens):
+        """
+        Given an iterable of (field-prefixed) ``tokens``, adds any new ones
+        to the term dictionary.
+        """
+        self.read_term_dictionary()
+        new_tokens = sorted(set([token for token in tokens if not token in self.term_dictionary_set]))
+
+        if not new_tokens:
+            return
+
+        if not os.path.exists(self.term_dictionary_path) and not self.get_total_docs():
+            # Started along with the index, so it has every token (see
+            # ``term_dictionary_complete``).
+            stats = self.read_stats()
+            stats['complete_term_dictionary'] = True
+            self.write_stats(stats)
+
+        raw = ''.join(["{0}\n".format(token) for token in new_tokens]).encode('utf-8')
+
+        with open(self.term_dictionary_path, 'ab') as terms_file:
+            terms_file.write(raw)
+
+        self.term_dictionary_set.update(new_tokens)
+        self.term_dictionary_size += len(raw)
+        self.term_dictionary_stale = True
+
+    def term_dictionary_complete(self):
+        """
+        Returns ``True`` if the term dictionary has every token in the index.
+
+        Indexes from before there was a term dictionary only have the tokens
+        indexed since, so nothing can be ruled out from what's missing.
+        """
+        return bool(self.read_stats().get('complete_term_dictionary'))
+
+    def estimate_term_docs(self, term, dictionary=None):
+        """
+        Given a (field-prefixed) n-gram ``term``, estimates how selective it
+        is from the number of tokens in the term dictionary that start with
+        it (with no segment reads at all).
+
+        If the term dictionary is complete (see ``term_dictionary_complete``)
+        & the estimate is ``0``, the term is definitely not in the index.
+
+        Optionally accepts a ``dictionary`` parameter, which is the already
+        loaded term dictionary. Default is ``None`` (load it).
+        """
+        if dictionary is None:
+            dictionary = self.load_term_dictionary()
+
+        start = bisect.bisect_left(dictionary, term)
+        return bisect.bisect_left(dictionary, term + u'\U0010ffff', start) - start
+
+    def fuzzy_expand(self, word, max_edits=1, max_expansions=50, field=None):
+        """
+        Given a ``word``, finds the tokens in the term dictionary within
+        ``max_edits`` edits of it.
+
+        Rather than checking every token, this walks the sorted dictionary
+        with a ``LevenshteinAutomaton``. Tokens sharing a prefix with the
+        previous one reuse its states & once a prefix can't possibly match,
+        every token starting with it gets skipped in one ``bisect``.
+
+        Optionally accepts a ``max_expansions`` parameter, which is an integer
+        capping how many tokens get returned. Default is ``50``.
+
+        Optionally accepts a ``field`` parameter, which limits the matches
+        (& so the ``max_expansions``) to the tokens from that field. Default
+        is ``None`` (any field).
+
+        Returns a list of the matching tokens, in sorted order.
+        """
+        dictionary = self.load_term_dictionary()
+        automaton = LevenshteinAutomaton(word, max_edits)
+        # ``states[i]`` is the state after the first ``i`` characters of
+        # ``previous``.
+        states = [automaton.start()]
+        previous = ''
+        matches = []
+        position = 0
+
+        while position < len(dictionary) and len(matches) < max_expansions:
+            token = dictionary[position]
+            common = 0
+
+            while common < min(len(previous), len(token), len(states) - 1) and previous[common] == token[common]:
+                common += 1
+
+            del states[common + 1:]
+            dead_at = None
+
+            for offset in range(common, len(token)):
+                state = automaton.step(states[-1], token[offset])
+
+                if not automaton.can_match(state):
+                    dead_at = offset
+                    break
+
+                states.append(state)
+
+            if dead_at is not None:
+                # Nothing starting with this prefix can match, so jump past
+                # all of it.
+                dead_prefix = token[:dead_at + 1]
+                position = bisect.bisect_left(dictionary, dead_prefix + u'\U0010ffff', position + 1)
+                previous = token[:dead_at]
+                continue
+
+            if automaton.is_match(states[-1]) and (field is None or self.split_field_term(token)[0] == field):
+                matches.append(token)
+
+            previous = token
+            position += 1
+
+        self.profiler.incr('fuzzy_expansions', len(matches))
+        return matches
+
+    def fuzzy_terms(self, field, word, max_edits=1):
+        """
+        Given a ``field`` & a ``word``, returns the index terms to search for
+        to find the tokens within ``max_edits`` of it.
+
+        Each matching token is searched for using its longest n-gram, rather
+        than all of them. So like a plain word, it matches on (up to) its
+        first 6 characters: ``lumbrgh~`` finds ``lumbergh``, but also
+        ``lumberjack``.
+        """
+        terms = []
+
+        for token in self.fuzzy_expand(self.make_field_term(field, word), max_edits, field=field):
+            grams = self.make_ngrams([self.split_field_term(token)[1]])
+
+            if not grams:
+                continue
+
+            term = self.make_field_term(field, max(grams, key=len))
+
+            if not term in terms:
+                terms.append(term)
+
+        return terms
+
+
+    # ========
+    # Indexing
+    # ========
+
+    def make_field_term(self, field, term):
+        """
+        Given a ``field`` name & a ``term``, returns the term as it's stored
+        in the index.
+
+        Terms from the ``text`` field are stored as-is. Terms from other
+        fields get the field name as a prefix (like ``subject:audit``). Since
+        tokenization strips colons, these can never collide.
+        """
+        if field == self.DEFAULT_FIELD:
+            return term
+
+        return "{0}:{1}".format(field, term)
+
+    def split_field_term(self, term):
+        """
+        The inverse of ``make_field_term``.
+
+        Returns a tuple of the field name & the bare term.
+        """
+        if ':' in term:
+            return tuple(term.split(':', 1))
+
+        return self.DEFAULT_FIELD, term
+
+    def make_field_terms(self, field_tokens):
+        """
+        Given a dict of ``field_tokens`` (field names as keys & lists of
+        tokens as values), generates the n-grams for each field.
+
+        Returns a dict of (prefixed) terms, with the positions as values.
+        """
+        terms = {}
+
+        for field, tokens in field_tokens.items():
+            for term, positions in self.make_ngrams(tokens).items():
+                terms[self.make_field_term(field, term)] = positions
+
+        return terms
+
+    # ==========
+    # Doc Values
+    # ==========
+
+    def load_ordinals(self):
+        """
+        Returns a dict of ``doc_id`` to ordinal mappings.
+
+        Every document gets a small integer (its ordinal) the first time it's
+        indexed, in the order they were indexed. These are kept one per line
+        in ``ordinals.txt`` (the line number being the ordinal). Since the
+        file is only ever appended to, only new lines need reading.
+        """
+        if not os.path.exists(self.ordinals_path):
+            return self.ordinals
+
+        size = os.path.getsize(self.ordinals_path)
+
+        if size < self.ordinals_size:
+            # Replaced out from under us. Start over.
+            self.ordinals = {}
+            self.ordinal_doc_ids = []
+            self.ordinals_size = 0
+
+        if size > self.ordinals_size:
+            with open(self.ordinals_path, 'rb') as ordinals_file:
+                ordinals_file.seek(self.ordinals_size)
+
+                for line in ordinals_file:
+                    doc_id = line.decode('utf-8').rstrip('\n')
+                    self.ordinals[doc_id] = len(self.ordinal_doc_ids)
+                    self.ordinal_doc_ids.append(doc_id)
+
+            self.ordinals_size = size
+
+        return self.ordinals
+
+    def assign_ordinals(self, doc_ids):
+        """
+        Given a list of ``doc_ids``, returns their ordinals, assigning new
+        ones to any documents that don't have one yet.
+        """
+        ordinals = self.load_ordinals()
+        new_lines = []
+        assigned = []
+
+        for doc_id in doc_ids:
+            if not doc_id in ordinals:
+                ordinals[doc_id] = len(self.ordinal_doc_ids)
+                self.ordinal_doc_ids.append(doc_id)
+                new_lines.append(doc_id)
+
+            assigned.append(ordinals[doc_id])
+
+        if new_lines:
+            raw = ''.join(["{0}\n".format(doc_id) for doc_id in new_lines]).encode('utf-8')
+
+            with open(self.ordinals_path, 'ab') as ordinals_file:
+                ordinals_file.write(raw)
+
+            self.ordinals_size += len(raw)
+
+        return assigned
+
+    def get_ordinal(self, doc_id):
+        """
+        Given a ``doc_id``, returns its ordinal (or ``None`` if it has never
+        been indexed).
+        """
+        return self.load_ordinals().get(doc_id)
+
+    def make_column_name(self, field):
+        """
+        Given a ``field``, returns the path to its doc values column.
+
+        A column is a flat array of fixed-size values (doubles for
+        ``numeric`` fields, integers for ``keyword`` fields), one per
+        document ordinal, so it can be read (or ``mmap``-ed) wholesale.
+        """
+        return os.path.join(self.values_path, "{0}.dv".format(field))
+
+    def make_column_keys_name(self, field):
+        """
+        Given a ``keyword`` ``field``, returns the path to the file of its
+        distinct values.
+
+        The column stores the line number of a document's value within this
+        file, rather than the value itself.
+        """
+        return os.path.join(self.values_path, "{0}.keys".format(field))
+
+    def get_column_type(self, field):
+        """
+        Given a ``field``, returns the ``(typecode, missing_value)`` of its
+        column.
+
+        Raises a ``KeyError`` if the field doesn't have doc values.
+        """
+        if not field in self.doc_values:
+            raise KeyError("The '{0}' field doesn't have doc values.".format(field))
+
+        return self.COLUMN_TYPES[self.doc_values[field]]
+
+    def load_column(self, field):
+        """
+        Given a ``field``, returns its column as an ``array``.
+
+        The column is cached until the file changes.
+        """
+        column_name = self.make_column_name(field)
+        typecode, missing = self.get_column_type(field)
+
+        if not os.path.exists(column_name):
+            return array.array(typecode)
+
+        column_stat = os.stat(column_name)
+        cache_key = (column_stat.st_size, column_stat.st_mtime)
+        cached = self.columns.get(field)
+
+        if cached is not None and cached[0] == cache_key:
+            return cached[1]
+
+        column = array.array(typecode)
+
+        with open(column_name, 'rb') as column_file:
+            column.frombytes(column_file.read())
+
+        self.columns[field] = (cache_key, column)
+        return column
+
+    def load_column_keys(self, field):
+        """
+        Given a ``keyword`` ``field``, returns a tuple of a list of its
+        distinct values & a dict of values to their position in that list.
+        """
+        keys_name = self.make_column_keys_name(field)
+        size = os.path.getsize(keys_name) if os.path.exists(keys_name) else 0
+        cached = self.column_keys.get(field)
+
+        if cached is not None and cached[0] == size:
+            return cached[1], cached[2]
+
+        keys = []
+
+        if size:
+            with open(keys_name, 'r') as keys_file:
+                keys = [json.loads(line) for line in keys_file]
+
+        lookup = dict([(key, position) for position, key in enumerate(keys)])
+        self.column_keys[field] = (size, keys, lookup)
+        return keys, lookup
+
+    def get_key_ordinal(self, field, value):
+        """
+        Given a ``keyword`` ``field`` & a ``value``, returns the position of
+        the value in the field's keys, adding it if it's new.
+        """
+        keys, lookup = self.load_column_keys(field)
+
+        if value in lookup:
+            return lookup[value]
+
+        if not os.path.exists(self.values_path):
+            os.makedirs(self.values_path)
+
+        with open(self.make_column_keys_name(field), 'a') as keys_file:
+            keys_file.write("{0}\n".format(json.dumps(value, ensure_ascii=False)))
+
+        # Let the next ``load_column_keys`` pick it up.
+        self.column_keys.pop(field, None)
+        return len(keys)
+
+    def write_column_value(self, field, ordinal, value):
+        """
+        Writes a single (already encoded) ``value`` into the ``field``'s
+        column at the given ``ordinal``.
+
+        If the column is too short, it gets padded with missing values.
+        """
+        column_name = self.make_column_name(field)
+        typecode, missing = self.get_column_type(field)
+        item_size = array.array(typecode).itemsize
+
+        if not os.path.exists(self.values_path):
+            os.makedirs(self.values_path)
+
+        mode = 'r+b' if os.path.exists(column_name) else 'w+b'
+
+        with open(column_name, mode) as column_file:
+            column_file.seek(0, os.SEEK_END)
+            length = column_file.tell() // item_size
+
+            if ordinal >= length:
+                column_file.write(array.array(typecode, [missing] * (ordinal - length)).tobytes())
+            else:
+                column_file.seek(ordinal * item_size)
+
+            column_file.write(array.array(typecode, [value]).tobytes())
+
+        self.columns.pop(field, None)
+
+        # Any cached filters on the field are now out of date.
+        for cache_key in list(self.filter_cache.keys()):
+            if cache_key[0] == field:
+                del self.filter_cache[cache_key]
+
+    def save_doc_values(self, ordinal, document):
+        """
+        Given a document's ``ordinal`` & the ``document`` dict, writes the
+        values of all the doc values fields to their columns.
+        """
+        for field, kind in self.doc_values.items():
+            typecode, missing = self.COLUMN_TYPES[kind]
+            value = document.get(field)
+
+            if value is None:
+                value = missing
+            elif kind == 'keyword':
+                value = self.get_key_ordinal(field, str(value))
+            else:
+                value = float(value)
+
+            self.write_column_value(field, ordinal, value)
+
+        return True
+
+    def get_doc_value(self, field, ordinal):
+        """
+        Given a ``field`` & a document's ``ordinal``, returns the value
+        stored in the column (or ``None`` if there isn't one).
+        """
+        return self.get_doc_values(field, [ordinal])[0]
+
+    def get_doc_values(self, field, ordinals):
+        """
+        Given a ``field`` & a list of documents' ``ordinals``, returns a list
+        of the values stored in the column (with ``None`` where there isn't
+        one).
+
+        The column (& any keys) only get loaded once, however many documents
+        there are.
+        """
+        column = self.load_column(field)
+        keys = None
+        values = []
+
+        if self.doc_values[field] == 'keyword':
+            keys = self.load_column_keys(field)[0]
+
+        for ordinal in ordinals:
+            if ordinal is None or ordinal >= len(column):
+                values.append(None)
+                continue
+
+            value = column[ordinal]
+
+            if keys is not None:
+                value = keys[value] if value >= 0 else None
+            elif value != value:
+                # NaN marks a missing value.
+                value = None
+
+            values.append(value)
+
+        return values
+
+    def matches_filter(self, value, condition):
+        """
+        Checks a doc ``value`` against a filter ``condition``.
+
+        A tuple (or list) ``condition`` is an inclusive ``(low, high)`` range,
+        where either end can be ``None`` to leave it open. Anything else has
+        to match exactly.
+        """
+        if value is None:
+            return False
+
+        if isinstance(condition, (tuple, list)):
+            low, high = condition
+
+            if low is not None and value < low:
+                return False
+
+            if high is not None and value > high:
+                return False
+
+            return True
+
+        return value == condition
+
+    def make_filter(self, field, condition):
+        """
+        Given a ``field`` & a filter ``condition`` (see ``matches_filter``),
+        returns a ``DocSet`` of the ordinals of all the matching documents.
+
+        This scans the field's column once, so the result gets cached (see
+        ``get_filter``).
+        """
+        column = self.load_column(field)
+        matching = DocSet()
+
+        if self.doc_values[field] == 'keyword':
+            # Compare the (integer) positions of the keys, rather than
+            # decoding every value.
+            keys = self.load_column_keys(field)[0]
+            wanted = set([position for position, key in enumerate(keys) if self.matches_filter(key, condition)])
+
+            for ordinal, position in enumerate(column):
+                if position in wanted:
+                    matching.add(ordinal)
+        else:
+            for ordinal, value in enumerate(column):
+                # NaN marks a missing value.
+                if value == value and self.matches_filter(value, condition):
+                    matching.add(ordinal)
+
+        return matching
+
+    def get_filter(self, field, condition):
+        """
+        Given a ``field`` & a filter ``condition``, returns the ``DocSet`` of
+        matching documents, from the cache if possible.
+
+        Cached filters are thrown away whenever the column changes.
+        """
+        if isinstance(condition, list):
+            condition = tuple(condition)
+
+        cache_key = (field, condition)
+        # Make sure we're looking at the current column.
+        self.load_column(field)
+        column_key = self.columns.get(field, (None, None))[0]
+        cached = self.filter_cache.get(cache_key)
+
+        if cached is not None and cached[0] == column_key:
+            self.filter_cache.move_to_end(cache_key)
+            self.profiler.incr('filter_cache_hits')
+            return cached[1]
+
+        self.profiler.incr('filter_cache_misses')
+        matching = self.make_filter(field, condition)
+        self.filter_cache[cache_key] = (column_key, matching)
+
+        while len(self.filter_cache) > self.filter_cache_size:
+            self.filter_cache.popitem(last=False)
+
+        return matching
+
+    def build_filter(self, filters):
+        """
+        Given a dict of ``filters`` (field names as keys & conditions as
+        values), returns a ``DocSet`` of the documents that pass them all.
+        """
+        doc_sets = [self.get_filter(field, condition) for field, condition in filters.items()]
+        doc_sets.sort(key=len)
+        matching = doc_sets[0]
+
+        for doc_set in doc_sets[1:]:
+            matching = matching & doc_set
+
+        return matching
+
+    def count_facets(self, doc_ids, facets):
+        """
+        Given some ``doc_ids`` & a list of ``facets`` (field names), counts
+        how many of the documents have each value.
+
+        Returns a dict, with the field names as keys & dicts of values to
+        counts as the values.
+        """
+        ordinals = self.load_ordinals()
+        counts = {}
+
+        doc_ordinals = [ordinals.get(doc_id) for doc_id in doc_ids]
+
+        for field in facets:
+            field_counts = {}
+
+            for value in self.get_doc_values(field, doc_ordinals):
+                if value is not None:
+                    field_counts[value] = field_counts.get(value, 0) + 1
+
+            counts[field] = field_counts
+
+        return counts
+
+    def sort_by_field(self, scored_results, sort):
+        """
+        Given (score-ordered) ``scored_results`` (``Hit``s) & a ``sort`` field
+        name, reorders them by the field's doc values.
+
+        Prefix the field with ``-`` to sort in descending order. Documents
+        without a value always come last & ties keep their score order.
+        """
+        reverse = sort.startswith('-')
+        field = sort.lstrip('-')
+        ordinals = self.load_ordinals()
+        with_values = []
+        without_values = []
+
+        values = self.get_doc_values(field, [ordinals.get(res.id) for res in scored_results])
+
+        for res, value in zip(scored_results, values):
+            if value is None:
+                without_values.append(res)
+            else:
+                with_values.append((value, res))
+
+        with_values.sort(key=lambda pair: pair[0], reverse=reverse)
+        return [res for value, res in with_values] + without_values
+
+    def whole_terms(self, field_tokens):
+        """
+        Given a dict of ``field_tokens``, returns a set of the whole
+        (field-prefixed) tokens, for the term dictionary.
+        """
+        tokens = set()
+
+        for field, field_token_list in field_tokens.items():
+            for token in field_token_list:
+                tokens.add(self.make_field_term(field, token))
+
+        return tokens
+
+    def analyze_fields(self, document):
+        """
+        Given a ``document`` dict, tokenizes each of the indexed fields it
+        has.
+
+        Returns a dict, with the field names as keys & lists of tokens as
+        values.
+        """
+        field_tokens = {}
+
+        for field in self.fields:
+            if field in document:
+                field_tokens[field] = self.make_tokens(str(document[field]))
+
+        return field_tokens
+
+    def analyze(self, document):
+        """
+        Given a ``document`` dict, runs the analysis (tokenization & n-gram
+        generation) on the fields that get indexed.
+
+        Returns a dict of terms, with the positions as values.
+        """
+        return self.make_field_terms(self.analyze_fields(document))
+
+    def check_document(self, document):
+        """
+        Ensures the provided ``document`` can be indexed.
+
+        Raises an exception if it can not.
+        """
+        # Ensure that the ``document`` looks like a dictionary.
+        if not hasattr(document, 'items'):
+            raise AttributeError('You must provide `index` with a document in the form of a dictionary.')
+
+        # Without any of the indexed fields, there'd be nothing to find.
+        for field in self.fields:
+            if field in document:
+                return
+
+        raise KeyError('You must provide `index` with a document with at least one of these fields in it: {0}.'.format(', '.join(sorted(self.fields))))
+
+    def index(self, doc_id, document):
+        """
+        Given a ``doc_id`` string & a ``document`` dict, does everything needed
+        to save & index the document for searching.
+
+        The ``document`` dict must have at least one of the indexed fields
+        (by default, just ``text``), which should contain the blob to be
+        indexed. All other fields are simply stored.
+
+        Returns ``True`` on success.
+        """
+        self.check_document(document)
+
+        with self.write_lock, self.profiling('index') as profiler:
+            self.check_routing()
+            # Make sure the document ID is a string.
+            doc_id = str(doc_id)
+
+            with profiler.phase('save_document'):
+                self.save_document(doc_id, document)
+                ordinal = self.assign_ordinals([doc_id])[0]
+                self.save_doc_values(ordinal, document)
+
+            # Start analysis & indexing.
+            with profiler.phase('analysis'):
+                field_tokens = self.analyze_fields(document)
+                terms = self.make_field_terms(field_tokens)
+
+            self.save_norms([(ordinal, dict([(field, len(tokens)) for field, tokens in field_tokens.items()]))])
+
+            with profiler.phase('save_segments'):
+                # The tokens go in first, so the term dictionary never misses
+                # anything that's in the segments (see ``plan_query``).
+                self.add_to_term_dictionary(self.whole_terms(field_tokens))
+
+                for term, positions in terms.items():
+                    self.save_segment(term, {doc_id: positions}, update=True)
+
+            profiler.incr('terms_written', len(terms))
+            field_lengths = dict([(field, [len(tokens)]) for field, tokens in field_tokens.items()])
+            self.add_to_stats(1, field_lengths)
+            self.commit([self.make_segment_name(term) for term in terms], [doc_id])
+
+        return True
+
+    def bulk_index(self, documents):
+        """
+        Given an iterable of ``(doc_id, document)`` pairs, saves & indexes all
+        of them in one batch.
+
+        Rather than rewriting a segment once per document (like ``index``
+        does), the postings for the whole batch are gathered in memory first,
+        so each term only gets written out once.
+
+        The whole batch is checked (see ``check_document``) before anything
+        gets written, so one bad document leaves the index untouched.
+
+        Returns the number of documents indexed.
+        """
+        batch_terms = {}
+        batch_tokens = set()
+        batch_doc_ids = []
+        batch_lengths = []
+        field_lengths = {}
+        count = 0
+
+        with self.write_lock, self.profiling('bulk_index') as profiler:
+            self.check_routing()
+            documents = [(str(doc_id), document) for doc_id, document in documents]
+
+            for doc_id, document in documents:
+                self.check_document(document)
+
+            for doc_id, document in documents:
+                with profiler.phase('save_document'):
+                    self.save_document(doc_id, document)
+                    ordinal = self.assign_ordinals([doc_id])[0]
+                    self.save_doc_values(ordinal, document)
+
+                with profiler.phase('analysis'):
+                    field_tokens = self.analyze_fields(document)
+
+                    for term, positions in self.make_field_terms(field_tokens).items():
+                        batch_terms.setdefault(term, {})
+                        batch_terms[term][doc_id] = positions
+
+                    batch_tokens.update(self.whole_terms(field_tokens))
+
+                for field, tokens in field_tokens.items():
+                    field_lengths.setdefault(field, [])
+                    field_lengths[field].append(len(tokens))
+
+                batch_lengths.append((ordinal, dict([(field, len(tokens)) for field, tokens in field_tokens.items()])))
+                batch_doc_ids.append(doc_id)
+                count += 1
+
+            with profiler.phase('save_segments'):
+                self.add_to_term_dictionary(batch_tokens)
+
+                for term, term_info in batch_terms.items():
+                    self.save_segment(term, term_info, update=True)
+
+                self.save_norms(batch_lengths)
+
+            profiler.incr('docs_indexed', count)
+            profiler.incr('terms_written', len(batch_terms))
+
+            if count:
+                self.add_to_stats(count, field_lengths)
+                self.commit([self.make_segment_name(term) for term in batch_terms], batch_doc_ids)
+
+        return count
+
+
+    # =====
+    # Norms
+    # =====
+
+    def encode_norm(self, length):
+        """
+        Given a field's ``length`` (in tokens), quantizes it into a single
+        byte, on a log scale (so it's precise for short fields & coarse for
+        long ones). ``0`` is kept for fields that are empty or missing.
+        """
+        if not length:
+            return 0
+
+        return max(1, min(255, int(round(math.log(1 + length, 2) * 16))))
+
+    def make_norms_name(self, field):
+        """
+        Given a ``field``, returns the path to its norms, which hold a byte
+        (see ``encode_norm``) per document ordinal.
+        """
+        return os.path.join(self.norms_path, "{0}.norm".format(field))
+
+    def save_norms(self, doc_lengths):
+        """
+        Records the lengths of the indexed fields of new documents, for the
+        similarities that use them (see ``Similarity``).
+
+        Takes a ``doc_lengths`` parameter, which should be a list of
+        ``(ordinal, lengths)`` tuples, ``lengths`` being a dict of field
+        names to token counts.
+        """
+        if not doc_lengths:
+            return True
+
+        if not os.path.exists(self.norms_path):
+            os.makedirs(self.norms_path)
+
+        for field in self.fields:
+            norms_name = self.make_norms_name(field)
+            mode = 'r+b' if os.path.exists(norms_name) else 'w+b'
+
+            with open(norms_name, mode) as norms_file:
+                norms_file.seek(0, os.SEEK_END)
+                length = norms_file.tell()
+
+                for ordinal, lengths in sorted(doc_lengths, key=lambda pair: pair[0]):
+                    norm = self.encode_norm(lengths.get(field, 0))
+
+                    if ordinal > length:
+                        norms_file.seek(length)
+                        norms_file.write(bytes(ordinal - length))
+                    else:
+                        norms_file.seek(ordinal)
+
+                    norms_file.write(bytes([norm]))
+                    length = max(length, ordinal + 1)
+
+            self.norms.pop(field, None)
+
+        return True
+
+    def load_norms(self, field):
+        """
+        Given a ``field``, returns its norms as a ``bytearray``, indexed by
+        document ordinal.
+
+        The norms are cached until the file changes.
+        """
+        norms_name = self.make_norms_name(field)
+
+        if not os.path.exists(norms_name):
+            return bytearray()
+
+        norms_stat = os.stat(norms_name)
+        cache_key = (norms_stat.st_size, norms_stat.st_mtime)
+        cached = self.norms.get(field)
+
+        if cached is not None and cached[0] == cache_key:
+            return cached[1]
+
+        with open(norms_name, 'rb') as norms_file:
+            norms = bytearray(norms_file.read())
+
+        self.norms[field] = (cache_key, norms)
+        return norms
+
+    def postings_norms(self, postings, field):
+        """
+        Given some ``postings`` & a ``field``, returns a ``bytearray`` of the
+        field's norm for the document in each slot (``0`` if unknown).
+        """
+        if not field in postings.field_norms:
+            norms = self.load_norms(field)
+            ordinals = self.load_ordinals()
+            slot_norms = bytearray(len(postings))
+
+            for slot, doc_id in enumerate(postings.doc_ids):
+                ordinal = ordinals.get(doc_id, -1)
+
+                if 0 <= ordinal < len(norms):
+                    slot_norms[slot] = norms[ordinal]
+
+            postings.field_norms[field] = slot_norms
+
+        return postings.field_norms[field]
+
+
+    # =======
+    # Impacts
+    # =======
+
+    def make_impact_name(self, term):
+        """
+        Given a ``term``, returns the path to the impacts file it's in (see
+        ``build_impacts``).
+        """
+        if self.segment_buckets:
+            name = self.segment_bucket(term)
+        else:
+            name = self.hash_name(term)
+
+        return os.path.join(self.impacts_path, "{0}.impacts".format(name))
+
+    def build_impacts(self, block_size=128, max_postings=None):
+        """
+        Writes out an impact-ordered copy of the postings, for fast
+        approximate searches (see the ``impact_blocks`` option of
+        ``search``).
+
+        Each term's postings get sorted by how much they add to the score
+        (by term frequency, since that's all that varies within a term, but
+        lowest first for terms so common they count against a document) &
+        split into blocks, one per line, with the most important block first.
+        A search can then read just the first few blocks of a term, rather
+        than all of a huge posting list (like those of short n-grams).
+
+        Optionally accepts a ``block_size`` parameter, which is how many
+        postings go in a block. Default is ``128``.
+
+        Optionally accepts a ``max_postings`` parameter, which prunes each
+        term down to its highest impact postings. The document counts still
+        include everything, so scoring isn't affected. Default is ``None``
+        (keep them all).
+
+        The impacts are a snapshot, so rebuild them after indexing more.
+
+        They're built a segment at a time, so only one segment's worth needs
+        to be in memory. Any impacts file that ends up with terms from more
+        than one segment (after ``rebalance_segments``, say) gets put back
+        in order at the end.
+
+        Returns the number of terms written.
+        """
+        ordinals = self.load_ordinals()
+        written = set()
+        needs_sorting = set()
+        term_count = 0
+
+        with self.write_lock:
+            total_docs = self.get_total_docs()
+            generation = self.read_generation()
+            # Built off to the side, then swapped in all at once.
+            new_impacts_path = tempfile.mkdtemp(dir=self.base_directory, prefix=self.TEMP_PREFIX)
+
+            for seg_name in self.segment_names():
+                impact_files = {}
+
+                for term, term_info in self.iter_segment_records(seg_name):
+                    term_info = json.loads(term_info)
+                    direction = -1 if self.bm25_idf(len(term_info), total_docs) >= 0 else 1
+                    postings = sorted(
+                        [[doc_id, len(positions)] for doc_id, positions in term_info.items()],
+                        key=lambda posting: (direction * posting[1], ordinals.get(posting[0], -1))
+                    )
+
+                    if max_postings is not None:
+                        postings = postings[:max_postings]
+
+                    blocks = [postings[i:i + block_size] for i in range(0, len(postings), block_size)] or [[]]
+                    header = {
+                        'df': len(term_info),
+                        'stored': len(postings),
+                        'blocks': len(blocks),
+                    }
+                    lines = []
+
+                    for block_number, block in enumerate(blocks):
+                        data = {'postings': block}
+
+                        if block_number == 0:
+                            data.update(header)
+
+                        lines.append(self.make_record(term, data))
+
+                    impact_files.setdefault(self.make_impact_name(term), {})[term] = lines
+
+                for impact_name, term_lines in impact_files.items():
+                    impact_path = os.path.join(new_impacts_path, os.path.basename(impact_name))
+
+                    if impact_path in written:
+                        needs_sorting.add(impact_path)
+
+                    written.add(impact_path)
+                    term_count += len(term_lines)
+
+                    with open(impact_path, 'ab') as impact_file:
+                        for term in sorted(term_lines):
+                            impact_file.write(''.join(term_lines[term]).encode('utf-8'))
+
+            for impact_path in needs_sorting:
+                with open(impact_path, 'rb') as impact_file:
+                    lines = impact_file.read().decode('utf-8').splitlines(True)
+
+                # Stable, so each term's blocks stay in order.
+                lines.sort(key=lambda line: self.parse_record(line)[0])
+
+                with open(impact_path, 'wb') as impact_file:
+                    impact_file.write(''.join(lines).encode('utf-8'))
+
+            with open(os.path.join(new_impacts_path, 'meta.json'), 'w') as meta_file:
+                json.dump({'generation': generation, 'total_docs': total_docs, 'block_size': block_size, 'max_postings': max_postings}, meta_file)
+
+            if os.path.exists(self.impacts_path):
+                shutil.rmtree(self.impacts_path)
+
+            os.rename(new_impacts_path, self.impacts_path)
+
+        return term_count
+
+    def impacts_current(self):
+        """
+        Returns ``True`` if the impacts (see ``build_impacts``) exist & no
+        commits have happened since they were built.
+        """
+        meta_path = os.path.join(self.impacts_path, 'meta.json')
+
+        if not os.path.exists(meta_path):
+            return False
+
+        with open(meta_path, 'r') as meta_file:
+            return json.load(meta_file).get('generation') == self.read_generation()
+
+    def load_impacts(self, term, blocks):
+        """
+        Given a ``term``, reads up to ``blocks`` of its impact-ordered
+        postings.
+
+        Returns a tuple of the number of documents with the term, a list of
+        ``[doc_id, term_frequency]`` postings (best first) & whether that's
+        all of them.
+        """
+        impact_name = self.make_impact_name(term)
+        profiler = self.profiler
+        header = None
+        postings = []
+        blocks_read = 0
+
+        with profiler.phase('segment_io'):
+            if not os.path.exists(impact_name):
+                return 0, postings, True
+
+            with open(impact_name, 'r') as impact_file:
+                for line in impact_file:
+                    impact_term, data = self.parse_record(line)
+
+                    if impact_term < term:
+                        continue
+
+                    if impact_term > term or blocks_read >= max(blocks, 1):
+                        # The terms are in order, so there's no more to find.
+                        break
+
+                    data = json.loads(data)
+
+                    if header is None:
+                        header = data
+
+                    postings.extend(data['postings'])
+                    blocks_read += 1
+
+            profiler.incr('impact_blocks_read', blocks_read)
+
+        if header is None:
+            return 0, postings, True
+
+        return header['df'], postings, len(postings) == header['df']
+
+    def collect_impacts(self, terms, blocks, doc_filter=None):
+        """
+        Like ``collect_postings``, but only reads the first ``blocks`` of
+        each term's impact-ordered postings (see ``load_impacts``).
+
+        Returns the same as ``collect_postings``, plus whether any postings
+        were left unread (meaning the results are approximate).
+        """
+        per_term_docs = {}
+        postings = Postings()
+        approximate = False
+
+        if doc_filter is not None:
+            ordinals = self.load_ordinals()
+
+        for term in terms:
+            term_docs, term_postings, complete = self.load_impacts(term, blocks)
+            per_term_docs[term] = term_docs
+            approximate = approximate or not complete
+
+            for doc_id, term_freq in term_postings:
+                if doc_filter is not None and not ordinals.get(doc_id, -1) in doc_filter:
+                    continue
+
+                postings.add(term, doc_id, term_freq)
+
+        return per_term_docs, postings, approximate
+
+
+    # =========
+    # Searching
+    # =========
+
+    def parse_query(self, query):
+        """
+        Given a ``query`` string, converts it into terms for searching in the
+        index.
+
+        Plain words get searched for in all the indexed fields. To search
+        only within a single field, prefix the word with the field name (like
+        ``subject:audit``).
+
+        To tolerate typos, suffix a word with ``~`` (for one edit) or ``~2``
+        (for two), like ``lumberg~``. This searches for the indexed words that
+        are that close (see ``fuzzy_expand``).
+
+        Returns a list of terms.
+        """
+        field_tokens = dict([(field, []) for field in self.fields])
+        fuzzy_terms = {}
+        unscoped = []
+
+        for chunk in query.split():
+            chunk_fields = list(self.fields)
+            match = self.FIELD_QUERY.match(chunk)
+            scoped = match and match.group(1) in self.fields
+
+            if scoped:
+                chunk_fields = [match.group(1)]
+                chunk = match.group(2)
+
+            fuzzy = self.FUZZY_QUERY.match(chunk)
+
+            if fuzzy:
+                max_edits = int(fuzzy.group(2) or 1)
+
+                for field in chunk_fields:
+                    for token in self.make_tokens(fuzzy.group(1)):
+                        for term in self.fuzzy_terms(field, token, max_edits):
+                            fuzzy_terms.setdefault(term, [0])
+            elif scoped:
+                field_tokens[chunk_fields[0]].extend(self.make_tokens(chunk))
+            else:
+                unscoped.append(chunk)
+
+        if unscoped:
+            tokens = self.make_tokens(' '.join(unscoped))
+
+            for field in self.fields:
+                field_tokens[field].extend(tokens)
+
+        terms = self.make_field_terms(field_tokens)
+
+        for term, positions in fuzzy_terms.items():
+            terms.setdefault(term, positions)
+
+        return terms
+
+    def plan_query(self, terms):
+        """
+        Given the ``terms`` of a query, works out which to fetch & in what
+        order.
+
+        If the term dictionary is complete (see
+        ``term_dictionary_complete``), each term's selectivity gets estimated
+        from it (see ``estimate_term_docs``). Terms that can't be in the index
+        are left out entirely & the rest get fetched in one round, most
+        selective (then longest) first.
+
+        Otherwise, the front grams of a token nest: every document with
+        ``report`` also has ``repor``, ``repo`` & ``rep``. So the shorter
+        grams get fetched first & if one of them matches nothing, the longer
+        grams built on it can be skipped, without changing the results.
+
+        Returns a list of rounds, each a list of ``(term, prefix)`` tuples,
+        where ``prefix`` is the next shorter gram of the same token that has
+        to match for the term to be fetched (or ``None``).
+        """
+        term_set = set(terms)
+
+        if self.term_dictionary_complete():
+            dictionary = self.load_term_dictionary()
+            estimates = dict([(term, self.estimate_term_docs(term, dictionary)) for term in term_set])
+            found = [term for term in term_set if estimates[term]]
+
+            if not found:
+                return []
+
+            return [[(term, None) for term in sorted(found, key=lambda term: (estimates[term], -len(term), term))]]
+
+        rounds = {}
+
+        for term in term_set:
+            prefix = term[:-1] if term[:-1] in term_set else None
+            rounds.setdefault(len(term), []).append((term, prefix))
+
+        return [sorted(rounds[length]) for length in sorted(rounds)]
+
+    def fetch_terms(self, terms, term_timings=None):
+        """
+        Given the ``terms`` of a query, returns a dict of each of them to its
+        ``term_info``.
+
+        Each term is only fetched once, following the plan from
+        ``plan_query``, with each round's reads batched by segment (see
+        ``load_segments``). Terms the plan rules out get an empty dict.
+
+        Optionally accepts a ``term_timings`` parameter, which is a dict. If
+        provided, the time spent fetching each term gets recorded in it.
+        """
+        term_infos = {}
+
+        for round_terms in self.plan_query(terms):
+            needed = []
+
+            for term, prefix in round_terms:
+                if prefix is not None and not term_infos[prefix]:
+                    term_infos[term] = {}
+                    self.profiler.incr('terms_skipped')
+                else:
+                    needed.append(term)
+
+            term_infos.update(self.load_segments(needed, term_timings=term_timings))
+
+        for term in terms:
+            if not term in term_infos:
+                term_infos[term] = {}
+                self.profiler.incr('terms_skipped')
+
+        return term_infos
+
+    def collect_results(self, terms, term_timings=None, doc_filter=None):
+        """
+        For a list of ``terms``, collects all the documents from the index
+        containing those terms.
+
+        Optionally accepts a ``term_timings`` parameter, which is a dict. If
+        provided, the time spent fetching each term gets recorded in it.
+
+        Optionally accepts a ``doc_filter`` parameter, which is a ``DocSet``.
+        If provided, only documents whose ordinals are in it get collected.
+        The per-term counts still include every document, so scoring isn't
+        affected by the filter.
+
+        The returned data is a tuple of two dicts. This is done to make the
+        process of scoring easy & require no further information.
+
+        The first dict contains all the terms as keys & a count (integer) of
+        the matching docs as values.
+
+        The second dict inverts this, with ``doc_ids`` as the keys. The values
+        are a nested dict, which contains the ``terms`` as the keys and a
+        count of the number of positions within that doc.
+
+        Since this is complex, an example return value::
+
+            >>> per_term_docs, per_doc_counts = ms.collect_results(['hello', 'world'])
+            >>> per_term_docs
+            {
+                'hello': 2,
+                'world': 1
+            }
+            >>> per_doc_counts
+            {
+                'doc-1': {
+                    'hello': 4
+                },
+                'doc-2': {
+                    'hello': 1,
+                    'world': 3
+                }
+            }
+
+        """
+        per_term_docs = {}
+        per_doc_counts = {}
+
+        if doc_filter is not None:
+            ordinals = self.load_ordinals()
+
+        term_infos = self.fetch_terms(terms, term_timings=term_timings)
+
+        for term in terms:
+            term_matches = term_infos[term]
+            per_term_docs.setdefault(term, 0)
+            per_term_docs[term] += len(term_matches.keys())
+
+            for doc_id, positions in term_matches.items():
+                if doc_filter is not None and not ordinals.get(doc_id, -1) in doc_filter:
+                    continue
+
+                per_doc_counts.setdefault(doc_id, {})
+                per_doc_counts[doc_id].setdefault(term, 0)
+                per_doc_counts[doc_id][term] += len(positions)
+
+        return per_term_docs, per_doc_counts
+
+    def collect_postings(self, terms, term_timings=None, doc_filter=None, term_infos=None):
+        """
+        Like ``collect_results``, but gathers the matches into a compact
+        ``Postings`` (rather than a dict per document), which is what
+        ``search`` uses. The ``terms`` should be unique.
+
+        Optionally accepts a ``term_infos`` parameter, which is a dict of the
+        ``terms`` to their already fetched ``term_info``. Default is ``None``
+        (fetch them via ``fetch_terms``).
+
+        Returns a tuple of the ``per_term_docs`` dict (as ``collect_results``
+        does) & the ``Postings``.
+        """
+        per_term_docs = {}
+        postings = Postings()
+
+        if doc_filter is not None:
+            ordinals = self.load_ordinals()
+
+        if term_infos is None:
+            term_infos = self.fetch_terms(terms, term_timings=term_timings)
+
+        for term in terms:
+            term_matches = term_infos[term]
+            per_term_docs[term] = len(term_matches)
+
+            for doc_id, positions in term_matches.items():
+                if doc_filter is not None and not ordinals.get(doc_id, -1) in doc_filter:
+                    continue
+
+                postings.add(term, doc_id, len(positions))
+
+        return per_term_docs, postings
+
+    def bm25_relevance(self, terms, matches, current_doc, total_docs, b=0, k=1.2):
+        """
+        Given multiple inputs, performs a BM25 relevance calculation for a
+        given document.
+
+        ``terms`` should be a list of terms.
+
+        ``matches`` should be the first dictionary back from
+        ``collect_results``.
+
+        ``current_doc`` should be the second dictionary back from
+        ``collect_results``.
+
+        ``total_docs`` should be an integer of the total docs in the index.
+
+        Optionally accepts a ``b`` parameter, which is an integer specifying
+        the length of the document. Since it doesn't vastly affect the score,
+        the default is ``0``.
+
+        Optionally accepts a ``k`` parameter. It accepts a float & is used to
+        modify scores to fall into a given range. With the default of ``1.2``,
+        scores typically range from ``0.4`` to ``1.0``.
+        """
+        # More or less borrowed from http://sphinxsearch.com/blog/2010/08/17/how-sphinx-relevance-ranking-works/.
+        score = b
+
+        for term in terms:
+            if not matches.get(term):
+                # No document has this term, so it can't contribute (and
+                # would otherwise divide by zero).
+                continue
+
+            idf = self.bm25_idf(matches[term], total_docs)
+            score = score + self.term_boost(term) * current_doc.get(term, 0) * idf / (current_doc.get(term, 0) + k)
+
+        return 0.5 + score / (2 * len(terms))
+
+    def term_boost(self, term):
+        """
+        Returns the boost of the field a given ``term`` belongs to.
+        """
+        return self.fields.get(self.split_field_term(term)[0], 1.0)
+
+    def bm25_idf(self, term_docs, total_docs):
+        """
+        Returns the (normalized) inverse document frequency of a term.
+
+        ``term_docs`` should be an integer of how many docs contain the term.
+
+        ``total_docs`` should be an integer of the total docs in the index.
+        """
+        return math.log((total_docs - term_docs + 1.0) / term_docs) / math.log(1.0 + total_docs)
+
+    def bm25_explain(self, terms, matches, current_doc, total_docs, b=0, k=1.2):
+        """
+        Breaks down a ``bm25_relevance`` score into what each term
+        contributed.
+
+        Takes the same parameters as ``bm25_relevance``.
+
+        Returns a dict, with the ``terms`` as keys & their share of the score
+        as values. The score is ``0.5`` plus the sum of these.
+        """
+        contributions = {}
+
+        for term in terms:
+            tf = current_doc.get(term, 0)
+
+            if not tf or not matches.get(term):
+                continue
+
+            idf = self.bm25_idf(matches[term], total_docs)
+            contributions[term] = (self.term_boost(term) * tf * idf / (tf + k)) / (2 * len(terms))
+
+        return contributions
+
+    def score_results(self, terms, per_term_docs, per_doc_counts, total_docs):
+        """
+        Scores each of the documents in ``per_doc_counts``.
+
+        ``terms``, ``per_term_docs`` & ``per_doc_counts`` are as passed to or
+        returned from ``collect_results``. ``total_docs`` should be an integer
+        of the total docs in the index.
+
+        Returns a list of dicts, each with an ``id`` & a ``score``.
+        """
+        scored_results = []
+
+        for doc_id, current_doc in per_doc_counts.items():
+            scored_results.append({
+                'id': doc_id,
+                'score': self.bm25_relevance(terms, per_term_docs, current_doc, total_docs),
+            })
+
+        return scored_results
+
+    def score_postings(self, terms, per_term_docs, postings, total_docs):
+        """
+        Scores every document in the ``postings`` (see ``collect_postings``),
+        using the ``similarity``.
+
+        With the default ``BM25Similarity``, gives exactly the same scores as
+        ``bm25_relevance``, but without building anything per document.
+
+        Returns an ``array('d')`` of the scores, indexed by slot.
+        """
+        return self.similarity.score_postings(self, terms, per_term_docs, postings, total_docs)
+
+    def bound_term_docs(self, per_term_docs, total_docs):
+        """
+        Caps each of the ``per_term_docs`` at ``total_docs``.
+
+        The stats & postings are read separately, so while another process
+        is indexing, the postings can already include documents the stats
+        don't count yet. Left alone, that makes for impossible IDFs.
+        """
+        return dict([(term, min(term_docs, total_docs)) for term, term_docs in per_term_docs.items()])
+
+    def explain_terms(self, terms, per_term_docs, total_docs, term_timings):
+        """
+        Describes what each of the ``terms`` cost during a search.
+
+        Returns a dict, with the ``terms`` as keys & dicts of the ``segment``
+        consulted, the length of the ``postings``, the ``idf`` & the ``time``
+        (in seconds) spent fetching it as values.
+        """
+        explained = {}
+
+        for term in terms:
+            term_docs = per_term_docs.get(term, 0)
+            explained[term] = {
+                'segment': self.make_segment_name(term),
+                'postings': term_docs,
+                'idf': self.similarity.idf(term_docs, total_docs) if term_docs else 0.0,
+                'time': term_timings.get(term, 0.0),
+            }
+
+        return explained
+
+    def make_cursor(self, score, ordinal, doc_id=None):
+        """
+        Given the ``score`` & ``ordinal`` of the last hit on a page, returns
+        an opaque token for fetching the next page (see ``search``).
+
+        Indexes written before ordinals existed have none for their older
+        documents, so if ``ordinal`` is ``None``, the hit's ``doc_id`` is used
+        to break ties instead.
+        """
+        if ordinal is None:
+            raw = "{0!r}::{1}".format(score, doc_id).encode('utf-8')
+        else:
+            raw = "{0!r}:{1}".format(score, ordinal).encode('utf-8')
+
+        return base64.urlsafe_b64encode(raw).decode('ascii')
+
+    def parse_cursor(self, cursor):
+        """
+        The inverse of ``make_cursor``.
+
+        Returns a tuple of the score, ordinal & doc id (only one of which is
+        set), or ``None`` for an empty ``cursor`` (the first page). Raises a
+        ``ValueError`` if the cursor is garbled.
+        """
+        if not cursor:
+            return None
+
+        try:
+            score, ordinal, doc_id = (base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').split(':', 2) + [None])[:3]
+
+            if doc_id is None:
+                return float(score), int(ordinal), None
+            elif not ordinal and doc_id:
+                return float(score), None, doc_id
+        except (TypeError, ValueError):
+            pass
+
+        raise ValueError("Invalid cursor '{0}'.".format(cursor))
+
+    def page_after(self, scored_results, cursor, limit):
+        """
+        Given ``scored_results`` (an iterable of ``Hit``s), returns the (at
+        most) ``limit`` best hits that rank strictly after the ``cursor``.
+
+        Hits are ranked by descending score, with ties broken by ascending
+        ordinal, so every hit has a distinct position. Any hits without an
+        ordinal come after those with one, in ``doc_id`` order. Rather than
+        sorting everything, only a heap of ``limit`` hits is kept, so the cost
+        doesn't grow with how deep the page is.
+        """
+        ordinals = self.load_ordinals()
+        after = self.parse_cursor(cursor)
+
+        def rank(res):
+            ordinal = ordinals.get(res.id)
+
+            if ordinal is None:
+                return (-res.score, 1, 0, res.id)
+
+            return (-res.score, 0, ordinal, '')
+
+        if after is None:
+            candidates = scored_results
+        else:
+            score, ordinal, doc_id = after
+
+            if ordinal is None:
+                after_rank = (-score, 1, 0, doc_id)
+            else:
+                after_rank = (-score, 0, ordinal, '')
+
+            candidates = (res for res in scored_results if rank(res) > after_rank)
+
+        return heapq.nsmallest(limit, candidates, key=rank)
+
+    def search(self, query, offset=0, limit=20, profile=False, explain=False, sort=None, filters=None, facets=None, search_after=None, impact_blocks=None):
+        """
+        Given a ``query``, performs a search on the index & returns the results.
+
+        Optionally accepts an ``offset`` parameter, which is an integer &
+        controls what the starting point in the results is. Default is ``0``
+        (the beginning).
+
+        Optionally accepts a ``limit`` parameter, which is an integer &
+        controls how many results to return. Default is ``20``.
+
+        Optionally accepts a ``profile`` parameter, which is a boolean. If
+        ``True``, the per-phase timings & counters for the search get included
+        in the results (as ``profile``). Default is ``False``.
+
+        Optionally accepts an ``explain`` parameter, which is a boolean. If
+        ``True``, the results include an ``explain`` dict, with details on
+        every term searched for (see ``explain_terms``) under ``terms`` & a
+        per-term breakdown of each returned hit's score (see
+        ``Similarity.explain``) under ``hits``. Default is ``False``.
+
+        The following use the doc values columns (see the ``doc_values``
+        option), so no documents need loading to handle them.
+
+        Optionally accepts a ``sort`` parameter, which is a field name to
+        order the results by instead of ``score``. Prefix it with ``-`` for
+        descending order. Default is ``None``.
+
+        Optionally accepts a ``filters`` parameter, which is a dict of field
+        names to conditions (either a value to match or an inclusive
+        ``(low, high)`` range). Only documents passing all of them are
+        returned. Each filter is cached (see ``get_filter``) & applied before
+        any scoring happens. Default is ``None``.
+
+        Optionally accepts a ``facets`` parameter, which is a list of field
+        names. The results then include ``facets``, counting how many of all
+        the hits have each value. Default is ``None``.
+
+        Optionally accepts a ``search_after`` parameter, which is a cursor
+        token for deep pagination. Pass an empty string for the first page,
+        then the ``next`` token from each page's results to get the one after
+        it (``next`` is ``None`` once there are no more). Unlike ``offset``,
+        each page costs the same no matter how deep it is. Can't be combined
+        with ``offset`` or ``sort``. Default is ``None``.
+
+        Optionally accepts an ``impact_blocks`` parameter, which is an
+        integer. If provided (& the impacts are up to date, see
+        ``build_impacts``), only that many blocks of each term's best
+        postings get read, which bounds the work on huge posting lists. Hits
+        are scored on just the postings read, so some may be missed or
+        scored differently. The results include ``approximate``, which is
+        ``True`` if any postings went unread. Default is ``None`` (read
+        everything).
+
+        Readers (see the ``refresh_interval`` option) pick up any new commits
+        first, if they're due to.
+
+        Returns a dictionary containing the ``total_hits`` (integer), which is
+        a count of all the documents that matched, and ``results``, which is
+        a list of results (in descending ``score`` order) & sliced to the
+        provided ``offset/limit`` combination.
+        """
+        results = {
+            'total_hits': 0,
+            'results': []
+        }
+
+        if search_after is not None:
+            if offset or sort:
+                raise ValueError('`search_after` can not be combined with `offset` or `sort`.')
+
+            results['next'] = None
+
+        with self.profiling('search', enabled=profile, attach_to=results) as profiler:
+            self.maybe_refresh()
+            self.check_routing()
+
+            if not len(query):
+                return results
+
+            total_docs = self.get_total_docs()
+
+            if total_docs == 0:
+                return results
+
+            with profiler.phase('parse_query'):
+                terms = self.parse_query(query)
+
+            if self.query_log:
+                self.log_query(terms)
+
+            term_timings = {} if explain else None
+            doc_filter = None
+
+            if filters:
+                with profiler.phase('filtering'):
+                    doc_filter = self.build_filter(filters)
+
+            with profiler.phase('collect_results'):
+                if impact_blocks is not None and self.impacts_current():
+                    per_term_docs, postings, results['approximate'] = self.collect_impacts(terms, impact_blocks, doc_filter=doc_filter)
+                else:
+                    per_term_docs, postings = self.collect_postings(terms, term_timings=term_timings, doc_filter=doc_filter)
+
+                    if impact_blocks is not None:
+                        results['approximate'] = False
+
+                per_term_docs = self.bound_term_docs(per_term_docs, total_docs)
+
+            doc_ids = postings.doc_ids
+
+            if facets:
+                with profiler.phase('faceting'):
+                    results['facets'] = self.count_facets(doc_ids, facets)
+
+            with profiler.phase('scoring'):
+                scores = self.score_postings(terms, per_term_docs, postings, total_docs)
+
+            profiler.incr('docs_scored', len(scores))
+            results['total_hits'] = len(scores)
+
+            # Sort & slice the results. Only the hits that could make the
+            # page ever become ``Hit``s.
+            with profiler.phase('sorting'):
+                if search_after is not None:
+                    all_hits = (Hit(doc_ids[slot], scores[slot]) for slot in range(len(scores)))
+                    sliced_results = self.page_after(all_hits, search_after, limit)
+                elif sort:
+                    sorted_slots = sorted(range(len(scores)), key=scores.__getitem__, reverse=True)
+                    sorted_results = [Hit(doc_ids[slot], scores[slot]) for slot in sorted_slots]
+                    sliced_results = self.sort_by_field(sorted_results, sort)[offset:offset + limit]
+                else:
+                    # Only the hits up to the end of the page need ordering.
+                    top_slots = heapq.nlargest(offset + limit, range(len(scores)), key=scores.__getitem__)[offset:]
+                    sliced_results = [Hit(doc_ids[slot], scores[slot]) for slot in top_slots]
+
+            if search_after is not None:
+                if sliced_results and len(sliced_results) == limit:
+                    last = sliced_results[-1]
+                    results['next'] = self.make_cursor(last.score, self.get_ordinal(last.id), last.id)
+
+            # For each result, load up the doc & update the dict.
+            for res in sliced_results:
+                doc_dict = self.load_document(res.id)
+                doc_dict.update({'id': res.id, 'score': res.score})
+                results['results'].append(doc_dict)
+
+            if explain:
+                results['explain'] = {
+                    'terms': self.explain_terms(terms, per_term_docs, total_docs, term_timings),
+                    'hits': {},
+                }
+
+                for res in sliced_results:
+                    results['explain']['hits'][res.id] = self.similarity.explain(self, terms, per_term_docs, postings, postings.slots[res.id], total_docs)
+
+        return results
+
+
+    # ========
+    # Sharding
+    # ========
+
+    def shard_stats(self, terms):
+        """
+        The first phase of a distributed search.
+
+        Given a list of ``terms``, returns the stats needed for globally
+        consistent scoring, as a dict containing the ``total_docs`` & the
+        ``per_term_docs`` (as returned by ``collect_results``).
+
+        Everything returned is plain JSON-serializable data, so this can
+        happen in another process (or on another host).
+
+        The postings fetched are kept until the matching ``shard_search``, so
+        a query only reads each segment once per shard.
+        """
+        self.maybe_refresh()
+        self.check_routing()
+        term_infos = self.fetch_terms(terms)
+        self.shard_terms = (self.read_generation(), list(terms), term_infos)
+        per_term_docs = {}
+
+        for term in terms:
+            per_term_docs[term] = len(term_infos[term])
+
+        return {
+            'total_docs': self.get_total_docs(),
+            'per_term_docs': per_term_docs,
+        }
+
+    def shard_search(self, terms, per_term_docs, total_docs, top_k):
+        """
+        The second phase of a distributed search.
+
+        Given a list of ``terms``, plus the ``per_term_docs`` & ``total_docs``
+        aggregated across all the shards, scores the local documents & returns
+        the best ``top_k`` of them.
+
+        Reuses the postings ``shard_stats`` fetched for the same ``terms``, as
+        long as nothing's been committed since.
+
+        Returns a dict containing the local ``total_hits`` & the ``hits``, a
+        list of ``[doc_id, score]`` pairs in descending ``score`` order.
+        """
+        self.maybe_refresh()
+        self.check_routing()
+        term_infos = None
+        shard_terms, self.shard_terms = self.shard_terms, None
+
+        if shard_terms is not None and shard_terms[1] == list(terms) and shard_terms[0] == self.read_generation():
+            term_infos = shard_terms[2]
+
+        postings = self.collect_postings(terms, term_infos=term_infos)[1]
+        per_term_docs = self.bound_term_docs(per_term_docs, total_docs)
+        scores = self.score_postings(terms, per_term_docs, postings, total_docs)
+        top_slots = heapq.nlargest(top_k, range(len(scores)), key=scores.__getitem__)
+
+        return {
+            'total_hits': len(scores),
+            'hits': [[postings.doc_ids[slot], scores[slot]] for slot in top_slots],
+        }
+
+
+def call_shard(shard, method_name, *args):
+    """
+    Calls ``method_name`` on ``shard`` with the provided ``args``.
+
+    Lives at the module level so that it can be handed to a process pool.
+    """
+    return getattr(shard, method_name)(*args)
+
+
+class JsonShardClient(object):
+    """
+    A stand-in for talking to a shard over RPC.
+
+    Wraps a local ``Microsearch`` shard, but round-trips every request &
+    response through JSON, just like a network hop would. Handy for making
+    sure nothing relies on sharing objects with the shard.
+    """
+    def __init__(self, shard):
+        self.shard = shard
+
+    def call(self, method_name, *args):
+        args = json.loads(json.dumps(args))
+        response = getattr(self.shard, method_name)(*args)
+        return json.loads(json.dumps(response))
+
+    def index(self, doc_id, document):
+        return self.call('index', doc_id, document)
+
+    def bulk_index(self, documents):
+        return self.call('bulk_index', list(documents))
+
+    def load_document(self, doc_id):
+        return self.call('load_document', doc_id)
+
+    def get_total_docs(self):
+        return self.call('get_total_docs')
+
+    def check_index(self, repair=False, workers=None):
+        return self.call('check_index', repair, workers)
+
+    def compact(self):
+        return self.call('compact')
+
+    def shard_stats(self, terms):
+        return self.call('shard_stats', terms)
+
+    def shard_search(self, terms, per_term_docs, total_docs, top_k):
+        return self.call('shard_search', terms, per_term_docs, total_docs, top_k)
+
+
+class ShardedMicrosearch(object):
+    """
+    Spreads documents over several ``Microsearch`` shards.
+
+    Documents are routed to a shard based on the hash of their ``doc_id``.
+    Indexing happens on all the shards in parallel, as does searching, which
+    is a two-phase scatter-gather:
+
+    * Each shard reports its per-term document counts, which get summed so
+      that every shard scores with the same (global) IDF.
+    * Each shard then scores its own matches & returns only its top hits,
+      which are merged into the final results.
+
+    Typical usage::
+
+        ms = microsearch.ShardedMicrosearch('/tmp/microsearch', shards=4)
+        ms.bulk_index(documents)
+        ms.search('blob')
+
+    """
+    def __init__(self, base_directory, shards=None, shard_class=Microsearch, client_class=None, executor=None, **shard_options):
+        """
+        Sets up the shards.
+
+        Requires a ``base_directory`` parameter, which specifies the parent
+        directory the shard directories will be kept in.
+
+        Optionally accepts a ``shards`` parameter, which is an integer of the
+        number of shards. The number is recorded on disk, so it only needs
+        providing when creating the index. Default is ``None`` (use the
+        recorded number, or ``4`` for a new index).
+
+        Optionally accepts a ``shard_class`` parameter, which is the class
+        used for each shard. Default is ``Microsearch``.
+
+        Optionally accepts a ``client_class`` parameter, which wraps each
+        shard (for instance, ``JsonShardClient``). Default is ``None`` (talk
+        to the shards directly).
+
+        Optionally accepts an ``executor`` parameter, which should be a
+        ``concurrent.futures`` executor used to fan out the work. With a
+        process pool, the shards get pickled for every call, so each worker
+        works on its own copy (``SqliteMicrosearch`` shards reopen their
+        database). Default is ``None`` (a thread pool with one worker per
+        shard).
+
+        Any other keyword arguments (like ``fields``) are passed along to
+        each shard.
+        """
+        self.base_directory = base_directory
+        self.shards_path = os.path.join(self.base_directory, 'shards.json')
+
+        if not os.path.exists(self.base_directory):
+            os.makedirs(self.base_directory)
+
+        if os.path.exists(self.shards_path):
+            with open(self.shards_path, 'r') as shards_file:
+                existing = json.load(shards_file)['shards']
+
+            if shards is not None and shards != existing:
+                raise ValueError("This index was created with {0} shards, not {1}.".format(existing, shards))
+
+            shards = existing
+        else:
+            if shards is None:
+                shards = 4
+
+            with open(self.shards_path, 'w') as shards_file:
+                json.dump({'shards': shards}, shards_file)
+
+        self.shards = []
+
+        for shard_number in range(shards):
+            shard_path = os.path.join(self.base_directory, 'shard-{0:03d}'.format(shard_number))
+            self.shards.append(shard_class(shard_path, **shard_options))
+
+        if client_class is not None:
+            self.clients = [client_class(shard) for shard in self.shards]
+        else:
+            self.clients = list(self.shards)
+
+        if executor is None:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.shards))
+
+        self.executor = executor
+
+    def close(self):
+        """
+        Shuts down the executor used to talk to the shards, then closes the
+        shards themselves.
+        """
+        self.executor.shutdown()
+
+        for shard in self.shards:
+            shard.close()
+
+    def shard_number(self, doc_id):
+        """
+        Given a ``doc_id``, returns the number of the shard it belongs in.
+        """
+        return int(self.shards[0].hash_name(str(doc_id)), 16) % len(self.shards)
+
+    def scatter(self, method_name, per_shard_args):
+        """
+        Calls ``method_name`` on every shard client in parallel.
+
+        ``per_shard_args`` should be a list (one per shard) of argument lists.
+
+        Returns a list of the responses, in shard order.
+        """
+        futures = []
+
+        for client, args in zip(self.clients, per_shard_args):
+            futures.append(self.executor.submit(call_shard, client, method_name, *args))
+
+        return [future.result() for future in futures]
+
+    def index(self, doc_id, document):
+        """
+        Given a ``doc_id`` string & a ``document`` dict, indexes the document
+        in the appropriate shard.
+        """
+        doc_id = str(doc_id)
+        return self.clients[self.shard_number(doc_id)].index(doc_id, document)
+
+    def bulk_index(self, documents):
+        """
+        Given an iterable of ``(doc_id, document)`` pairs, splits them up by
+        shard & indexes them on all the shards in parallel.
+
+        Returns the number of documents indexed.
+        """
+        per_shard_docs = [[] for shard in self.shards]
+
+        for doc_id, document in documents:
+            doc_id = str(doc_id)
+            per_shard_docs[self.shard_number(doc_id)].append((doc_id, document))
+
+        return sum(self.scatter('bulk_index', [[docs] for docs in per_shard_docs]))
+
+    def get_total_docs(self):
+        """
+        Returns the total number of documents across all the shards.
+        """
+        return sum(self.scatter('get_total_docs', [[] for client in self.clients]))
+
+    def check_index(self, repair=False, workers=None):
+        """
+        Checks (& optionally repairs) all the shards in parallel.
+
+        Takes the same parameters & returns the same data as
+        ``Microsearch.check_index``, combined across the shards.
+        """
+        report = {
+            'segments': 0,
+            'problems': [],
+            'repaired': [],
+        }
+
+        for shard_report in self.scatter('check_index', [[repair, workers] for client in self.clients]):
+            report['segments'] += shard_report['segments']
+            report['problems'].extend(shard_report['problems'])
+            report['repaired'].extend(shard_report['repaired'])
+
+        return report
+
+    def compact(self):
+        """
+        Compacts all the shards in parallel.
+
+        Returns the number of segments rewritten.
+        """
+        return sum(self.scatter('compact', [[] for client in self.clients]))
+
+    def load_document(self, doc_id):
+        """
+        Given a ``doc_id`` string, loads a given document from its shard.
+        """
+        return self.clients[self.shard_number(doc_id)].load_document(doc_id)
+
+    def search(self, query, offset=0, limit=20):
+        """
+        Given a ``query``, performs a search on all the shards & returns the
+        merged results.
+
+        Takes the same parameters & returns the same data as
+        ``Microsearch.search``.
+        """
+        results = {
+            'total_hits': 0,
+            'results': []
+        }
+
+        if not len(query):
+            return results
+
+        terms = list(self.shards[0].parse_query(query))
+        no_args = [[terms] for client in self.clients]
+
+        # Gather the global stats.
+        total_docs = 0
+        per_term_docs = dict([(term, 0) for term in terms])
+
+        for stats in self.scatter('shard_stats', no_args):
+            total_docs += stats['total_docs']
+
+            for term, count in stats['per_term_docs'].items():
+                per_term_docs[term] += count
+
+        if total_docs == 0:
+            return results
+
+        # Each shard only needs to send back enough to fill this page.
+        top_k = offset + limit
+        shard_args = [[terms, per_term_docs, total_docs, top_k] for client in self.clients]
+        all_hits = []
+
+        for shard_results in self.scatter('shard_search', shard_args):
+            results['total_hits'] += shard_results['total_hits']
+            all_hits.extend(shard_results['hits'])
+
+        top_hits = heapq.nlargest(top_k, all_hits, key=lambda hit: hit[1])
+
+        for doc_id, score in top_hits[offset:offset + limit]:
+            doc_dict = self.load_document(doc_id)
+            doc_dict.update({
+                'id': doc_id,
+                'score': score,
+            })
+            results['results'].append(doc_dict)
+
+        return results
+
+
+class SqliteMicrosearch(Microsearch):
+    """
+    A ``Microsearch`` that keeps everything in a single SQLite database.
+
+    The stock layout scatters the index over a huge number of small segment
+    files (& one file per document), which makes the filesystem the
+    bottleneck on big indexes. This variant stores the postings, documents &
+    stats as rows in one file instead, so lookups become keyed B-tree reads.
+
+    Typical usage::
+
+        ms = microsearch.SqliteMicrosearch('/tmp/microsearch')
+        ms.bulk_index([
+            ('email_1', {'text': "This is a blob of text to be indexed."}),
+            ('email_2', {'text': "And another blob."}),
+        ])
+        ms.search('blob')
+
+    """
+    SEGMENT_FILES = False
+    # How many terms' postings a reader (see ``refresh``) keeps in memory.
+    TERM_CACHE_SIZE = 65536
+
+    def __init__(self, base_directory, db_name='microsearch.db', **kwargs):
+        """
+        Sets up the object & the database.
+
+        Requires a ``base_directory`` parameter, which specifies the parent
+        directory the database will be kept in.
+
+        Optionally accepts a ``db_name`` parameter, which controls the
+        filename of the database. Default is ``microsearch.db``.
+
+        Any other keyword arguments are passed along to ``Microsearch``.
+        """
+        self.db_path = os.path.join(base_directory, db_name)
+        self.connections = threading.local()
+        self.connections_lock = threading.Lock()
+        self.open_connections = []
+        super(SqliteMicrosearch, self).__init__(base_directory, **kwargs)
+
+    def setup(self):
+        """
+        Handles the creation of the data directory & the database tables.
+        """
+        if not os.path.exists(self.base_directory):
+            os.makedirs(self.base_directory)
+
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS postings (term TEXT PRIMARY KEY, info TEXT NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS documents (doc_id TEXT PRIMARY KEY, data TEXT NOT NULL)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, data TEXT NOT NULL)')
+        return True
+
+    @property
+    def connection(self):
+        """
+        The database connection for the current thread.
+
+        Every thread gets a connection of its own (opened the first time it
+        needs one), so one thread's transaction never takes in another's
+        writes, & searches see only what's been committed. Connections left
+        by threads that have since finished get closed as new ones open.
+        """
+        connection = getattr(self.connections, 'connection', None)
+
+        if connection is None:
+            # We manage the transactions ourselves (see ``transaction``), so
+            # ``sqlite3``'s implicit ones are turned off. ``close`` may run
+            # on any thread, hence ``check_same_thread``.
+            connection = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.connections.connection = connection
+
+            with self.connections_lock:
+                still_open = []
+
+                for thread, other in self.open_connections:
+                    if thread.is_alive():
+                        still_open.append((thread, other))
+                    else:
+                        other.close()
+
+                still_open.append((threading.current_thread(), connection))
+                self.open_connections = still_open
+
+        return connection
+
+    @property
+    def transaction_depth(self):
+        """
+        How deeply nested the current thread's transactions are (see
+        ``transaction``).
+        """
+        return getattr(self.connections, 'transaction_depth', 0)
+
+    @transaction_depth.setter
+    def transaction_depth(self, depth):
+        self.connections.transaction_depth = depth
+
+    def __getstate__(self):
+        # Connections can't be pickled either, so a copy sent to another
+        # process (by a process pool, say) opens its own.
+        state = super(SqliteMicrosearch, self).__getstate__()
+        del state['connections']
+        del state['connections_lock']
+        state['open_connections'] = []
+        return state
+
+    def __setstate__(self, state):
+        super(SqliteMicrosearch, self).__setstate__(state)
+        self.connections = threading.local()
+        self.connections_lock = threading.Lock()
+        self.setup()
+
+    def segment_names(self):
+        """
+        Returns a list of the segments. All the postings are in one table, so
+        the database is the only one.
+        """
+        return [self.db_path]
+
+    def iter_segment_records(self, seg_name):
+        """
+        Yields the raw ``(term, term_info)`` records from the postings table,
+        in order.
+        """
+        for row in self.connection.execute('SELECT term, info FROM postings ORDER BY term').fetchall():
+            yield tuple(row)
+
+    def write_segment(self, seg_name, term_infos):
+        """
+        Replaces the entire contents of the postings table with the given
+        dict of ``term_infos``.
+        """
+        with self.transaction():
+            self.connection.execute('DELETE FROM postings')
+            self.connection.executemany(
+                'INSERT INTO postings (term, info) VALUES (?, ?)',
+                [(term, json.dumps(term_info, ensure_ascii=False)) for term, term_info in term_infos.items()]
+            )
+
+        return True
+
+    def check_index(self, repair=False, workers=None):
+        """
+        Checks the whole index for damage.
+
+        On top of the checks ``Microsearch`` does, SQLite's own
+        ``integrity_check`` is run over the database. That kind of damage
+        can't be repaired from here (restore a snapshot instead).
+        """
+        rows = self.connection.execute('PRAGMA integrity_check').fetchall()
+        report = super(SqliteMicrosearch, self).check_index(repair=repair, workers=workers)
+
+        if [row[0] for row in rows] != ['ok']:
+            for row in reversed(rows):
+                report['problems'].insert(0, {'segment': self.db_path, 'problem': row[0]})
+
+        return report
+
+    def compact(self):
+        """
+        Tidies up the postings (see ``rebuild_segment``), then has SQLite
+        reclaim the free space in the database.
+
+        Returns the number of segments rewritten.
+        """
+        with self.write_lock:
+            count = super(SqliteMicrosearch, self).compact()
+            # ``VACUUM`` can't run inside a transaction.
+            self.connection.execute('VACUUM')
+            self.connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+        return count
+
+    def snapshot_files(self):
+        """
+        Returns a sorted list of the paths (relative to the
+        ``base_directory``) of every file that makes up the index.
+
+        The write-ahead log gets folded into the database first, so the
+        database file alone is complete.
+        """
+        self.connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        wal_suffixes = ('-wal', '-shm', '-journal')
+        return [path for path in super(SqliteMicrosearch, self).snapshot_files() if not path.endswith(wal_suffixes)]
+
+    def close(self):
+        """
+        Closes every thread's database connection.
+        """
+        with self.connections_lock:
+            for thread, connection in self.open_connections:
+                connection.close()
+
+            self.open_connections = []
+            self.connections = threading.local()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        A context manager that wraps the enclosed writes in a transaction.
+
+        These nest, with only the outermost one actually committing. This is
+        what lets ``bulk_index`` write an entire batch in a single
+        transaction, rather than one per term.
+        """
+        if self.transaction_depth == 0:
+            # Take the write lock up front, so another connection's writes
+            # wait their turn rather than failing midway.
+            self.connection.execute('BEGIN IMMEDIATE')
+
+        self.transaction_depth += 1
+
+        try:
+            yield
+        except:
+            self.transaction_depth -= 1
+
+            if self.transaction_depth == 0:
+                self.connection.execute('ROLLBACK')
+                self.pending_commits = []
+
+            raise
+
+        self.transaction_depth -= 1
+
+        if self.transaction_depth == 0:
+            self.connection.execute('COMMIT')
+
+            if not self.commits_deferred():
+                self.flush_commits()
+
+    def read_stats(self):
+        """
+        Reads the index-wide stats.
+
+        If the stats do not exist, it makes returns data with the current
+        version of ``microsearch`` & zero docs (used in scoring).
+
+        Once warmed up (see ``warmup``), the stats come from memory instead.
+        """
+        if self.stats_cache is not None:
+            return json.loads(json.dumps(self.stats_cache))
+
+        row = self.connection.execute("SELECT data FROM stats WHERE name = 'stats'").fetchone()
+
+        if row is None:
+            return {
+                'version': '.'.join([str(bit) for bit in __version__]),
+                'total_docs': 0,
+            }
+
+        return json.loads(row[0])
+
+    def write_stats(self, new_stats):
+        """
+        Writes the index-wide stats.
+        """
+        with self.transaction():
+            self.connection.execute(
+                "INSERT OR REPLACE INTO stats (name, data) VALUES ('stats', ?)",
+                (json.dumps(new_stats),)
+            )
+
+        if self.stats_cache is not None:
+            self.stats_cache = new_stats
+
+        return True
+
+    def make_segment_name(self, term):
+        """
+        Every term lives in the database, so this returns its path.
+        """
+        return self.db_path
+
+    def commits_deferred(self):
+        """
+        Returns ``True`` if commits are being held back (see
+        ``Microsearch.batch``).
+
+        Within a transaction, they also wait for it to be committed, so
+        readers never see a generation whose writes they can't read yet.
+        """
+        return self.transaction_depth > 0 or self.batch_depth > 0
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Like ``Microsearch.batch``, but the whole batch is also one
+        transaction.
+        """
+        with self.write_lock, self.transaction(), super(SqliteMicrosearch, self).batch():
+            yield
+
+    def save_segment(self, term, term_info, update=False):
+        """
+        Writes out new index data for a ``term``.
+
+        Optionally takes an ``update`` parameter, which is a boolean &
+        determines whether the provided ``term_info`` should overwrite or
+        update the stored data. Default is ``False`` (overwrite).
+        """
+        self.postings_cache.pop(term, None)
+
+        with self.transaction():
+            if update:
+                # Straight from the table, as a reader's cached copy (see
+                # ``read_segment_terms``) may be out of date.
+                row = self.connection.execute('SELECT info FROM postings WHERE term = ?', (term,)).fetchone()
+                existing = json.loads(row[0]) if row is not None else {}
+                term_info = self.update_term_info(existing, term_info)
+
+            self.connection.execute(
+                'INSERT OR REPLACE INTO postings (term, info) VALUES (?, ?)',
+                (term, json.dumps(term_info, ensure_ascii=False))
+            )
+
+        cached = self.segment_cache.get(self.db_path)
+
+        if cached is not None:
+            cached.pop(term, None)
+
+        return True
+
+    def read_segment(self, term):
+        """
+        Given a ``term``, reads the ``term_info`` associated with it from the
+        database.
+
+        If the term is not found, this returns an empty dict.
+        """
+        return self.read_segment_terms(self.db_path, [term]).get(term, {})
+
+    def read_segment_terms(self, seg_name, terms):
+        """
+        Given the ``seg_name`` (the database) & a list of ``terms``, reads all
+        of their ``term_info`` with as few queries as possible.
+
+        There's only the one "segment", so readers (see ``refresh``) keep the
+        most recently used ``TERM_CACHE_SIZE`` terms' postings in memory
+        instead, until the next commit.
+
+        Returns a dict of the terms that were found to their ``term_info``.
+        """
+        profiler = self.profiler
+        cached = None
+        raw_infos = []
+        missing = []
+        found = {}
+
+        if self.refresh_interval is not None:
+            cached = self.segment_cache.setdefault(self.db_path, collections.OrderedDict())
+
+        for term in sorted(set(terms)):
+            if cached is not None and term in cached:
+                cached.move_to_end(term)
+                profiler.incr('segment_cache_hits')
+
+                if cached[term] is not None:
+                    raw_infos.append((term, cached[term]))
+            else:
+                missing.append(term)
+
+        # Stay well under SQLite's limit on the number of parameters.
+        for start in range(0, len(missing), 500):
+            chunk = missing[start:start + 500]
+
+            with profiler.phase('segment_io'):
+                rows = self.connection.execute(
+                    'SELECT term, info FROM postings WHERE term IN ({0})'.format(', '.join(['?'] * len(chunk))),
+                    chunk
+                ).fetchall()
+
+            for term, term_info in rows:
+                profiler.incr('bytes_read', len(term_info.encode('utf-8')))
+                raw_infos.append((term, term_info))
+
+            if cached is not None:
+                rows = dict(rows)
+
+                for term in chunk:
+                    cached[term] = rows.get(term)
+
+                while len(cached) > self.TERM_CACHE_SIZE:
+                    cached.popitem(last=False)
+
+        for term, term_info in raw_infos:
+            with profiler.phase('json_decode'):
+                found[term] = json.loads(term_info)
+
+            profiler.incr('postings_decoded', len(found[term]))
+
+        return found
+
+    def save_document(self, doc_id, document):
+        """
+        Given a ``doc_id`` string & a ``document`` dict, stores the document.
+        """
+        with self.transaction():
+            self.connection.execute(
+                'INSERT OR REPLACE INTO documents (doc_id, data) VALUES (?, ?)',
+                (doc_id, json.dumps(document, ensure_ascii=False))
+            )
+
+        if self.document_cache is not None:
+            self.document_cache.discard(doc_id)
+
+        return True
+
+    def document_exists(self, doc_id):
+        """
+        Returns ``True`` if the document with the given ``doc_id`` is stored.
+        """
+        return self.connection.execute('SELECT 1 FROM documents WHERE doc_id = ?', (doc_id,)).fetchone() is not None
+
+    def count_documents(self):
+        """
+        Returns how many documents are actually stored.
+        """
+        return self.connection.execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+
+    def read_document(self, doc_id):
+        """
+        Given a ``doc_id`` string, reads the raw JSON of a document.
+
+        Raises a ``KeyError`` if the document no longer exists.
+        """
+        row = self.connection.execute('SELECT data FROM documents WHERE doc_id = ?', (doc_id,)).fetchone()
+
+        if row is None:
+            raise KeyError("Document '{0}' not found.".format(doc_id))
+
+        return row[0]
+
+    def index(self, doc_id, document):
+        """
+        Given a ``doc_id`` string & a ``document`` dict, does everything needed
+        to save & index the document for searching.
+
+        Everything happens in a single transaction.
+        """
+        with self.write_lock, self.transaction():
+            return super(SqliteMicrosearch, self).index(doc_id, document)
+
+    def bulk_index(self, documents):
+        """
+        Given an iterable of ``(doc_id, document)`` pairs, saves & indexes all
+        of them in a single transaction.
+
+        Returns the number of documents indexed.
+        """
+        with self.write_lock, self.transaction():
+            return super(SqliteMicrosearch, self).bulk_index(documents)
+
+
+class IndexManager(object):
+    """
+    Hands out the indexes of many tenants (one small index each), all kept
+    under one ``base_directory``.
+
+    Tenants are only opened when first used & stay open for later requests,
+    so the setup work happens once, not per request. At most ``max_open``
+    are kept open (closing the least recently used, which bounds the open
+    database connections for ``SqliteMicrosearch``), ones left unused for
+    ``idle_timeout`` seconds get closed & the open ones share a single
+    document cache budget equally.
+
+    Typical usage::
+
+        manager = microsearch.IndexManager('/tmp/tenants', max_open=100, document_cache_size=64 * 1024 * 1024)
+
+        with manager.using('acme') as ms:
+            ms.search('blob')
+
+    """
+    # Tenant names become directory names, so keep them tame.
+    TENANT_NAME = re.compile(r'^[\w.-]+$')
+
+    def __init__(self, base_directory, index_class=Microsearch, max_open=256, idle_timeout=300, document_cache_size=0, compressed_cache_size=0, **index_options):
+        """
+        Sets up the manager. No tenants get opened until they're used.
+
+        Requires a ``base_directory`` parameter, which specifies the parent
+        directory the tenant directories will be kept in.
+
+        Optionally accepts an ``index_class`` parameter, which is the class
+        used for each tenant. Default is ``Microsearch``.
+
+        Optionally accepts a ``max_open`` parameter, which is an integer of
+        how many tenants to keep open at once. Default is ``256``.
+
+        Optionally accepts an ``idle_timeout`` parameter, which is a number
+        of seconds a tenant can go unused before being closed. Default is
+        ``300``.
+
+        Optionally accepts a ``document_cache_size`` parameter, which is the
+        total number of bytes of documents to cache (see ``DocumentCache``),
+        split equally between the open tenants. Default is ``0`` (no cache).
+
+        Optionally accepts a ``compressed_cache_size`` parameter, which is the
+        total for the compressed tier, split the same way. Default is ``0``.
+
+        Any other keyword arguments (like ``fields``) are passed along to
+        each tenant.
+        """
+        self.base_directory = base_directory
+        self.index_class = index_class
+        self.max_open = max_open
+        self.idle_timeout = idle_timeout
+        self.document_cache_size = document_cache_size
+        self.compressed_cache_size = compressed_cache_size
+        self.index_options = index_options
+        # Tenant names to ``[index, last_used, leases]``, least recently used
+        # first.
+        self.open_tenants = collections.OrderedDict()
+        self.lock = threading.RLock()
+        self.opened = 0
+        self.closed = 0
+
+        if not os.path.exists(self.base_directory):
+            os.makedirs(self.base_directory)
+
+    def tenant_path(self, tenant):
+        """
+        Given a ``tenant`` name, returns the path to its directory.
+
+        Raises a ``ValueError`` for names that aren't safe as one.
+        """
+        if not self.TENANT_NAME.match(tenant) or tenant in ('.', '..'):
+            raise ValueError("'{0}' is not a valid tenant name.".format(tenant))
+
+        return os.path.join(self.base_directory, tenant)
+
+    def tenants(self):
+        """
+        Returns a sorted list of every tenant with an index on disk.
+        """
+        return sorted([name for name in os.listdir(self.base_directory) if os.path.isdir(os.path.join(self.base_directory, name))])
+
+    def get(self, tenant):
+        """
+        Given a ``tenant`` name, returns its index, opening (& creating) it if
+        needed.
+
+        The index may get closed to make room for others once this returns,
+        so prefer ``using`` when other threads are opening tenants too.
+        """
+        with self.lock:
+            now = time.time()
+            entry = self.open_tenants.get(tenant)
+
+            if entry is None:
+                cache_share = self.cache_share(len(self.open_tenants) + 1)
+                index = self.index_class(self.tenant_path(tenant), document_cache_size=cache_share[0], compressed_cache_size=cache_share[1], **self.index_options)
+                entry = self.open_tenants[tenant] = [index, now, 0]
+                self.opened += 1
+                self.close_idle(now)
+                self.evict()
+                self.share_caches()
+            else:
+                self.open_tenants.move_to_end(tenant)
+                entry[1] = now
+
+            return entry[0]
+
+    @contextlib.contextmanager
+    def using(self, tenant):
+        """
+        A context manager that provides a ``tenant``'s index, which won't get
+        closed while in use.
+        """
+        with self.lock:
+            index = self.get(tenant)
+            entry = self.open_tenants[tenant]
+            entry[2] += 1
+
+        try:
+            yield index
+        finally:
+            with self.lock:
+                entry[2] -= 1
+                entry[1] = time.time()
+
+    def close_tenant(self, tenant):
+        """
+        Closes a ``tenant``'s index, if it's open.
+        """
+        with self.lock:
+            entry = self.open_tenants.pop(tenant, None)
+
+            if entry is not None:
+                entry[0].close()
+                self.closed += 1
+                self.share_caches()
+
+    def close_idle(self, now=None):
+        """
+        Closes every tenant that hasn't been used for ``idle_timeout``
+        seconds (& isn't in use).
+
+        Returns a list of the tenants closed.
+        """
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            idle = [tenant for tenant, entry in self.open_tenants.items() if not entry[2] and now - entry[1] >= self.idle_timeout]
+
+            for tenant in idle:
+                self.close_tenant(tenant)
+
+        return idle
+
+    def evict(self):
+        """
+        Closes the least recently used tenants (that aren't in use) until at
+        most ``max_open`` are open. The most recently used one always stays.
+        """
+        with self.lock:
+            for tenant in list(self.open_tenants)[:-1]:
+                if len(self.open_tenants) <= self.max_open:
+                    break
+
+                if not self.open_tenants[tenant][2]:
+                    self.close_tenant(tenant)
+
+    def cache_share(self, open_count):
+        """
+        Returns each tenant's ``(document_cache_size, compressed_cache_size)``
+        share of the budget, with ``open_count`` tenants open.
+        """
+        open_count = max(open_count, 1)
+        return (self.document_cache_size // open_count, self.compressed_cache_size // open_count)
+
+    def share_caches(self):
+        """
+        Splits the cache budget equally between the open tenants, so none of
+        them can crowd out the rest.
+        """
+        if not self.document_cache_size:
+            return
 
-        It uses a similar hashing mechanism as ``make_segment_name``, using
-        the hash fragment to control the directory structure instead of the
-        filename.
+        with self.lock:
+            document_bytes, compressed_bytes = self.cache_share(len(self.open_tenants))
 
-        Returns the full filepath to the document.
+            for index, last_used, leases in self.open_tenants.values():
+                if index.document_cache is not None:
+                    index.document_cache.resize(document_bytes, compressed_bytes=compressed_bytes)
+
+    def stats(self):
         """
-        # Builds a path like ``BASE_DIR/documents/5d4140/hello.json``.
-        return os.path.join(self.docs_path, self.hash_name(doc_id), "{0}.json".format(doc_id))
+        Returns a dict of how many tenants are ``open`` & have been
+        ``opened``/``closed`` in total, plus the ``cache_bytes`` in use.
+        """
+        with self.lock:
+            caches = [entry[0].document_cache for entry in self.open_tenants.values() if entry[0].document_cache is not None]
 
-    def save_document(self, doc_id, document):
+            return {
+                'open': len(self.open_tenants),
+                'opened': self.opened,
+                'closed': self.closed,
+                'cache_bytes': sum([cache.size + cache.compressed_size for cache in caches]),
+            }
+
+    def close(self):
         """
-        Given a ``doc_id`` string & a ``document`` dict, writes the document to
-        disk.
+        Closes every open tenant.
+        """
+        with self.lock:
+            for tenant in list(self.open_tenants):
+                self.close_tenant(tenant)
 
-        Uses JSON as the serialization format.
+
+class MergeScheduler(object):
+    """
+    Scrubs an index's segments in a background thread, rather than all at
+    once (like ``Microsearch.compact``).
+
+    Segments join a backlog (see ``schedule``, or the ``scrub_interval``
+    option) & get worked through one at a time. Each one gets checked (see
+    ``Microsearch.check_segment``) without holding the write lock & only
+    the ones with problems get rewritten, so healthy segments only cost a
+    read. The work is throttled to ``io_rate`` bytes per second & to using
+    at most ``cpu_budget`` of the thread's time, so searches stay
+    responsive while it runs.
+
+    Only file-based indexes have segments to work through. SQLite keeps its
+    own B-tree in order, so use ``SqliteMicrosearch.compact`` instead.
+
+    Typical usage::
+
+        ms = microsearch.Microsearch('/tmp/microsearch')
+        scheduler = microsearch.MergeScheduler(ms, io_rate=4 * 1024 * 1024, cpu_budget=0.25, scrub_interval=3600)
+        scheduler.start()
+        scheduler.metrics()
+        scheduler.stop()
+
+    """
+    def __init__(self, ms, io_rate=None, cpu_budget=0.5, interval=1.0, scrub_interval=None):
         """
-        doc_path = self.make_document_name(doc_id)
-        base_path = os.path.dirname(doc_path)
+        Sets up the scheduler. Nothing runs until ``start`` is called.
 
-        if not os.path.exists(base_path):
-            os.makedirs(base_path)
+        Requires a ``ms`` parameter, which is the (writable) index to
+        maintain. Raises a ``ValueError`` if it doesn't keep its postings in
+        segment files.
 
-        with open(doc_path, 'w') as doc_file:
-            doc_file.write(json.dumps(document, ensure_ascii=False))
+        Optionally accepts an ``io_rate`` parameter, which is a number of
+        bytes per second that merging may read & write. Default is ``None``
+        (unlimited).
 
-        return True
+        Optionally accepts a ``cpu_budget`` parameter, which is the fraction
+        (between ``0`` & ``1``) of the time merging may keep busy. Default is
+        ``0.5``.
 
-    def load_document(self, doc_id):
+        Optionally accepts an ``interval`` parameter, which is how many
+        seconds to wait between checks for work. Default is ``1.0``.
+
+        Optionally accepts a ``scrub_interval`` parameter, which is how many
+        seconds to wait between scheduling every segment. Default is ``None``
+        (only what gets passed to ``schedule``).
+        """
+        if not 0 < cpu_budget <= 1:
+            raise ValueError('`cpu_budget` must be between 0 & 1.')
+
+        if not ms.SEGMENT_FILES:
+            raise ValueError("'{0}' doesn't keep its postings in segment files.".format(ms.base_directory))
+
+        self.ms = ms
+        self.io_rate = io_rate
+        self.cpu_budget = cpu_budget
+        self.interval = interval
+        self.scrub_interval = scrub_interval
+        self.scrubbed_at = None
+        # Segment paths waiting to be checked, oldest first.
+        self.backlog = collections.OrderedDict()
+        # Which documents exist, remembered until the backlog is cleared.
+        self.known_docs = {}
+        self.io_tokens = io_rate or 0
+        self.io_checked_at = time.time()
+        self.checked = 0
+        self.merged = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.busy_seconds = 0.0
+        self.throttled_seconds = 0.0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def schedule(self, seg_names=None):
         """
-        Given a ``doc_id`` string, loads a given document from disk.
+        Adds segments to the backlog.
 
-        Raises an exception if the document no longer exists.
+        Optionally accepts a ``seg_names`` parameter, which is a list of
+        segment paths. Default is ``None`` (every segment).
+        """
+        if seg_names is None:
+            seg_names = self.ms.segment_names()
 
-        Returns the document data as a dict.
+        with self.lock:
+            for seg_name in seg_names:
+                self.backlog[seg_name] = True
+
+    def throttle(self, io_bytes, busy):
         """
-        doc_path = self.make_document_name(doc_id)
+        Waits long enough to keep within the ``io_rate``, given that a merge
+        just read/wrote ``io_bytes`` & took ``busy`` seconds.
+        """
+        delay = busy * (1.0 - self.cpu_budget) / self.cpu_budget
 
-        with open(doc_path, 'r') as doc_file:
-            data = json.loads(doc_file.read())
+        if self.io_rate:
+            now = time.time()
+            # A token bucket, holding up to a second's worth.
+            self.io_tokens = min(self.io_rate, self.io_tokens + (now - self.io_checked_at) * self.io_rate) - io_bytes
+            self.io_checked_at = now
 
-        return data
+            if self.io_tokens < 0:
+                delay = max(delay, -self.io_tokens / float(self.io_rate))
 
+        if delay > 0:
+            self.throttled_seconds += delay
+            self.stop_event.wait(delay)
 
-    def index(self, doc_id, document):
+    def segment_version(self, seg_name):
         """
-        Given a ``doc_id`` string & a ``document`` dict, does everything needed
-        to save & index the document for searching.
+        Returns something that changes whenever a segment gets rewritten
+        (or ``None`` if it doesn't exist).
+        """
+        if not os.path.exists(seg_name):
+            return None
 
-        The ``document`` dict must have a ``text`` key, which should contain the
-        blob to be indexed. All other fields are simply stored.
+        return self.ms.file_version(os.stat(seg_name))
 
-        Returns ``True`` on success.
+    def run_once(self):
         """
-        # Ensure that the ``document`` looks like a dictionary.
-        if not hasattr(document, 'items'):
-            raise AttributeError('You must provide `index` with a document in the form of a dictionary.')
+        Checks the oldest segment in the backlog, rewriting it if it has any
+        problems.
 
-        # For example purposes, we only index the ``text`` field.
-        if not 'text' in document:
-            raise KeyError('You must provide `index` with a document with a `text` field in it.')
+        The segment gets read & tidied without the write lock. If it's been
+        written to in the meantime (or a document thought to be missing has
+        turned up), it goes back on the backlog instead.
 
-        # Make sure the document ID is a string.
-        doc_id = str(doc_id)
-        self.save_document(doc_id, document)
+        Returns ``False`` if the backlog was empty, ``True`` otherwise.
+        """
+        with self.lock:
+            if not self.backlog:
+                self.known_docs = {}
+                return False
+
+            seg_name = self.backlog.popitem(last=False)[0]
+
+        ms = self.ms
+        start_time = time.time()
+        version = self.segment_version(seg_name)
+        io_bytes = 0
+
+        if version is not None:
+            io_bytes = version[0]
+            self.bytes_read += io_bytes
+            self.checked += 1
+
+            if ms.check_segment(seg_name, self.known_docs):
+                term_infos, misplaced = ms.tidy_segment(seg_name, self.known_docs)
+
+                with ms.write_lock:
+                    # Postings can land before their document does, so the
+                    # ones dropped for missing documents get double-checked.
+                    missing = [doc_id for doc_id, exists in self.known_docs.items() if not exists]
+                    revived = [doc_id for doc_id in missing if ms.document_exists(doc_id)]
+
+                    for doc_id in missing:
+                        del self.known_docs[doc_id]
+
+                    if revived or self.segment_version(seg_name) != version:
+                        self.schedule([seg_name])
+                    else:
+                        ms.write_segment(seg_name, term_infos)
 
-        # Start analysis & indexing.
-        tokens = self.make_tokens(document.get('text', ''))
-        terms = self.make_ngrams(tokens)
+                        for term, term_info in misplaced.items():
+                            ms.save_segment(term, term_info, update=True)
 
-        for term, positions in terms.items():
-            self.save_segment(term, {doc_id: positions}, update=True)
+                        written = os.path.getsize(seg_name)
 
-        self.increment_total_docs()
+                        if written == 0:
+                            os.remove(seg_name)
+
+                        ms.commit([seg_name] + [ms.make_segment_name(term) for term in misplaced])
+                        self.merged += 1
+                        self.bytes_written += written
+                        io_bytes += written
+
+        busy = time.time() - start_time
+        self.busy_seconds += busy
+        self.throttle(io_bytes, busy)
         return True
 
+    def run(self):
+        """
+        The body of the background thread: works until ``stop`` is called.
+        """
+        while not self.stop_event.is_set():
+            if self.scrub_interval is not None and (self.scrubbed_at is None or time.time() - self.scrubbed_at >= self.scrub_interval):
+                self.scrubbed_at = time.time()
+                self.schedule()
 
-    # =========
-    # Searching
-    # =========
+            if not self.run_once():
+                self.stop_event.wait(self.interval)
 
-    def parse_query(self, query):
+    def start(self):
         """
-        Given a ``query`` string, converts it into terms for searching in the
-        index.
+        Starts working in a background thread.
+        """
+        if self.thread is not None:
+            return
 
-        Returns a list of terms.
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name='microsearch-merges')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stops the background thread, waiting for any segment in progress to
+        finish.
         """
-        tokens = self.make_tokens(query)
-        return self.make_ngrams(tokens)
+        if self.thread is None:
+            return
 
-    def collect_results(self, terms):
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+
+    def metrics(self):
         """
-        For a list of ``terms``, collects all the documents from the index
-        containing those terms.
+        Returns a dict of how many segments have been ``checked`` &
+        ``merged`` (rewritten), the ``bytes_read`` & ``bytes_written``, the
+        number still in the ``backlog``, the ``throughput`` (in bytes per
+        second spent working) & the ``busy_seconds`` & ``throttled_seconds``.
+        """
+        with self.lock:
+            backlog = len(self.backlog)
+
+        return {
+            'checked': self.checked,
+            'merged': self.merged,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'backlog': backlog,
+            'throughput': (self.bytes_read + self.bytes_written) / self.busy_seconds if self.busy_seconds else 0.0,
+            'busy_seconds': self.busy_seconds,
+            'throttled_seconds': self.throttled_seconds,
+        }
 
-        The returned data is a tuple of two dicts. This is done to make the
-        process of scoring easy & require no further information.
 
-        The first dict contains all the terms as keys & a count (integer) of
-        the matching docs as values.
+# ======
+# Ingest
+# ======
 
-        The second dict inverts this, with ``doc_ids`` as the keys. The values
-        are a nested dict, which contains the ``terms`` as the keys and a
-        count of the number of positions within that doc.
+def iter_directory(path):
+    """
+    Given a directory ``path``, yields a ``(doc_id, document)`` pair for
+    every file under it, with the contents as the ``text``.
 
-        Since this is complex, an example return value::
+    The ``doc_id`` is the path relative to the directory, with ``.`` in place
+    of the slashes.
+    """
+    for directory, dirnames, filenames in os.walk(path):
+        dirnames.sort()
 
-            >>> per_term_docs, per_doc_counts = ms.collect_results(['hello', 'world'])
-            >>> per_term_docs
-            {
-                'hello': 2,
-                'world': 1
-            }
-            >>> per_doc_counts
-            {
-                'doc-1': {
-                    'hello': 4
-                },
-                'doc-2': {
-                    'hello': 1,
-                    'world': 3
-                }
-            }
+        for filename in sorted(filenames):
+            full_path = os.path.join(directory, filename)
+            doc_id = os.path.relpath(full_path, path).replace(os.sep, '.')
 
-        """
-        per_term_docs = {}
-        per_doc_counts = {}
+            with open(full_path, 'r', errors='replace') as doc_file:
+                yield doc_id, {'text': doc_file.read()}
 
-        for term in terms:
-            term_matches = self.load_segment(term)
 
-            per_term_docs.setdefault(term, 0)
-            per_term_docs[term] += len(term_matches.keys())
+def iter_jsonl(lines, id_field='id'):
+    """
+    Given an iterable of JSON ``lines``, yields a ``(doc_id, document)`` pair
+    for each one.
 
-            for doc_id, positions in term_matches.items():
-                per_doc_counts.setdefault(doc_id, {})
-                per_doc_counts[doc_id].setdefault(term, 0)
-                per_doc_counts[doc_id][term] += len(positions)
+    Optionally accepts an ``id_field`` parameter, which is the key holding
+    each document's ID (it's removed from the document). Default is ``id``.
+    """
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
 
-        return per_term_docs, per_doc_counts
+        document = json.loads(line)
 
-    def bm25_relevance(self, terms, matches, current_doc, total_docs, b=0, k=1.2):
-        """
-        Given multiple inputs, performs a BM25 relevance calculation for a
-        given document.
+        if not id_field in document:
+            raise KeyError("Line {0} has no '{1}' field.".format(line_number, id_field))
 
-        ``terms`` should be a list of terms.
+        doc_id = document.pop(id_field)
+        yield doc_id, document
 
-        ``matches`` should be the first dictionary back from
-        ``collect_results``.
 
-        ``current_doc`` should be the second dictionary back from
-        ``collect_results``.
+def iter_sources(sources, id_field='id'):
+    """
+    Given a list of ``sources`` (directories, ``.mbox`` files, ``.jsonl``
+    files or ``-`` for JSONL on stdin), yields every ``(doc_id, document)``
+    pair in them.
+    """
+    for source in sources:
+        if source == '-':
+            for pair in iter_jsonl(sys.stdin, id_field=id_field):
+                yield pair
+        elif os.path.isdir(source):
+            for pair in iter_directory(source):
+                yield pair
+        elif source.endswith('.mbox'):
+            with open(source, 'rb') as mbox_file:
+                for pair in iter_mbox(mbox_file):
+                    yield pair
+        else:
+            with open(source, 'r') as jsonl_file:
+                for pair in iter_jsonl(jsonl_file, id_field=id_field):
+                    yield pair
+
+
+def iter_mbox(mbox_file, id_prefix='message-'):
+    """
+    Given a binary ``mbox_file``, yields a ``(doc_id, document)`` pair for
+    every email in it.
 
-        ``total_docs`` should be an integer of the total docs in the index.
+    The file gets read a line at a time, so only one email is ever held in
+    memory, no matter how big the mailbox is. The ``document`` has the body
+    as the ``text``, plus the ``subject``, ``from`` & ``date`` headers.
 
-        Optionally accepts a ``b`` parameter, which is an integer specifying
-        the length of the document. Since it doesn't vastly affect the score,
-        the default is ``0``.
+    The ``doc_id`` is the ``Message-ID``. Optionally accepts an ``id_prefix``
+    parameter, which is used (along with the position in the mailbox) for
+    emails without one. Default is ``message-``.
+    """
+    lines = []
+    count = 0
 
-        Optionally accepts a ``k`` parameter. It accepts a float & is used to
-        modify scores to fall into a given range. With the default of ``1.2``,
-        scores typically range from ``0.4`` to ``1.0``.
-        """
-        # More or less borrowed from http://sphinxsearch.com/blog/2010/08/17/how-sphinx-relevance-ranking-works/.
-        score = b
+    for line in mbox_file:
+        if line.startswith(b'From '):
+            if lines:
+                yield parse_email(b''.join(lines), '{0}{1}'.format(id_prefix, count))
+                count += 1
 
-        for term in terms:
-            idf = math.log((total_docs - matches[term] + 1.0) / matches[term]) / math.log(1.0 + total_docs)
-            score = score + current_doc.get(term, 0) * idf / (current_doc.get(term, 0) + k)
+            lines = []
+            continue
 
-        return 0.5 + score / (2 * len(terms))
+        if line.startswith(b'>') and line.lstrip(b'>').startswith(b'From '):
+            # Undo the quoting mbox does to body lines that look like the
+            # start of an email.
+            line = line[1:]
 
-    def search(self, query, offset=0, limit=20):
-        """
-        Given a ``query``, performs a search on the index & returns the results.
+        lines.append(line)
 
-        Optionally accepts an ``offset`` parameter, which is an integer &
-        controls what the starting point in the results is. Default is ``0``
-        (the beginning).
+    if lines:
+        yield parse_email(b''.join(lines), '{0}{1}'.format(id_prefix, count))
 
-        Optionally accepts a ``limit`` parameter, which is an integer &
-        controls how many results to return. Default is ``20``.
 
-        Returns a dictionary containing the ``total_hits`` (integer), which is
-        a count of all the documents that matched, and ``results``, which is
-        a list of results (in descending ``score`` order) & sliced to the
-        provided ``offset/limit`` combination.
-        """
-        results = {
-            'total_hits': 0,
-            'results': []
+def parse_email(raw_email, default_id):
+    """
+    Given the bytes of a ``raw_email``, returns a ``(doc_id, document)``
+    pair for it (see ``iter_mbox``).
+    """
+    message = email.parser.BytesParser(policy=email.policy.default).parsebytes(raw_email)
+    body = message.get_body(preferencelist=('plain',))
+    document = {'text': ''}
+
+    if body is not None:
+        try:
+            document['text'] = body.get_content()
+        except (LookupError, UnicodeError):
+            document['text'] = body.get_payload(decode=True).decode('utf-8', 'replace')
+
+    for header in ('subject', 'from', 'date'):
+        if message[header] is not None:
+            document[header] = str(message[header])
+
+    # Document IDs end up in filenames.
+    doc_id = str(message['message-id'] or '').strip().strip('<>').replace('/', '.')
+    return doc_id or default_id, document
+
+
+def stream_index(ms, documents, batch_size=500, queue_size=4, progress=None):
+    """
+    Indexes an iterable of ``(doc_id, document)`` pairs of any size, with
+    flat memory use.
+
+    The ``documents`` get read & batched up by a separate thread, while
+    the batches get indexed (via ``bulk_index``) on this one. The two are
+    joined by a bounded queue, so reading stalls whenever indexing falls
+    behind, rather than piling up documents.
+
+    Optionally accepts a ``batch_size`` parameter, which is how many
+    documents go in a batch. Default is ``500``.
+
+    Optionally accepts a ``queue_size`` parameter, which is how many batches
+    can be waiting at once. Default is ``4``.
+
+    Optionally accepts a ``progress`` parameter, which should be a callable.
+    If provided, it's called with the running total after every batch.
+    Default is ``None``.
+
+    Returns the number of documents indexed.
+    """
+    batches = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    errors = []
+
+    def put(batch):
+        while not stop.is_set():
+            try:
+                batches.put(batch, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def produce():
+        try:
+            pairs = iter(documents)
+
+            while not stop.is_set():
+                batch = list(itertools.islice(pairs, batch_size))
+
+                if not batch or not put(batch):
+                    break
+        except Exception as e:
+            errors.append(e)
+        finally:
+            put(None)
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    total = 0
+    finished = False
+
+    try:
+        while True:
+            batch = batches.get()
+
+            if batch is None:
+                break
+
+            total += ms.bulk_index(batch)
+
+            if progress is not None:
+                progress(total)
+
+        finished = True
+    finally:
+        stop.set()
+
+        if finished:
+            producer.join()
+        else:
+            # The producer may be stuck reading (from ``stdin``, say), so
+            # don't wait on it. It's a daemon, so it won't hold up exiting.
+            producer.join(timeout=1.0)
+
+    if errors:
+        raise errors[0]
+
+    return total
+
+
+# ============
+# Command Line
+# ============
+
+
+def detect_backend(directory):
+    """
+    Given the ``directory`` of an index (sharded or not), returns the name of
+    the backend it was built with, or ``None`` if there's no index there yet.
+    """
+    for path in [directory, os.path.join(directory, 'shard-000')]:
+        if os.path.exists(os.path.join(path, 'microsearch.db')):
+            return 'sqlite'
+
+        if os.path.exists(os.path.join(path, 'stats.json')):
+            return 'file'
+
+    return None
+
+
+def open_index(options):
+    """
+    Opens the index described by the command line ``options``.
+
+    Sharded indexes are used if ``--shards`` is given or the directory
+    already holds one. Without ``--backend``, an existing SQLite index is
+    detected (by its ``microsearch.db``), & it's an error to ask for the
+    file backend on one.
+    """
+    shard_class = Microsearch
+    backend = options.backend
+    existing = detect_backend(options.directory)
+
+    if backend is None:
+        backend = existing or 'file'
+    elif existing is not None and backend != existing:
+        raise ValueError("The index in '{0}' uses the {1} backend, not {2}.".format(options.directory, existing, backend))
+
+    if backend == 'sqlite':
+        shard_class = SqliteMicrosearch
+
+    kwargs = {}
+
+    if options.fields:
+        kwargs['fields'] = options.fields
+
+    if options.segment_buckets:
+        kwargs['segment_buckets'] = options.segment_buckets
+
+    if options.shards or os.path.exists(os.path.join(options.directory, 'shards.json')):
+        return ShardedMicrosearch(options.directory, shards=options.shards, shard_class=shard_class, **kwargs)
+
+    return shard_class(options.directory, **kwargs)
+
+
+def command_index(ms, options):
+    sources = options.sources or ['-']
+    documents = iter_sources(sources, id_field=options.id_field)
+    start = time.time()
+
+    def progress(total):
+        if not options.quiet:
+            elapsed = time.time() - start
+            print('Indexed {0} documents ({1:.1f} docs/sec)'.format(total, total / max(elapsed, 1e-9)), file=sys.stderr)
+
+    total = stream_index(ms, documents, batch_size=options.batch_size, queue_size=options.queue_size, progress=progress)
+    elapsed = time.time() - start
+    print(json.dumps({'indexed': total, 'seconds': round(elapsed, 3), 'docs_per_second': round(total / max(elapsed, 1e-9), 1)}))
+    return 0
+
+
+def command_search(ms, options):
+    queries = options.queries or [line.rstrip('\n') for line in sys.stdin]
+
+    for query in queries:
+        start = time.time()
+        results = ms.search(query, offset=options.offset, limit=options.limit)
+        elapsed = time.time() - start
+
+        if options.json:
+            results['query'] = query
+            print(json.dumps(results, ensure_ascii=False))
+        else:
+            for result in results['results']:
+                print('{0:.6f}\t{1}'.format(result['score'], result['id']))
+
+        if not options.quiet:
+            print('{0!r}: {1} hits in {2:.2f}ms'.format(query, results['total_hits'], elapsed * 1000), file=sys.stderr)
+
+    return 0
+
+
+def command_stats(ms, options):
+    if isinstance(ms, ShardedMicrosearch):
+        stats = {
+            'shards': len(ms.shards),
+            'total_docs': ms.get_total_docs(),
         }
+    else:
+        stats = ms.read_stats()
+        stats['segments'] = len(ms.segment_names())
 
-        if not len(query):
-            return results
+    disk_usage = 0
 
-        total_docs = self.get_total_docs()
+    for directory, dirnames, filenames in os.walk(options.directory):
+        for filename in filenames:
+            disk_usage += os.path.getsize(os.path.join(directory, filename))
 
-        if total_docs == 0:
-            return results
+    stats['disk_usage'] = disk_usage
+    print(json.dumps(stats, sort_keys=True))
+    return 0
 
-        terms = self.parse_query(query)
-        per_term_docs, per_doc_counts = self.collect_results(terms)
-        scored_results = []
-        final_results = []
 
-        # Score the results per document.
-        for doc_id, current_doc in per_doc_counts.items():
-            scored_results.append({
-                'id': doc_id,
-                'score': self.bm25_relevance(terms, per_term_docs, current_doc, total_docs),
-            })
+def command_compact(ms, options):
+    print(json.dumps({'segments': ms.compact()}))
+    return 0
 
-        # Sort based on score.
-        sorted_results = sorted(scored_results, key=lambda res: res['score'], reverse=True)
-        results['total_hits'] = len(sorted_results)
 
-        # Slice the results.
-        sliced_results = sorted_results[offset:offset + limit]
+def command_check(ms, options):
+    report = ms.check_index(repair=options.repair, workers=options.workers)
+    print(json.dumps(report, ensure_ascii=False))
 
-        # For each result, load up the doc & update the dict.
-        for res in sliced_results:
-            doc_dict = self.load_document(res['id'])
-            doc_dict.update(res)
-            results['results'].append(doc_dict)
+    if report['problems'] and not options.repair:
+        return 1
 
-        return results
+    return 0
+
+
+def make_parser():
+    index_options = argparse.ArgumentParser(add_help=False)
+    index_options.add_argument('directory', help='The directory the index is kept in.')
+    index_options.add_argument('--backend', choices=['file', 'sqlite'], default=None, help='Storage backend to use (only needed when creating an index). Default is file.')
+    index_options.add_argument('--shards', type=int, default=None, help='Number of shards (only needed when creating a sharded index).')
+    index_options.add_argument('--segment-buckets', type=int, default=None, help='Number of segment files (only needed when creating an index).')
+    index_options.add_argument('--field', dest='fields', action='append', default=None, help='A field to index (repeatable). Default is just text.')
+    index_options.add_argument('--quiet', action='store_true', help="Don't report progress on stderr.")
+
+    parser = argparse.ArgumentParser(prog='microsearch', description='Index & search with microsearch.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    index_parser = subparsers.add_parser('index', parents=[index_options], help='Bulk index documents.')
+    index_parser.add_argument('sources', nargs='*', help='Directories, mbox files, JSONL files or - for JSONL on stdin (the default).')
+    index_parser.add_argument('--id-field', default='id', help='The JSONL field holding the document ID.')
+    index_parser.add_argument('--batch-size', type=int, default=500, help='Documents per bulk indexing batch.')
+    index_parser.add_argument('--queue-size', type=int, default=4, help='Batches that can be read ahead of the indexing.')
+    index_parser.set_defaults(handler=command_index)
+
+    search_parser = subparsers.add_parser('search', parents=[index_options], help='Run queries, reporting the latency.')
+    search_parser.add_argument('queries', nargs='*', help='Queries to run. Default is one per line from stdin.')
+    search_parser.add_argument('--offset', type=int, default=0)
+    search_parser.add_argument('--limit', type=int, default=20)
+    search_parser.add_argument('--json', action='store_true', help='Print the full results as JSON lines.')
+    search_parser.set_defaults(handler=command_search)
+
+    stats_parser = subparsers.add_parser('stats', parents=[index_options], help='Show the index stats.')
+    stats_parser.set_defaults(handler=command_stats)
+
+    compact_parser = subparsers.add_parser('compact', parents=[index_options], help='Rewrite the segments in their tidiest form.')
+    compact_parser.set_defaults(handler=command_compact)
+
+    check_parser = subparsers.add_parser('check', parents=[index_options], help='Check the index for damage.')
+    check_parser.add_argument('--repair', action='store_true', help='Fix whatever can be fixed.')
+    check_parser.add_argument('--workers', type=int, default=None, help='How many segments to check at once.')
+    check_parser.set_defaults(handler=command_check)
+
+    # Only here for the help, as ``main`` hands these off to
+    # ``microsearch_bench``.
+    subparsers.add_parser('bench', help='Run the benchmark (see microsearch_bench.py).')
+    return parser
+
+
+def main(argv=None):
+    """
+    The ``microsearch`` command.
+
+    Run ``microsearch --help`` for the details.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+
+    if argv[:1] == ['bench']:
+        # Everything after ``bench`` belongs to the benchmark's own parser.
+        import microsearch_bench
+        return microsearch_bench.main(argv[1:])
+
+    options = make_parser().parse_args(argv)
+    ms = open_index(options)
+
+    try:
+        return options.handler(ms, options)
+    finally:
+        ms.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
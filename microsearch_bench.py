@@ -0,0 +1,467 @@
+"""
+A reproducible benchmark for ``microsearch``.
+
+Works entirely offline, by generating a seeded synthetic corpus (with a
+Zipfian term distribution, like real text). Indexing is measured one document
+at a time, in bulk & in parallel (sharded), followed by a mix of queries
+(single term, multi-term, prefix & paging) & deep pagination.
+
+How to run:
+
+    python microsearch_bench.py
+    python microsearch_bench.py --docs 5000 --output run.json
+    python microsearch_bench.py --compare run.json
+
+Once installed, ``microsearch bench`` takes the same arguments.
+
+To benchmark against real data instead (for instance, the Enron corpus from
+http://www.cs.cmu.edu/~enron/), point it at a directory of emails:
+
+    python microsearch_bench.py --maildir </path/to/enron_mail_20110402/maildir>
+
+"""
+import argparse
+import contextlib
+import gc
+import glob
+import json
+import os
+import random
+import shutil
+import sys
+import time
+import microsearch
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows.
+    resource = None
+
+
+WORKLOADS = ['index_single', 'index_bulk', 'index_parallel', 'query_single', 'query_multi', 'query_prefix', 'query_paging', 'deep_pagination']
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+# ==============
+# Corpus Helpers
+# ==============
+
+def make_vocabulary(rng, size, min_length=3, max_length=10):
+    """
+    Generates a list of ``size`` unique, made-up words.
+
+    The words are in rank order (the first is the most frequent).
+    """
+    vocabulary = []
+    seen = set(microsearch.Microsearch.STOP_WORDS)
+
+    while len(vocabulary) < size:
+        length = rng.randint(min_length, max_length)
+        word = ''.join([rng.choice(LETTERS) for i in range(length)])
+
+        if not word in seen:
+            seen.add(word)
+            vocabulary.append(word)
+
+    return vocabulary
+
+
+def zipf_weights(size, exponent=1.1):
+    """
+    Returns the cumulative Zipfian weights for a vocabulary of ``size`` words.
+    """
+    cumulative = []
+    total = 0.0
+
+    for rank in range(1, size + 1):
+        total += 1.0 / (rank ** exponent)
+        cumulative.append(total)
+
+    return cumulative
+
+
+def make_corpus(vocabulary, num_docs, min_words=50, max_words=300, exponent=1.1, seed=42):
+    """
+    Generates ``num_docs`` synthetic ``(doc_id, document)`` pairs.
+
+    The same ``seed`` always produces the same corpus.
+    """
+    rng = random.Random(seed)
+    cumulative = zipf_weights(len(vocabulary), exponent)
+
+    for doc_number in range(num_docs):
+        length = rng.randint(min_words, max_words)
+        words = rng.choices(vocabulary, cum_weights=cumulative, k=length)
+        yield 'doc_{0}'.format(doc_number), {
+            'text': ' '.join(words),
+            'created': '2012-02-{0:02d}T12:00:00-0000'.format(doc_number % 28 + 1),
+        }
+
+
+def load_maildir(maildir, num_docs):
+    """
+    Loads up to ``num_docs`` emails from an Enron-style ``maildir``.
+    """
+    all_emails = sorted(glob.glob(os.path.join(maildir, '*/*/*.')))[:num_docs]
+
+    for email_filepath in all_emails:
+        with open(email_filepath, 'r', errors='replace') as raw_email:
+            doc_id = os.path.relpath(email_filepath, maildir).replace('/', '.')
+            yield doc_id, {'text': raw_email.read()}
+
+
+def make_queries(rng, vocabulary, kind, count):
+    """
+    Generates ``count`` queries of the given ``kind``.
+
+    Query terms are drawn from the more common half of the vocabulary, so
+    that most queries actually match something.
+    """
+    common = vocabulary[:max(1, len(vocabulary) // 2)]
+    queries = []
+
+    for i in range(count):
+        if kind == 'multi':
+            queries.append(' '.join(rng.sample(common, min(3, len(common)))))
+        elif kind == 'prefix':
+            queries.append(rng.choice(common)[:3])
+        else:
+            queries.append(rng.choice(common))
+
+    return queries
+
+
+# ===============
+# Measuring Tools
+# ===============
+
+def percentile(sorted_timings, percent):
+    """
+    Returns the given ``percent`` (nearest-rank) of some ``sorted_timings``.
+    """
+    if not sorted_timings:
+        return 0.0
+
+    rank = int(round(percent / 100.0 * len(sorted_timings) + 0.5)) - 1
+    return sorted_timings[min(max(rank, 0), len(sorted_timings) - 1)]
+
+
+def summarize(timings, operations, elapsed):
+    """
+    Turns a list of per-operation ``timings`` into summary stats.
+    """
+    sorted_timings = sorted(timings)
+    return {
+        'operations': operations,
+        'elapsed': elapsed,
+        'throughput': operations / elapsed if elapsed else 0.0,
+        'p50': percentile(sorted_timings, 50),
+        'p95': percentile(sorted_timings, 95),
+        'p99': percentile(sorted_timings, 99),
+        'max': sorted_timings[-1] if sorted_timings else 0.0,
+    }
+
+
+def disk_usage(path):
+    """
+    Returns the total bytes & the number of files under ``path``.
+    """
+    total_bytes = 0
+    total_files = 0
+
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            total_bytes += os.path.getsize(os.path.join(dirpath, filename))
+            total_files += 1
+
+    return total_bytes, total_files
+
+
+def peak_rss():
+    """
+    Returns the peak resident set size of the process, in bytes.
+    """
+    if resource is None:
+        return None
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports kilobytes, OS X reports bytes.
+    if sys.platform != 'darwin':
+        max_rss *= 1024
+
+    return max_rss
+
+
+@contextlib.contextmanager
+def track_gc():
+    """
+    Records the garbage collector's pauses for the duration of the block.
+
+    Yields a dict of the number of ``collections`` & their total ``pause``
+    (in seconds), which is kept up to date.
+    """
+    stats = {'collections': 0, 'pause': 0.0}
+    started = [0.0]
+
+    def callback(phase, info):
+        if phase == 'start':
+            started[0] = time.time()
+        else:
+            stats['collections'] += 1
+            stats['pause'] += time.time() - started[0]
+
+    gc.callbacks.append(callback)
+
+    try:
+        yield stats
+    finally:
+        gc.callbacks.remove(callback)
+
+
+def timed(func, *args, **kwargs):
+    """
+    Runs ``func`` & returns how long it took.
+    """
+    start_time = time.time()
+    func(*args, **kwargs)
+    return time.time() - start_time
+
+
+# =========
+# Workloads
+# =========
+
+def make_index(options, name, shards=None):
+    """
+    Creates a fresh index for a workload.
+    """
+    path = os.path.join(options.directory, name)
+    shutil.rmtree(path, ignore_errors=True)
+
+    index_class = microsearch.Microsearch
+
+    if options.backend == 'sqlite':
+        index_class = microsearch.SqliteMicrosearch
+
+    if shards:
+        return microsearch.ShardedMicrosearch(path, shards=shards, shard_class=index_class)
+
+    return index_class(path)
+
+
+def bench_index_single(options, documents):
+    ms = make_index(options, 'index_single')
+    timings = []
+    start_time = time.time()
+
+    for doc_id, document in documents:
+        timings.append(timed(ms.index, doc_id, document))
+
+    return ms, summarize(timings, len(documents), time.time() - start_time)
+
+
+def bench_index_bulk(options, documents, shards=None):
+    ms = make_index(options, 'index_parallel' if shards else 'index_bulk', shards=shards)
+    timings = []
+    start_time = time.time()
+
+    for offset in range(0, len(documents), options.batch_size):
+        timings.append(timed(ms.bulk_index, documents[offset:offset + options.batch_size]))
+
+    return ms, summarize(timings, len(documents), time.time() - start_time)
+
+
+def bench_queries(ms, queries, offset=0, limit=20):
+    timings = []
+    hits = 0
+    start_time = time.time()
+
+    for query in queries:
+        query_start = time.time()
+        results = ms.search(query, offset=offset, limit=limit)
+        timings.append(time.time() - query_start)
+        hits += results['total_hits']
+
+    summary = summarize(timings, len(queries), time.time() - start_time)
+    summary['avg_hits'] = hits / float(len(queries)) if queries else 0.0
+    return summary
+
+
+def run(options):
+    """
+    Runs the requested workloads & returns a dict of all the results.
+    """
+    indexes = []
+
+    try:
+        with track_gc() as gc_stats:
+            report = run_workloads(options, indexes)
+    finally:
+        for ms in indexes:
+            ms.close()
+
+    report['gc'] = dict(gc_stats)
+    return report
+
+
+def run_workloads(options, indexes):
+    """
+    Does the work of ``run``, minus tracking the garbage collector.
+
+    Every index that gets built is added to ``indexes``, so it can be closed
+    afterwards.
+    """
+    rng = random.Random(options.seed)
+    vocabulary = make_vocabulary(rng, options.vocabulary)
+
+    if options.maildir:
+        documents = list(load_maildir(options.maildir, options.docs))
+    else:
+        documents = list(make_corpus(vocabulary, options.docs, options.min_words, options.max_words, options.zipf, options.seed))
+
+    workloads = options.workloads.split(',')
+    report = {
+        'options': vars(options),
+        'version': '.'.join([str(bit) for bit in microsearch.__version__]),
+        'workloads': {},
+    }
+    searcher = None
+
+    for workload in ('index_single', 'index_bulk', 'index_parallel'):
+        if not workload in workloads:
+            continue
+
+        print("Running `{0}` over {1} docs...".format(workload, len(documents)), file=sys.stderr)
+
+        if workload == 'index_single':
+            ms, summary = bench_index_single(options, documents)
+        elif workload == 'index_bulk':
+            ms, summary = bench_index_bulk(options, documents)
+        else:
+            ms, summary = bench_index_bulk(options, documents, shards=options.shards)
+
+        indexes.append(ms)
+        summary['index_bytes'], summary['index_files'] = disk_usage(os.path.join(options.directory, workload))
+        report['workloads'][workload] = summary
+
+        # Prefer searching the unsharded bulk-built index, if there is one.
+        if searcher is None or workload == 'index_bulk':
+            searcher = ms
+
+    if searcher is None:
+        ms, summary = bench_index_bulk(options, documents)
+        indexes.append(ms)
+        searcher = ms
+
+    query_workloads = [
+        ('query_single', 'single', 0),
+        ('query_multi', 'multi', 0),
+        ('query_prefix', 'prefix', 0),
+        ('query_paging', 'single', options.limit * 5),
+    ]
+
+    for workload, kind, offset in query_workloads:
+        if not workload in workloads:
+            continue
+
+        print("Running `{0}`...".format(workload), file=sys.stderr)
+        queries = make_queries(rng, vocabulary, kind, options.queries)
+        report['workloads'][workload] = bench_queries(searcher, queries, offset=offset, limit=options.limit)
+
+    if 'deep_pagination' in workloads:
+        print("Running `deep_pagination`...", file=sys.stderr)
+        # The most common term matches nearly everything.
+        query = vocabulary[0]
+        pages = {}
+        offset = 0
+
+        while offset < options.docs:
+            pages[str(offset)] = bench_queries(searcher, [query] * 5, offset=offset, limit=options.limit)
+            offset = offset * 10 if offset else options.limit
+
+        report['workloads']['deep_pagination'] = pages
+
+    report['peak_rss'] = peak_rss()
+    return report
+
+
+def compare(report, baseline):
+    """
+    Prints how a ``report`` differs from a ``baseline`` report.
+    """
+    for workload, summary in sorted(report['workloads'].items()):
+        old_summary = baseline.get('workloads', {}).get(workload)
+
+        if not old_summary or not 'p50' in summary:
+            continue
+
+        for stat in ('throughput', 'p50', 'p95', 'p99'):
+            old_value = old_summary.get(stat) or 0.0
+            change = (summary[stat] - old_value) / old_value * 100 if old_value else 0.0
+            print("{0:>16} {1:>10}: {2:12.6f} -> {3:12.6f} ({4:+.1f}%)".format(workload, stat, old_value, summary[stat], change))
+
+
+def print_report(report):
+    for workload, summary in sorted(report['workloads'].items()):
+        if not 'p50' in summary:
+            for offset, page in sorted(summary.items(), key=lambda item: int(item[0])):
+                print("{0:>16} offset {1:>6}: p50 {2:.4f}s p99 {3:.4f}s".format(workload, offset, page['p50'], page['p99']))
+            continue
+
+        line = "{0:>16}: {1:10.1f} ops/s p50 {2:.4f}s p95 {3:.4f}s p99 {4:.4f}s".format(
+            workload, summary['throughput'], summary['p50'], summary['p95'], summary['p99']
+        )
+
+        if 'index_bytes' in summary:
+            line += " ({0} bytes in {1} files)".format(summary['index_bytes'], summary['index_files'])
+
+        print(line)
+
+    if report['peak_rss']:
+        print("Peak RSS: {0:.1f} MB".format(report['peak_rss'] / 1024.0 / 1024.0))
+
+    if 'gc' in report:
+        print("GC: {0} collections, {1:.3f}s paused".format(report['gc']['collections'], report['gc']['pause']))
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description='Benchmarks microsearch with reproducible synthetic workloads.')
+    parser.add_argument('--docs', type=int, default=500, help='Number of documents to index.')
+    parser.add_argument('--vocabulary', type=int, default=5000, help='Number of distinct words in the corpus.')
+    parser.add_argument('--zipf', type=float, default=1.1, help='Exponent of the Zipfian term distribution.')
+    parser.add_argument('--min-words', type=int, default=50, help='Minimum words per document.')
+    parser.add_argument('--max-words', type=int, default=300, help='Maximum words per document.')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed for the corpus & queries.')
+    parser.add_argument('--queries', type=int, default=100, help='Number of queries per query workload.')
+    parser.add_argument('--limit', type=int, default=20, help='Results per page.')
+    parser.add_argument('--batch-size', type=int, default=100, help='Documents per bulk indexing batch.')
+    parser.add_argument('--shards', type=int, default=4, help='Shards for the parallel indexing workload.')
+    parser.add_argument('--backend', choices=['file', 'sqlite'], default='file', help='Storage backend to use.')
+    parser.add_argument('--workloads', default=','.join(WORKLOADS), help='Comma-separated workloads to run.')
+    parser.add_argument('--directory', default='/tmp/microsearch_bench', help='Where to put the indexes.')
+    parser.add_argument('--maildir', default=None, help='Index emails from this maildir instead of a synthetic corpus.')
+    parser.add_argument('--output', default=None, help='Write the JSON report to this file.')
+    parser.add_argument('--compare', default=None, help='Compare against a previous JSON report.')
+    return parser
+
+
+def main(argv=None):
+    options = make_parser().parse_args(argv)
+    report = run(options)
+    print_report(report)
+
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare, 'r') as baseline_file:
+            compare(report, json.load(baseline_file))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,4 @@
-from distutils.core import setup
+from setuptools import setup
 
 setup(
     name = "microsearch",
@@ -8,8 +8,14 @@ setup(
     author_email = 'daniel@toastdriven.com',
     long_description=open('README.rst', 'r').read(),
     py_modules = [
-        'microsearch'
+        'microsearch',
+        'microsearch_bench',
     ],
+    entry_points = {
+        'console_scripts': [
+            'microsearch = microsearch:main',
+        ],
+    },
     classifiers = [
         'Development Status :: 5 - Production/Stable',
         'Intended Audience :: Developers',
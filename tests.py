@@ -1,6 +1,12 @@
+import array
+import concurrent.futures
+import contextlib
+import io
 import json
 import os
 import shutil
+import threading
+import time
 import unittest
 import microsearch
 
@@ -269,6 +275,74 @@ class MicrosearchTestCase(unittest.TestCase):
         # Should load the correct document data.
         self.assertEqual(self.micro.load_document('hello'), {'abc': [1, 5], 'bcd': [3, 4]})
 
+    def test_document_cache(self):
+        cache = microsearch.DocumentCache(50, compressed_bytes=100)
+        cache.put('doc-1', {'text': 'Hello world'}, 23)
+        cache.put('doc-2', {'text': 'Goodbye world'}, 25)
+        self.assertEqual(cache.size, 48)
+
+        # Copies, so callers can't change what's cached.
+        document = cache.get('doc-1')
+        document['id'] = 'doc-1'
+        self.assertEqual(cache.get('doc-1'), {'text': 'Hello world'})
+        self.assertEqual(cache.hits, 2)
+
+        # Deep ones, at that.
+        nested = {'text': 'Hello', 'tags': ['a']}
+        cache.put('doc-1', nested, 23)
+        nested['tags'].append('b')
+        cache.get('doc-1')['tags'].append('c')
+        self.assertEqual(cache.get('doc-1'), {'text': 'Hello', 'tags': ['a']})
+        cache.put('doc-1', {'text': 'Hello world'}, 23)
+
+        # ``doc-2`` is the least recently used, so it gets compressed.
+        cache.put('doc-3', {'text': 'Hello again'}, 23)
+        self.assertEqual(list(cache.documents), ['doc-1', 'doc-3'])
+        self.assertEqual(list(cache.compressed), ['doc-2'])
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.get('doc-2'), {'text': 'Goodbye world'})
+        self.assertEqual(cache.compressed_hits, 1)
+        self.assertEqual(list(cache.documents), ['doc-3', 'doc-2'])
+
+        cache.discard('doc-3')
+        self.assertNotIn('doc-3', cache)
+        self.assertIsNone(cache.get('doc-3'))
+        self.assertEqual(cache.misses, 1)
+
+        cache.resize(10, compressed_bytes=0)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual((cache.size, cache.compressed_size), (0, 0))
+
+    def test_load_document_cached(self):
+        micro = microsearch.Microsearch(self.base, document_cache_size=1024, compressed_cache_size=1024)
+        micro.index('email_1', {'text': 'My stapler is missing.\n\nMilton'})
+        self.assertEqual(micro.search('stapler')['results'][0]['id'], 'email_1')
+
+        with micro.profiling('search', enabled=True) as profiler:
+            results = micro.search('stapler')
+
+        self.assertEqual(results['results'][0]['text'], 'My stapler is missing.\n\nMilton')
+        self.assertEqual(profiler.as_dict()['counters']['document_cache_hits'], 1)
+        self.assertEqual(micro.load_document('email_1'), {'text': 'My stapler is missing.\n\nMilton'})
+
+        # Updates replace the cached copy.
+        micro.index('email_1', {'text': 'My red stapler is missing.\n\nMilton'})
+        self.assertNotIn('email_1', micro.document_cache)
+        self.assertEqual(micro.load_document('email_1')['text'], 'My red stapler is missing.\n\nMilton')
+
+        # As do updates elsewhere, once a reader refreshes.
+        reader = microsearch.Microsearch(self.base, refresh_interval=60, document_cache_size=1024)
+        reader.load_document('email_1')
+        micro.index('email_1', {'text': 'Where is my stapler?'})
+        self.assertEqual(reader.load_document('email_1')['text'], 'My red stapler is missing.\n\nMilton')
+        self.assertTrue(reader.refresh())
+        self.assertEqual(reader.load_document('email_1')['text'], 'Where is my stapler?')
+
+        # Non-readers catch up on their next search.
+        other = microsearch.Microsearch(self.base)
+        other.index('email_1', {'text': 'I could set the building on fire.'})
+        self.assertEqual(micro.search('building')['results'][0]['text'], 'I could set the building on fire.')
+
     def test_index(self):
         # Check the exceptions.
         self.assertRaises(AttributeError, self.micro.index, 'email_1', 'A raw doc.')
@@ -319,6 +393,863 @@ class MicrosearchTestCase(unittest.TestCase):
             'world': [1],
         })
 
+    def test_assign_ordinals(self):
+        self.assertEqual(self.micro.get_ordinal('email_1'), None)
+        self.assertEqual(self.micro.assign_ordinals(['email_1', 'email_2']), [0, 1])
+        self.assertEqual(self.micro.assign_ordinals(['email_3', 'email_1']), [2, 0])
+        self.assertEqual(self.micro.get_ordinal('email_3'), 2)
+
+        with open(self.micro.ordinals_path, 'r') as ordinals_file:
+            self.assertEqual(ordinals_file.read(), 'email_1\nemail_2\nemail_3\n')
+
+        # Other instances pick up new additions.
+        other = microsearch.Microsearch(self.base)
+        self.assertEqual(other.get_ordinal('email_2'), 1)
+        self.micro.assign_ordinals(['email_4'])
+        self.assertEqual(other.get_ordinal('email_4'), 3)
+
+    def test_doc_values(self):
+        self.assertRaises(ValueError, microsearch.Microsearch, self.base, doc_values={'size': 'float'})
+        # Options can't be passed positionally.
+        self.assertRaises(TypeError, microsearch.Microsearch, self.base, None, {'size': 'numeric'})
+
+        micro = microsearch.Microsearch(self.base, doc_values={'size': 'numeric', 'from': 'keyword'})
+        self.assertRaises(KeyError, micro.load_column, 'subject')
+        self.assertEqual(len(micro.load_column('size')), 0)
+        self.assertEqual(micro.get_doc_value('size', 0), None)
+
+        self.assertTrue(micro.save_doc_values(2, {'size': 15, 'from': 'bob'}))
+        self.assertTrue(micro.save_doc_values(0, {'size': 3.5, 'from': 'milton'}))
+        self.assertTrue(micro.save_doc_values(3, {'from': 'bob'}))
+
+        self.assertEqual(len(micro.load_column('size')), 4)
+        self.assertEqual(micro.get_doc_value('size', 0), 3.5)
+        self.assertEqual(micro.get_doc_value('size', 1), None)
+        self.assertEqual(micro.get_doc_value('size', 2), 15.0)
+        self.assertEqual(micro.get_doc_value('size', 3), None)
+        self.assertEqual(list(micro.load_column('from')), [1, -1, 0, 0])
+        self.assertEqual(micro.load_column_keys('from'), (['bob', 'milton'], {'bob': 0, 'milton': 1}))
+        self.assertEqual(micro.get_doc_value('from', 0), 'milton')
+        self.assertEqual(micro.get_doc_value('from', 1), None)
+        self.assertEqual(micro.get_doc_value('from', 3), 'bob')
+        self.assertEqual(micro.get_doc_values('from', [0, 1, 3, None, 9]), ['milton', None, 'bob', None, None])
+        self.assertEqual(micro.get_doc_values('size', [2, 1, 0]), [15.0, None, 3.5])
+
+        # Overwrites in place.
+        micro.save_doc_values(2, {'size': 7, 'from': 'peter'})
+        self.assertEqual(micro.get_doc_value('size', 2), 7.0)
+        self.assertEqual(micro.get_doc_value('from', 2), 'peter')
+        self.assertEqual(os.path.getsize(micro.make_column_name('size')), 32)
+
+    def test_matches_filter(self):
+        self.assertTrue(self.micro.matches_filter('bob', 'bob'))
+        self.assertFalse(self.micro.matches_filter('bob', 'milton'))
+        self.assertFalse(self.micro.matches_filter(None, 'bob'))
+        self.assertTrue(self.micro.matches_filter(5.0, (1, 5)))
+        self.assertFalse(self.micro.matches_filter(5.0, (1, 4)))
+        self.assertTrue(self.micro.matches_filter(5.0, (None, 5)))
+        self.assertTrue(self.micro.matches_filter('2012-02-18', ('2012-02-01', None)))
+        self.assertFalse(self.micro.matches_filter(None, (None, None)))
+
+    def test_search_doc_values(self):
+        micro = microsearch.Microsearch(self.base, doc_values={'created': 'keyword', 'from': 'keyword', 'size': 'numeric'})
+        micro.index('email_1', {'text': "Peter, I need those TPS reports.", 'from': 'lumbergh', 'created': '2012-02-03', 'size': 30})
+        micro.index('email_2', {'text': 'My stapler is missing. Those reports too.', 'from': 'milton', 'created': '2012-02-01', 'size': 40})
+        micro.bulk_index([
+            ('email_3', {'text': "Peter, those reports. Saturday.", 'from': 'lumbergh', 'created': '2012-02-02'}),
+            ('email_4', {'text': 'Those Bobs.', 'from': 'bobs', 'created': '2012-02-04', 'size': 10}),
+        ])
+
+        results = micro.search('those reports', sort='created')
+        self.assertEqual([res['id'] for res in results['results']], ['email_2', 'email_3', 'email_1', 'email_4'])
+        results = micro.search('those reports', sort='-created')
+        self.assertEqual([res['id'] for res in results['results']], ['email_4', 'email_1', 'email_3', 'email_2'])
+        # Missing values go last.
+        results = micro.search('those', sort='-size')
+        self.assertEqual([res['id'] for res in results['results']], ['email_2', 'email_1', 'email_4', 'email_3'])
+
+        results = micro.search('those reports', filters={'from': 'lumbergh'}, facets=['from'])
+        self.assertEqual(results['total_hits'], 2)
+        self.assertEqual(sorted([res['id'] for res in results['results']]), ['email_1', 'email_3'])
+        self.assertEqual(results['facets'], {'from': {'lumbergh': 2}})
+
+        results = micro.search('those', filters={'created': ('2012-02-02', '2012-02-03')}, facets=['from', 'size'])
+        self.assertEqual(results['total_hits'], 2)
+        self.assertEqual(results['facets'], {'from': {'lumbergh': 2}, 'size': {30.0: 1}})
+
+        results = micro.search('those', filters={'size': (None, 35)}, facets=['from'])
+        self.assertEqual(results['total_hits'], 2)
+        self.assertEqual(results['facets'], {'from': {'lumbergh': 1, 'bobs': 1}})
+
+    def test_doc_set(self):
+        docs = microsearch.DocSet([5, 1, 70000, 5])
+        self.assertEqual(len(docs), 3)
+        self.assertEqual(list(docs), [1, 5, 70000])
+        self.assertTrue(5 in docs)
+        self.assertTrue(70000 in docs)
+        self.assertFalse(2 in docs)
+        self.assertFalse(65536 in docs)
+        self.assertTrue(isinstance(docs.containers[0], array.array))
+
+        # Dense containers become bitmaps.
+        dense = microsearch.DocSet(range(0, 10000, 2))
+        self.assertTrue(isinstance(dense.containers[0], bytearray))
+        self.assertEqual(len(dense), 5000)
+        self.assertTrue(9998 in dense)
+        self.assertFalse(9999 in dense)
+        self.assertEqual(list(dense)[:3], [0, 2, 4])
+
+        self.assertEqual(list(docs & dense), [])
+        self.assertEqual(list(dense & microsearch.DocSet([1, 2, 3, 4, 70000])), [2, 4])
+        self.assertEqual(list(docs & microsearch.DocSet([5, 70000, 80000])), [5, 70000])
+
+    def test_get_filter(self):
+        micro = microsearch.Microsearch(self.base, doc_values={'from': 'keyword', 'size': 'numeric'}, filter_cache_size=2)
+        micro.save_doc_values(0, {'from': 'bob', 'size': 10})
+        micro.save_doc_values(1, {'from': 'milton', 'size': 20})
+        micro.save_doc_values(2, {'from': 'bob'})
+
+        self.assertEqual(list(micro.get_filter('from', 'bob')), [0, 2])
+        self.assertEqual(list(micro.get_filter('from', ['a', 'c'])), [0, 2])
+        self.assertEqual(list(micro.get_filter('size', (15, None))), [1])
+        self.assertEqual(list(micro.filter_cache.keys()), [('from', ('a', 'c')), ('size', (15, None))])
+
+        # Cache hits get moved to the end.
+        profiler = micro.profiler = microsearch.Profiler()
+        self.assertEqual(list(micro.get_filter('from', ('a', 'c'))), [0, 2])
+        self.assertEqual(profiler.counters, {'filter_cache_hits': 1})
+        self.assertEqual(list(micro.filter_cache.keys()), [('size', (15, None)), ('from', ('a', 'c'))])
+
+        # Writes throw the field's cached filters away.
+        micro.save_doc_values(3, {'from': 'bob', 'size': 30})
+        self.assertEqual(list(micro.filter_cache.keys()), [])
+        self.assertEqual(list(micro.get_filter('size', (15, None))), [1, 3])
+        self.assertEqual(list(micro.build_filter({'from': 'bob', 'size': (15, None)})), [3])
+
+    def test_collect_results_filter(self):
+        self.micro.index('email_1', {'text': 'Hello world'})
+        self.micro.index('email_2', {'text': 'Hello there'})
+
+        per_term_docs, per_doc_counts = self.micro.collect_results(['hello'], doc_filter=microsearch.DocSet([1]))
+        self.assertEqual(per_term_docs, {'hello': 2})
+        self.assertEqual(per_doc_counts, {'email_2': {'hello': 1}})
+
+    def test_cursors(self):
+        cursor = self.micro.make_cursor(0.5572567355483165, 12)
+        self.assertEqual(self.micro.parse_cursor(cursor), (0.5572567355483165, 12, None))
+        cursor = self.micro.make_cursor(0.5572567355483165, None, 'email:1')
+        self.assertEqual(self.micro.parse_cursor(cursor), (0.5572567355483165, None, 'email:1'))
+        self.assertEqual(self.micro.parse_cursor(''), None)
+        self.assertEqual(self.micro.parse_cursor(None), None)
+        self.assertRaises(ValueError, self.micro.parse_cursor, 'garbage')
+        self.assertRaises(ValueError, self.micro.parse_cursor, 'Zm9v')
+
+    def test_search_after(self):
+        self.assertEqual(self.micro.search('hello', search_after=''), {'total_hits': 0, 'results': [], 'next': None})
+        self.assertRaises(ValueError, self.micro.search, 'hello', offset=20, search_after='')
+
+        for doc_number in range(7):
+            self.micro.index('doc_{0}'.format(doc_number), {'text': 'Hello world ' * (doc_number % 3 + 1)})
+
+        self.micro.index('doc_7', {'text': 'Goodbye world'})
+
+        seen = []
+        cursor = ''
+        pages = 0
+
+        while cursor is not None:
+            results = self.micro.search('hello', limit=3, search_after=cursor)
+            self.assertEqual(results['total_hits'], 7)
+            seen.extend([(res['score'], res['id']) for res in results['results']])
+            cursor = results['next']
+            pages += 1
+
+        self.assertEqual(pages, 3)
+        # Descending score, then indexing order.
+        self.assertEqual([doc_id for score, doc_id in seen], ['doc_0', 'doc_3', 'doc_6', 'doc_1', 'doc_4', 'doc_2', 'doc_5'])
+        self.assertEqual(seen, sorted(seen, key=lambda hit: (-hit[0], self.micro.get_ordinal(hit[1]))))
+
+        # An exactly-full last page still ends.
+        results = self.micro.search('hello', limit=7, search_after='')
+        self.assertEqual(len(results['results']), 7)
+        self.assertEqual(self.micro.search('hello', limit=7, search_after=results['next'])['results'], [])
+
+        # Indexes from before ordinals existed page by doc id instead.
+        os.remove(self.micro.ordinals_path)
+        self.micro.clear_caches()
+        seen = []
+        cursor = ''
+
+        while cursor is not None:
+            results = self.micro.search('hello', limit=3, search_after=cursor)
+            seen.extend([res['id'] for res in results['results']])
+            cursor = results['next']
+
+        self.assertEqual(seen, ['doc_0', 'doc_3', 'doc_6', 'doc_1', 'doc_4', 'doc_2', 'doc_5'])
+
+    def test_levenshtein_automaton(self):
+        def distance(first, second):
+            previous = list(range(len(second) + 1))
+
+            for i, first_char in enumerate(first):
+                current = [i + 1]
+
+                for j, second_char in enumerate(second):
+                    current.append(min(previous[j + 1] + 1, current[j] + 1, previous[j] + (first_char != second_char)))
+
+                previous = current
+
+            return previous[-1]
+
+        def accepts(automaton, candidate):
+            state = automaton.start()
+
+            for character in candidate:
+                state = automaton.step(state, character)
+
+                if not automaton.can_match(state):
+                    return False
+
+            return automaton.is_match(state)
+
+        words = ['lumberg', 'lumbergh', 'lumbrgh', 'umberg', 'lumbreg', 'lumber', 'plumber', 'ab', '', 'cafe', 'café']
+
+        for max_edits in (1, 2):
+            for word in words:
+                automaton = microsearch.LevenshteinAutomaton(word, max_edits)
+
+                for candidate in words:
+                    self.assertEqual(accepts(automaton, candidate), distance(word, candidate) <= max_edits, (word, candidate, max_edits))
+
+    def test_term_dictionary(self):
+        self.assertEqual(self.micro.load_term_dictionary(), [])
+        self.micro.add_to_term_dictionary(['lumbergh', 'peter'])
+        self.micro.add_to_term_dictionary(['milton', 'peter'])
+        self.assertEqual(self.micro.load_term_dictionary(), ['lumbergh', 'milton', 'peter'])
+
+        with open(self.micro.term_dictionary_path, 'r') as terms_file:
+            self.assertEqual(terms_file.read(), 'lumbergh\npeter\nmilton\n')
+
+        micro = microsearch.Microsearch(self.base, fields=['text', 'subject'])
+        micro.index('email_1', {'text': 'Hello world', 'subject': 'Greetings'})
+        self.assertEqual(micro.load_term_dictionary(), ['hello', 'lumbergh', 'milton', 'peter', 'subject:greetings', 'world'])
+
+    def test_fuzzy_expand(self):
+        self.micro.add_to_term_dictionary(['lumber', 'lumbergh', 'lumberjack', 'lunch', 'lumbergs', 'milton', 'plumber'])
+        self.assertEqual(self.micro.fuzzy_expand('lumberg'), ['lumber', 'lumbergh', 'lumbergs'])
+        self.assertEqual(self.micro.fuzzy_expand('lumbrgh'), ['lumbergh'])
+        self.assertEqual(self.micro.fuzzy_expand('lumbrgh', max_edits=2), ['lumbergh', 'lumbergs'])
+        self.assertEqual(self.micro.fuzzy_expand('lumberg', max_expansions=2), ['lumber', 'lumbergh'])
+        self.assertEqual(self.micro.fuzzy_expand('stapler'), [])
+
+        # Other fields' tokens don't use up the expansions.
+        self.micro.add_to_term_dictionary(['subject:lumbergh', 'subject:lumbergs'])
+        self.assertEqual(self.micro.fuzzy_expand('subject:lumberg', max_expansions=1), ['subject:lumbergh'])
+        self.assertEqual(self.micro.fuzzy_expand('subject:lumberg', max_expansions=1, field='text'), [])
+        self.assertEqual(self.micro.fuzzy_expand('subject:lumberg', max_expansions=1, field='subject'), ['subject:lumbergh'])
+
+    def test_fuzzy_search(self):
+        micro = microsearch.Microsearch(self.base, fields=['text', 'subject'])
+        micro.index('email_1', {'text': "Peter, I'm going to need those TPS reports.\n\nLumbergh", 'subject': 'Reports'})
+        micro.index('email_2', {'text': 'My stapler is missing.\n\nMilton', 'subject': 'Stapler'})
+        micro.index('email_3', {'text': 'About the lumber order.\n\nBob', 'subject': 'Lumber'})
+
+        self.assertEqual(micro.parse_query('lumbrgh~'), {'lumber': [0]})
+        self.assertEqual(micro.parse_query('lumbr~'), {'lumber': [0], 'subject:lumber': [0]})
+        self.assertEqual(micro.parse_query('subject:staplr~'), {'subject:staple': [0]})
+        self.assertEqual(micro.parse_query('miltn~ bob'), {'milton': [0], 'bob': [0], 'subject:bob': [0]})
+
+        # Front n-grams can't help with a typo this early in the word.
+        self.assertEqual(micro.search('mlton')['total_hits'], 0)
+        results = micro.search('mlton~')
+        self.assertEqual([res['id'] for res in results['results']], ['email_2'])
+        results = micro.search('subject:staplr~')
+        self.assertEqual([res['id'] for res in results['results']], ['email_2'])
+        # Like plain words, only the first 6 characters get matched on.
+        results = micro.search('lumbrgh~')
+        self.assertEqual(sorted([res['id'] for res in results['results']]), ['email_1', 'email_3'])
+        self.assertEqual(micro.search('lumbergh')['total_hits'], 2)
+
+    def test_warmup(self):
+        micro = microsearch.Microsearch(self.base, query_log=True)
+        micro.index('email_1', {'text': "Peter, I'm going to need those TPS reports.\n\nLumbergh"})
+        micro.index('email_2', {'text': 'My stapler is missing.\n\nMilton'})
+        micro.search('stapler')
+        micro.search('stapler milton')
+        self.assertEqual(micro.get_hot_terms(5), ['sta', 'stap', 'stapl', 'staple', 'mil'])
+        self.assertEqual(micro.write_warmup_snapshot(top_n=5), 5)
+
+        warm = microsearch.Microsearch(self.base, warmup=True)
+        self.assertEqual(sorted(warm.postings_cache), ['mil', 'sta', 'stap', 'stapl', 'staple'])
+        self.assertEqual(warm.postings_cache['staple'], micro.read_segment('staple'))
+        self.assertEqual(warm.term_dictionary, micro.load_term_dictionary())
+        self.assertEqual(warm.get_total_docs(), 2)
+
+        with warm.profiling('search', enabled=True) as profiler:
+            self.assertEqual(warm.load_segment('staple'), micro.read_segment('staple'))
+
+        self.assertEqual(profiler.as_dict()['counters']['postings_cache_hits'], 1)
+
+        # Writes keep the in-memory state fresh.
+        warm.index('email_3', {'text': 'Where is my stapler?'})
+        self.assertNotIn('staple', warm.postings_cache)
+        self.assertEqual(warm.get_total_docs(), 3)
+        self.assertEqual(warm.search('stapler')['total_hits'], 2)
+        self.assertIn('where', warm.load_term_dictionary())
+
+        # So do writes made elsewhere, before the next search.
+        micro.index('email_4', {'text': 'Milton found it.'})
+        self.assertEqual(warm.search('milton')['total_hits'], 2)
+        self.assertEqual(warm.get_total_docs(), 4)
+        self.assertEqual(warm.load_segment('mil'), micro.read_segment('mil'))
+
+        # An out of date snapshot only warms the term dictionary.
+        stale = microsearch.Microsearch(self.base, warmup=True)
+        self.assertEqual(stale.postings_cache, {})
+        self.assertEqual(stale.stats_cache, None)
+
+    def test_query_log_rotation(self):
+        micro = microsearch.Microsearch(self.base, query_log=True)
+        micro.QUERY_LOG_SIZE = 100
+        micro.index('email_1', {'text': 'My stapler is missing.\n\nMilton'})
+
+        for i in range(10):
+            micro.search('stapler')
+
+        micro.search('milton')
+        self.assertLessEqual(os.path.getsize(micro.query_log_path), 100)
+        self.assertTrue(os.path.exists(micro.query_log_path + '.1'))
+        self.assertEqual(micro.get_hot_terms(5), ['sta', 'stap', 'stapl', 'staple', 'mil'])
+
+    def test_refresh(self):
+        writer = microsearch.Microsearch(self.base)
+        self.assertEqual(writer.read_generation(), 0)
+        writer.index('email_1', {'text': "Peter, I'm going to need those TPS reports.\n\nLumbergh"})
+        writer.index('email_2', {'text': 'My stapler is missing.\n\nMilton'})
+        self.assertEqual(writer.read_generation(), 2)
+
+        reader = microsearch.Microsearch(self.base, refresh_interval=60)
+        self.assertEqual(reader.generation, 2)
+        self.assertEqual(reader.search('stapler')['total_hits'], 1)
+        self.assertEqual(reader.search('peter')['total_hits'], 1)
+        peter_segment = reader.make_segment_name('peter')
+        self.assertIn(peter_segment, reader.segment_cache)
+
+        # The reader keeps its view until it refreshes.
+        writer.index('email_3', {'text': 'Where is my stapler?'})
+        self.assertEqual(writer.read_generation(), 3)
+        self.assertEqual(reader.search('stapler')['total_hits'], 1)
+        self.assertEqual(reader.get_total_docs(), 2)
+
+        self.assertTrue(reader.refresh())
+        self.assertFalse(reader.refresh())
+        self.assertEqual(reader.generation, 3)
+        self.assertEqual(reader.get_total_docs(), 3)
+        self.assertNotIn(reader.make_segment_name('staple'), reader.segment_cache)
+        # Untouched segments stay cached.
+        self.assertIn(peter_segment, reader.segment_cache)
+        self.assertEqual(reader.search('stapler')['total_hits'], 2)
+
+        with open(writer.commits_path, 'r') as commits_file:
+            last_commit = json.loads(commits_file.readlines()[-1])
+
+        self.assertEqual(last_commit['generation'], 3)
+        self.assertEqual(last_commit['docs'], ['email_3'])
+        self.assertIn(os.path.basename(writer.make_segment_name('staple')), last_commit['segments'])
+
+        # Compacting starts the log over & drops everything.
+        writer.compact()
+        self.assertEqual(writer.read_generation(), 4)
+        self.assertTrue(reader.refresh())
+        self.assertEqual(len(reader.segment_cache), 0)
+        self.assertEqual(reader.search('stapler')['total_hits'], 2)
+
+        # Due for a refresh on every search.
+        eager = microsearch.Microsearch(self.base, refresh_interval=0)
+        self.assertEqual(eager.search('lumbergh')['total_hits'], 1)
+        writer.bulk_index([('email_4', {'text': 'Lumbergh wants the TPS reports.'})])
+        self.assertEqual(eager.search('lumbergh')['total_hits'], 2)
+
+    def test_batch_commits(self):
+        writer = microsearch.Microsearch(self.base)
+        reader = microsearch.Microsearch(self.base, refresh_interval=60)
+
+        with writer.batch():
+            writer.index('email_1', {'text': "Peter, I'm going to need those TPS reports.\n\nLumbergh"})
+            writer.index('email_2', {'text': 'My stapler is missing.\n\nMilton'})
+
+            with writer.batch():
+                writer.index('email_3', {'text': 'Where is my stapler?'})
+
+            # Nothing's visible until the outermost batch is done.
+            self.assertEqual(writer.read_generation(), 0)
+
+        self.assertEqual(writer.read_generation(), 1)
+        entries = reader.read_commits()
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]['docs'], ['email_1', 'email_2', 'email_3'])
+        self.assertIn(os.path.basename(writer.make_segment_name('staple')), entries[0]['segments'])
+        self.assertIn(os.path.basename(writer.make_segment_name('peter')), entries[0]['segments'])
+
+        # Once the log gets too big, it's started over & readers that are
+        # behind reload everything.
+        writer.COMMITS_LOG_SIZE = 400
+        self.assertTrue(reader.refresh())
+        self.assertEqual(reader.search('stapler')['total_hits'], 2)
+        self.assertIn(reader.make_segment_name('staple'), reader.segment_cache)
+
+        for i in range(4, 10):
+            writer.index('email_{0}'.format(i), {'text': 'Memo {0}'.format(i)})
+
+        self.assertLessEqual(os.path.getsize(writer.commits_path), 400)
+        # None of the memos touched ``staple``, so only starting over drops it.
+        self.assertTrue(reader.refresh())
+        self.assertNotIn(reader.make_segment_name('staple'), reader.segment_cache)
+        self.assertEqual(reader.search('memo')['total_hits'], 6)
+
+    def test_search_while_indexing(self):
+        writer = microsearch.Microsearch(self.base)
+        writer.index('email_0', {'text': 'Memo about the stapler'})
+        reader = microsearch.Microsearch(self.base, refresh_interval=0.0)
+        done = threading.Event()
+        errors = []
+
+        def write():
+            try:
+                for i in range(1, 50):
+                    writer.index('email_{0}'.format(i), {'text': 'Memo {0} about the stapler'.format(i)})
+            finally:
+                done.set()
+
+        def search(ms):
+            while not done.is_set():
+                try:
+                    ms.search('stapler memo')
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=write)] + [threading.Thread(target=search, args=(ms,)) for ms in [reader, reader, writer]]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(reader.search('stapler')['total_hits'], 50)
+
+    def test_snapshot_and_restore(self):
+        micro = microsearch.Microsearch(self.base, doc_values={'year': 'numeric'})
+        micro.index('email_1', {'text': "Peter, I'm going to need those TPS reports.\n\nLumbergh", 'year': 1999})
+        micro.index('email_2', {'text': 'My stapler is missing.\n\nMilton', 'year': 1998})
+
+        archive = io.BytesIO()
+        files = micro.snapshot(archive)
+        self.assertEqual(files, len(micro.snapshot_files()))
+        self.assertIn('stats.json', micro.snapshot_files())
+        self.assertIn('values/year.dv', micro.snapshot_files())
+
+        restore_base = self.base + '_restored'
+        self.addCleanup(shutil.rmtree, restore_base, True)
+        restored = microsearch.Microsearch(restore_base, doc_values={'year': 'numeric'})
+        archive.seek(0)
+        self.assertEqual(restored.restore(archive), files)
+        self.assertEqual(restored.get_total_docs(), 2)
+        self.assertEqual(restored.search('stapler'), micro.search('stapler'))
+        self.assertEqual(restored.search('peter', sort='year')['results'][0]['id'], 'email_1')
+
+        # Won't clobber an existing index.
+        archive.seek(0)
+        self.assertRaises(ValueError, restored.restore, archive)
+
+        # Damaged archives get caught.
+        shutil.rmtree(restore_base)
+        damaged = bytearray(archive.getvalue())
+        damaged[-60] ^= 1
+        restored = microsearch.Microsearch(restore_base)
+        self.assertRaises(ValueError, restored.restore, io.BytesIO(bytes(damaged)))
+
+        shutil.rmtree(restore_base)
+        restored = microsearch.Microsearch(restore_base)
+        self.assertRaises(ValueError, restored.restore, io.BytesIO(archive.getvalue()[:-100]))
+
+        # Nothing gets left behind, in the index or next to it.
+        before = restored.snapshot_files()
+        temp_dirs = [name for name in os.listdir('/tmp') if name.startswith(restored.TEMP_PREFIX)]
+        undecodable = bytearray(archive.getvalue())
+        undecodable[archive.getvalue().index(b'\n') + 1] = 0xff
+        self.assertRaises(ValueError, restored.restore, io.BytesIO(bytes(undecodable)))
+        self.assertEqual(restored.snapshot_files(), before)
+        self.assertEqual([name for name in os.listdir('/tmp') if name.startswith(restored.TEMP_PREFIX)], temp_dirs)
+
+        # Also works with paths.
+        shutil.rmtree(restore_base)
+        archive_path = os.path.join('/tmp', 'microsearch_tests.snapshot')
+        self.addCleanup(os.remove, archive_path)
+        micro.snapshot(archive_path)
+        restored = microsearch.Microsearch(restore_base)
+        self.assertEqual(restored.restore(archive_path), files)
+
+    def test_check_index(self):
+        self.micro.index('email_1', {'text': "Peter, I'm going to need those TPS reports.\n\nLumbergh"})
+        self.micro.index('email_2', {'text': 'My stapler is missing.\n\nMilton'})
+        self.assertEqual(self.micro.check_index(), {'segments': 32, 'problems': [], 'repaired': []})
+        self.assertEqual(self.micro.temp_file_names(), [])
+
+        # Damage it in all the ways a crash or a bug might.
+        peter_seg = self.micro.make_segment_name('peter')
+        stapler_seg = self.micro.make_segment_name('stapler')
+
+        with open(peter_seg, 'a') as seg_file:
+            seg_file.write('aaa\t{"email_1": [1]}\n')
+            seg_file.write('peter\t{"email_3": [0]}\n')
+            seg_file.write('zzz\t{"email_1": [1]}\n')
+            seg_file.write('garbage\n')
+
+        with open(stapler_seg, 'a') as seg_file:
+            seg_file.write('zzzz\t{"email_1": [\n')
+
+        temp_name = os.path.join(self.micro.index_path, self.micro.TEMP_PREFIX + 'abc')
+
+        with open(temp_name, 'w') as temp_file:
+            temp_file.write('peter\t{}')
+
+        stats = self.micro.read_stats()
+        stats['total_docs'] = 5
+        self.micro.write_stats(stats)
+
+        report = self.micro.check_index()
+        self.assertEqual(report['repaired'], [])
+        self.assertEqual([problem['problem'] for problem in report['problems'] if problem['segment'] == peter_seg], [
+            "'aaa' is out of order.",
+            "'aaa' belongs in a different segment.",
+            "'peter' appears more than once.",
+            "'peter' references the missing document 'email_3'.",
+            "'zzz' belongs in a different segment.",
+            'Line 5 is not a valid record.',
+        ])
+        self.assertEqual([problem['problem'] for problem in report['problems'] if problem['segment'] == stapler_seg], [
+            "The postings for 'zzzz' can not be parsed.",
+        ])
+        self.assertEqual(report['problems'][0], {'segment': temp_name, 'problem': 'Leftover temporary file.'})
+        self.assertEqual(report['problems'][-1], {'segment': None, 'problem': 'The stats say there are 5 documents, but 2 are stored.'})
+
+        report = self.micro.check_index(repair=True)
+        self.assertEqual(report['repaired'], [temp_name, peter_seg, stapler_seg, 'stats'])
+        self.assertEqual(self.micro.check_index(), {'segments': 35, 'problems': [], 'repaired': []})
+        self.assertEqual(self.micro.get_total_docs(), 2)
+        self.assertEqual(self.micro.load_segment('peter'), {'email_1': [0]})
+        self.assertEqual(self.micro.load_segment('aaa'), {'email_1': [1]})
+        self.assertEqual(self.micro.load_segment('zzz'), {'email_1': [1]})
+        self.assertEqual(self.micro.search('stapler')['total_hits'], 1)
+
+    def test_compact(self):
+        self.micro.index('email_1', {'text': 'My stapler is missing.\n\nMilton'})
+        stapler_seg = self.micro.make_segment_name('staple')
+
+        with open(stapler_seg, 'a') as seg_file:
+            seg_file.write('aaa\t{"email_2": [1]}\n')
+
+        seg_count = len(self.micro.segment_names())
+        self.assertEqual(self.micro.compact(), seg_count)
+        self.assertEqual(self.micro.load_segment('aaa'), {})
+        self.assertEqual(self.micro.check_index()['problems'], [])
+        self.assertEqual(self.micro.search('stapler')['total_hits'], 1)
+
+    def test_merge_scheduler(self):
+        micro = microsearch.Microsearch(self.base)
+        scheduler = microsearch.MergeScheduler(micro, cpu_budget=1.0)
+        micro.index('email_1', {'text': 'My stapler is missing.\n\nMilton'})
+        micro.save_segment('staple', {'email_2': [1]}, update=True)
+        stapler_seg = micro.make_segment_name('staple')
+        seg_count = len(micro.segment_names())
+
+        scheduler.schedule()
+        self.assertIn(stapler_seg, scheduler.backlog)
+        self.assertEqual(scheduler.metrics()['backlog'], seg_count)
+
+        while scheduler.run_once():
+            pass
+
+        self.assertEqual(micro.load_segment('staple'), {'email_1': [1]})
+        metrics = scheduler.metrics()
+        self.assertEqual(metrics['backlog'], 0)
+        self.assertEqual(metrics['checked'], seg_count)
+        # Only the damaged segment gets rewritten.
+        self.assertEqual(metrics['merged'], 1)
+        self.assertGreater(metrics['bytes_read'], metrics['bytes_written'])
+        self.assertEqual(scheduler.known_docs, {})
+
+        # A segment written to while it was being tidied goes back on the
+        # backlog, rather than losing the new postings.
+        micro.save_segment('staple', {'email_3': [0]}, update=True)
+        scheduler.schedule([stapler_seg])
+        tidy_segment = micro.tidy_segment
+
+        def racing_tidy(seg_name, known_docs=None):
+            tidied = tidy_segment(seg_name, known_docs)
+            micro.index('email_3', {'text': 'A stapler!'})
+            return tidied
+
+        micro.tidy_segment = racing_tidy
+        scheduler.run_once()
+        del micro.tidy_segment
+        self.assertEqual(scheduler.metrics()['merged'], 1)
+        self.assertIn(stapler_seg, scheduler.backlog)
+        self.assertEqual(micro.search('stapler')['total_hits'], 2)
+
+        micro.save_segment('staple', {'email_4': [1]}, update=True)
+        scheduler.scrub_interval = 3600
+        scheduler.start()
+
+        for attempt in range(50):
+            if scheduler.metrics()['merged'] > 1 and not scheduler.metrics()['backlog']:
+                break
+
+            time.sleep(0.1)
+
+        scheduler.stop()
+        self.assertEqual(scheduler.metrics()['merged'], 2)
+        self.assertEqual(micro.load_segment('staple'), {'email_1': [1], 'email_3': [0]})
+        self.assertEqual(micro.check_index()['problems'], [])
+
+    def test_merge_scheduler_throttle(self):
+        micro = microsearch.Microsearch(self.base)
+        scheduler = microsearch.MergeScheduler(micro, io_rate=1000, cpu_budget=0.25)
+        self.assertRaises(ValueError, microsearch.MergeScheduler, micro, cpu_budget=0)
+        # Don't actually wait.
+        scheduler.stop_event.set()
+
+        scheduler.throttle(500, 0.0)
+        self.assertEqual(scheduler.throttled_seconds, 0.0)
+        scheduler.throttle(1500, 0.0)
+        self.assertAlmostEqual(scheduler.throttled_seconds, 1.0, places=1)
+        scheduler.io_tokens = 1000
+        scheduler.throttle(0, 0.1)
+        self.assertAlmostEqual(scheduler.throttled_seconds, 1.3, places=1)
+
+    def test_segment_buckets(self):
+        # Classic MD5 names by default, which lump non-ASCII terms together.
+        self.assertEqual(self.micro.segment_buckets, None)
+        self.assertEqual(self.micro.make_segment_name('\u00e9\u00e9'), self.micro.make_segment_name('\u00fc\u00df'))
+
+        micro = microsearch.Microsearch(self.base, segment_buckets=8)
+        self.assertEqual(micro.segment_bucket('cafe'), '00000')
+        self.assertEqual(micro.segment_bucket('caf\u00e9'), '00005')
+        self.assertEqual(micro.make_segment_name('cafe'), os.path.join(self.base, 'index', '00000.index'))
+        self.assertNotEqual(micro.make_segment_name('\u00e9\u00e9'), micro.make_segment_name('\u00fc\u00df'))
+
+        micro.bulk_index([('email_{0}'.format(i), {'text': 'Memo number {0}'.format(i)}) for i in range(20)])
+        bucket_names = set([os.path.join(self.base, 'index', '{0:05x}.index'.format(i)) for i in range(8)])
+        self.assertTrue(set(micro.segment_names()).issubset(bucket_names))
+        self.assertEqual(micro.search('memo')['total_hits'], 20)
+
+        # The number of buckets is remembered & can't change once there are
+        # documents.
+        self.assertEqual(microsearch.Microsearch(self.base).segment_buckets, 8)
+        self.assertRaises(ValueError, microsearch.Microsearch, self.base, segment_buckets=16)
+
+    def test_rebalance_segments(self):
+        micro = microsearch.Microsearch(self.base, segment_buckets=8)
+        micro.bulk_index([('email_{0}'.format(i), {'text': 'Memo number {0}'.format(i)}) for i in range(20)])
+        self.assertEqual(micro.rebalance_segments(), [])
+
+        moved = micro.rebalance_segments(factor=1.2)
+        self.assertTrue(len(moved) > 0)
+        self.assertEqual(micro.make_segment_name(moved[0]), os.path.join(self.base, 'index', 't{0:08x}.index'.format(microsearch.zlib.crc32(moved[0].encode('utf-8')))))
+        self.assertEqual(micro.check_index()['problems'], [])
+        self.assertEqual(micro.search('memo')['total_hits'], 20)
+
+        with open(micro.routing_path, 'r') as routing_file:
+            self.assertEqual(sorted(json.load(routing_file)), moved)
+
+        self.assertEqual(microsearch.Microsearch(self.base).segment_routes, micro.segment_routes)
+
+        # Impacts files fed by several segments still come out in order.
+        micro.build_impacts()
+
+        for term in ['memo', 'number', moved[0]]:
+            self.assertEqual(micro.load_impacts(term, 1)[0], 20)
+
+        for impact_name in os.listdir(micro.impacts_path):
+            if not impact_name.endswith('.impacts'):
+                continue
+
+            with open(os.path.join(micro.impacts_path, impact_name), 'r') as impact_file:
+                terms = [line.split('\t', 1)[0] for line in impact_file]
+
+            self.assertEqual(terms, sorted(terms))
+
+    def test_rebalance_segments_elsewhere(self):
+        micro = microsearch.Microsearch(self.base, segment_buckets=8)
+        micro.bulk_index([('email_{0}'.format(i), {'text': 'Memo number {0}'.format(i)}) for i in range(20)])
+        other = microsearch.Microsearch(self.base)
+
+        # Stopping after the routing is replaced leaves the sources with
+        # copies of the moved terms, which a repair tidies away.
+        write_segment = micro.write_segment
+
+        def crashing_write(seg_name, term_infos):
+            if not os.path.basename(seg_name).startswith('t'):
+                raise IOError('Crashed.')
+
+            return write_segment(seg_name, term_infos)
+
+        micro.write_segment = crashing_write
+        self.assertRaises(IOError, micro.rebalance_segments, factor=1.2)
+        del micro.write_segment
+        self.assertEqual(micro.search('memo')['total_hits'], 20)
+        self.assertNotEqual(micro.check_index(repair=True)['problems'], [])
+        self.assertEqual(micro.check_index()['problems'], [])
+
+        # Other instances pick up the new routing before searching or writing.
+        self.assertEqual(other.search('memo')['total_hits'], 20)
+        self.assertEqual(other.segment_routes, micro.segment_routes)
+        other.index('email_20', {'text': 'Memo number 20'})
+        self.assertEqual(micro.search('memo')['total_hits'], 21)
+        self.assertEqual(micro.check_index()['problems'], [])
+
+    def test_build_impacts(self):
+        self.micro.bulk_index([
+            ('email_1', {'text': 'Memo: stapler, stapler, stapler.'}),
+            ('email_2', {'text': 'Memo: stapler.'}),
+            ('email_3', {'text': 'Memo: stapler, stapler.'}),
+        ] + [('lunch_{0}'.format(i), {'text': 'Lunch.'}) for i in range(5)])
+        self.assertFalse(self.micro.impacts_current())
+        self.assertEqual(self.micro.build_impacts(block_size=2), 9)
+        self.assertTrue(self.micro.impacts_current())
+
+        with open(self.micro.make_impact_name('staple'), 'r') as impact_file:
+            lines = [line for line in impact_file if line.startswith('staple\t')]
+
+        self.assertEqual([json.loads(line.split('\t')[1]) for line in lines], [
+            {'df': 3, 'stored': 3, 'blocks': 2, 'postings': [['email_1', 3], ['email_3', 2]]},
+            {'postings': [['email_2', 1]]},
+        ])
+        self.assertEqual(self.micro.load_impacts('staple', 1), (3, [['email_1', 3], ['email_3', 2]], False))
+        self.assertEqual(self.micro.load_impacts('staple', 5), (3, [['email_1', 3], ['email_3', 2], ['email_2', 1]], True))
+        self.assertEqual(self.micro.load_impacts('stapler', 1), (0, [], True))
+
+        # Static pruning keeps the document counts.
+        self.micro.build_impacts(block_size=2, max_postings=1)
+        self.assertEqual(self.micro.load_impacts('staple', 5), (3, [['email_1', 3]], False))
+        self.assertEqual(self.micro.check_index()['problems'], [])
+
+    def test_search_impact_blocks(self):
+        self.micro.bulk_index([
+            ('email_1', {'text': 'Memo: stapler, stapler, stapler.'}),
+            ('email_2', {'text': 'Memo: stapler.'}),
+            ('email_3', {'text': 'Memo: stapler, stapler.'}),
+        ] + [('lunch_{0}'.format(i), {'text': 'Lunch.'}) for i in range(5)])
+        exact = self.micro.search('stapler')
+        self.assertEqual([res['id'] for res in exact['results']], ['email_1', 'email_3', 'email_2'])
+        self.assertFalse('approximate' in exact)
+
+        # Without impacts, it's just an exact search.
+        results = self.micro.search('stapler', impact_blocks=1)
+        self.assertEqual(results['approximate'], False)
+        self.assertEqual(results['results'], exact['results'])
+
+        self.micro.build_impacts(block_size=2)
+        results = self.micro.search('stapler', impact_blocks=1)
+        self.assertEqual(results['approximate'], True)
+        self.assertEqual(results['total_hits'], 2)
+        self.assertEqual(results['results'], exact['results'][:2])
+
+        results = self.micro.search('stapler', impact_blocks=2)
+        self.assertEqual(results['approximate'], False)
+        self.assertEqual(results, dict(exact, approximate=False))
+
+        # Stale impacts get ignored.
+        self.micro.index('email_6', {'text': 'Stapler.'})
+        self.assertFalse(self.micro.impacts_current())
+        self.assertEqual(self.micro.search('stapler', impact_blocks=1)['total_hits'], 4)
+
+        # Even if the number of documents hasn't changed.
+        self.micro.build_impacts(block_size=2)
+        self.micro.index('email_6', {'text': 'Lunch.'})
+        self.assertFalse(self.micro.impacts_current())
+
+    def test_make_field_term(self):
+        self.assertEqual(self.micro.make_field_term('text', 'hello'), 'hello')
+        self.assertEqual(self.micro.make_field_term('subject', 'hello'), 'subject:hello')
+        self.assertEqual(self.micro.split_field_term('hello'), ('text', 'hello'))
+        self.assertEqual(self.micro.split_field_term('subject:hello'), ('subject', 'hello'))
+
+    def test_fields(self):
+        self.assertEqual(self.micro.fields, {'text': 1.0})
+
+        micro = microsearch.Microsearch(self.base, fields=['text', 'subject'])
+        self.assertEqual(micro.fields, {'text': 1.0, 'subject': 1.0})
+
+        micro = microsearch.Microsearch(self.base, fields={'subject': 2.5})
+        self.assertEqual(micro.fields, {'subject': 2.5})
+        self.assertEqual(micro.term_boost('subject:hello'), 2.5)
+        self.assertEqual(micro.term_boost('hello'), 1.0)
+        self.assertRaises(KeyError, micro.index, 'email_1', {'text': 'Hello world'})
+
+    def test_analyze(self):
+        micro = microsearch.Microsearch(self.base, fields=['text', 'subject'])
+        self.assertEqual(micro.analyze_fields({'text': 'Hello world', 'subject': 'Audit', 'from': 'Bob'}), {
+            'text': ['hello', 'world'],
+            'subject': ['audit'],
+        })
+        self.assertEqual(micro.analyze({'subject': 'Tax audit'}), {
+            'subject:tax': [0],
+            'subject:aud': [1],
+            'subject:audi': [1],
+            'subject:audit': [1],
+        })
+
+    def test_parse_query_fields(self):
+        micro = microsearch.Microsearch(self.base, fields=['text', 'subject'])
+        self.assertEqual(micro.parse_query('subject:audit'), {
+            'subject:aud': [0],
+            'subject:audi': [0],
+            'subject:audit': [0],
+        })
+        self.assertEqual(micro.parse_query('tax subject:Audit'), {
+            'tax': [0],
+            'subject:aud': [0],
+            'subject:audi': [0],
+            'subject:audit': [0],
+            'subject:tax': [1],
+        })
+        # Unknown fields are just text.
+        self.assertEqual(micro.parse_query('from:bob'), {
+            'fro': [0],
+            'from': [0],
+            'bob': [1],
+            'subject:fro': [0],
+            'subject:from': [0],
+            'subject:bob': [1],
+        })
+
+    def test_fielded_search(self):
+        micro = microsearch.Microsearch(self.base, fields={'text': 1.0, 'subject': 2.0})
+        micro.index('email_1', {'subject': 'Audit', 'text': 'The numbers are in.'})
+        micro.bulk_index([
+            ('email_2', {'subject': 'Lunch', 'text': 'The audit is done, lunch is on me.'}),
+            ('email_3', {'subject': 'Taxes', 'text': 'Forms attached.'}),
+        ])
+
+        results = micro.search('subject:audit')
+        self.assertEqual(results['total_hits'], 1)
+        self.assertEqual(results['results'][0]['id'], 'email_1')
+
+        # Both match, but the subject is boosted.
+        results = micro.search('audit')
+        self.assertEqual([res['id'] for res in results['results']], ['email_1', 'email_2'])
+        self.assertTrue(results['results'][0]['score'] > results['results'][1]['score'])
+
+        stats = micro.read_stats()
+        self.assertEqual(stats['total_docs'], 3)
+        self.assertEqual(stats['field_lengths'], {'text': 7, 'subject': 3})
+        self.assertEqual(stats['field_docs'], {'text': 3, 'subject': 3})
+        self.assertEqual(micro.get_average_field_length('subject'), 1.0)
+        self.assertEqual(micro.get_average_field_length('from'), 0.0)
+
     def test_collect_results(self):
         raw_index = self.unhashed_micro.make_segment_name('hello')
         self.assertFalse(os.path.exists(raw_index))
@@ -333,6 +1264,164 @@ class MicrosearchTestCase(unittest.TestCase):
         self.assertEqual(self.unhashed_micro.collect_results(['hell']), ({'hell': 1}, {'ab': {'hell': 1}}))
         self.assertEqual(self.unhashed_micro.collect_results(['zeta', 'alpha', 'foo']), ({'alpha': 1, 'zeta': 1, 'foo': 0}, {'efg': {'alpha': 2, 'zeta': 2}}))
 
+    def test_postings(self):
+        postings = microsearch.Postings()
+        postings.add('hello', 'doc-1', 4)
+        postings.add('world', 'doc-1', 1)
+        postings.add('hello', 'doc-2', 1)
+        self.assertEqual(len(postings), 2)
+        self.assertEqual(postings.doc_ids, ['doc-1', 'doc-2'])
+        self.assertEqual(postings.term_slots['hello'].tolist(), [0, 1])
+        self.assertEqual(postings.term_freqs['hello'].tolist(), [4, 1])
+        self.assertEqual(postings.doc_counts(0), {'hello': 4, 'world': 1})
+        self.assertEqual(postings.doc_counts(1), {'hello': 1})
+        self.assertFalse(hasattr(postings, '__dict__'))
+        self.assertFalse(hasattr(microsearch.Hit('doc-1', 0.5), '__dict__'))
+
+    def test_collect_postings(self):
+        raw_index = self.unhashed_micro.make_segment_name('hello')
+
+        with open(raw_index, 'w') as raw_index_file:
+            raw_index_file.write('alpha\t{"efg": [9, 10]}\nhell\t{"ab": [2]}\nhello\t{"bcd": [3, 4], "abc": [1, 5, 6]}\nzeta\t{"efg": [1, 3]}\n')
+
+        per_term_docs, postings = self.unhashed_micro.collect_postings(['zeta', 'hello', 'foo'])
+        self.assertEqual(per_term_docs, {'zeta': 1, 'hello': 2, 'foo': 0})
+        self.assertEqual(postings.doc_ids, ['efg', 'bcd', 'abc'])
+        self.assertEqual(postings.doc_counts(2), {'hello': 3})
+
+        # Scores the same as the dict-based pipeline.
+        terms = ['zeta', 'hello', 'foo']
+        scores = self.unhashed_micro.score_postings(terms, per_term_docs, postings, 5)
+        per_doc_counts = self.unhashed_micro.collect_results(terms)[1]
+        scored_results = self.unhashed_micro.score_results(terms, per_term_docs, per_doc_counts, 5)
+        self.assertEqual([(res['id'], res['score']) for res in scored_results], list(zip(postings.doc_ids, scores)))
+
+    def test_read_segment_terms(self):
+        raw_index = self.unhashed_micro.make_segment_name('hello')
+
+        with open(raw_index, 'w') as raw_index_file:
+            raw_index_file.write('alpha\t{"efg": [9, 10]}\nhell\t{"ab": [2]}\nhello\t{"bcd": [3, 4], "abc": [1, 5, 6]}\nzeta\t{"efg": [1, 3]}\nzulu\t{"efg": [2]}\n')
+
+        for attempt in range(2):
+            with self.unhashed_micro.profiling('search', enabled=True) as profiler:
+                self.assertEqual(self.unhashed_micro.read_segment_terms(raw_index, ['hello', 'alpha', 'foo']), {
+                    'alpha': {'efg': [9, 10]},
+                    'hello': {'bcd': [3, 4], 'abc': [1, 5, 6]},
+                })
+
+        # Once it's been seen to be in order, it stops once it's past
+        # ``hello`` (at ``zeta``).
+        self.assertLess(profiler.as_dict()['counters']['bytes_read'], os.path.getsize(raw_index))
+
+        with self.unhashed_micro.profiling('search', enabled=True) as profiler:
+            self.assertEqual(self.unhashed_micro.load_segments(['zeta', 'hell', 'foo']), {
+                'zeta': {'efg': [1, 3]},
+                'hell': {'ab': [2]},
+                'foo': {},
+            })
+
+        self.assertEqual(profiler.as_dict()['counters']['segments_opened'], 1)
+
+        # Out of order segments get read to the end.
+        with open(raw_index, 'w') as raw_index_file:
+            raw_index_file.write('alpha\t{"efg": [9, 10]}\nhello\t{"bcd": [3, 4]}\nzeta\t{"efg": [1, 3]}\nfoo\t{"ab": [1]}\n')
+
+        self.assertEqual(self.unhashed_micro.read_segment_terms(raw_index, ['hello', 'foo']), {
+            'hello': {'bcd': [3, 4]},
+            'foo': {'ab': [1]},
+        })
+
+    def test_plan_query(self):
+        self.assertEqual(self.micro.plan_query(self.micro.parse_query('reports rep')), [
+            [('rep', None)],
+            [('repo', 'rep')],
+            [('repor', 'repo')],
+            [('report', 'repor')],
+        ])
+        self.assertEqual(self.micro.plan_query(['abc', 'xyzw']), [[('abc', None)], [('xyzw', None)]])
+
+        # With a complete term dictionary, missing terms get left out & the
+        # rest go most selective first.
+        self.micro.index('email_1', {'text': 'Reports, reports & a repair.'})
+        self.assertTrue(self.micro.term_dictionary_complete())
+        self.assertEqual(self.micro.estimate_term_docs('rep'), 2)
+        self.assertEqual(self.micro.plan_query(self.micro.parse_query('reports rex')), [
+            [('report', None), ('repor', None), ('repo', None), ('rep', None)],
+        ])
+
+    def test_fetch_terms(self):
+        self.micro.index('email_1', {'text': "Peter, I'm going to need those TPS reports.\n\nLumbergh"})
+        terms = self.micro.parse_query('repairs reports')
+
+        with self.micro.profiling('search', enabled=True) as profiler:
+            term_infos = self.micro.fetch_terms(terms)
+
+        self.assertEqual(sorted(term_infos), sorted(terms))
+        self.assertEqual(term_infos['report'], {'email_1': [7]})
+        self.assertEqual(term_infos['repa'], {})
+        # The term dictionary rules out ``repa``, ``repai`` & ``repair``.
+        self.assertEqual(profiler.as_dict()['counters']['terms_skipped'], 3)
+
+        for term in terms:
+            self.assertEqual(term_infos[term], self.micro.load_segment(term))
+
+        # Without a complete term dictionary, only the n-grams can help.
+        stats = self.micro.read_stats()
+        del stats['complete_term_dictionary']
+        self.micro.write_stats(stats)
+
+        with self.micro.profiling('search', enabled=True) as profiler:
+            self.assertEqual(self.micro.fetch_terms(terms), term_infos)
+
+        # Nothing has ``repa``, so nothing can have ``repai`` or ``repair``.
+        self.assertEqual(profiler.as_dict()['counters']['terms_skipped'], 2)
+
+    def test_norms(self):
+        self.assertEqual(self.micro.encode_norm(0), 0)
+        self.assertEqual(self.micro.encode_norm(1), 16)
+        self.assertEqual(self.micro.encode_norm(10 ** 9), 255)
+        self.assertAlmostEqual(self.micro.NORM_LENGTHS[self.micro.encode_norm(100)], 100, delta=5)
+
+        micro = microsearch.Microsearch(self.base, fields={'text': 1.0, 'subject': 2.0})
+        micro.index('email_1', {'subject': 'Stapler', 'text': 'My stapler is missing.\n\nMilton'})
+        micro.bulk_index([
+            ('email_2', {'text': 'Where is my stapler?'}),
+            ('email_3', {'subject': 'TPS reports', 'text': "Peter, I'm going to need those TPS reports.\n\nLumbergh"}),
+        ])
+        self.assertEqual(list(micro.load_norms('subject')), [micro.encode_norm(1), 0, micro.encode_norm(2)])
+        self.assertEqual(list(micro.load_norms('text')), [micro.encode_norm(4), micro.encode_norm(3), micro.encode_norm(9)])
+
+        postings = micro.collect_postings(micro.parse_query('stapler'))[1]
+        self.assertEqual(postings.doc_ids, ['email_1', 'email_2'])
+        self.assertEqual(list(micro.postings_norms(postings, 'subject')), [micro.encode_norm(1), 0])
+
+    def test_similarity(self):
+        documents = [
+            ('email_1', {'text': 'My stapler is missing.\n\nMilton'}),
+            ('email_2', {'text': "Peter, I'm going to need those TPS reports. And where is the stapler? Lumbergh"}),
+            ('email_3', {'text': 'How do you feel about becoming Management?\n\nThe Bobs'}),
+            ('email_4', {'text': 'Lunch is at noon.'}),
+        ]
+        self.micro.bulk_index(documents)
+        self.assertIsInstance(self.micro.similarity, microsearch.BM25Similarity)
+
+        # The default scores exactly as ``bm25_relevance`` does.
+        terms = self.micro.parse_query('stapler lumbergh')
+        per_term_docs, postings = self.micro.collect_postings(terms)
+        scores = self.micro.score_postings(terms, per_term_docs, postings, 4)
+
+        for slot, doc_id in enumerate(postings.doc_ids):
+            self.assertEqual(scores[slot], self.micro.bm25_relevance(terms, per_term_docs, postings.doc_counts(slot), 4))
+
+        # Both of these favour the shorter email.
+        for similarity in (microsearch.BM25FSimilarity(), microsearch.TFIDFSimilarity()):
+            micro = microsearch.Microsearch(self.base, similarity=similarity)
+            results = micro.search('stapler', explain=True)
+            self.assertEqual([res['id'] for res in results['results']], ['email_1', 'email_2'])
+
+            for res in results['results']:
+                self.assertAlmostEqual(sum(results['explain']['hits'][res['id']].values()), res['score'])
+
     def test_bm25_relevance(self):
         terms = ['hello']
         matching_docs = {
@@ -369,6 +1458,19 @@ class MicrosearchTestCase(unittest.TestCase):
         relevance = self.micro.bm25_relevance(terms, matching_docs, current_doc_occurances, total_docs)
         self.assertEqual("{:.2f}".format(relevance), '0.68', 'This fails on 2.X but should pass on Python 3.')
 
+        # Terms no document has shouldn't blow up.
+        terms = ['hello', 'world']
+        matching_docs = {
+            'hello': 25,
+            'world': 0,
+        }
+        current_doc_occurances = {
+            'hello': 5,
+        }
+        total_docs = 175
+        relevance = self.micro.bm25_relevance(terms, matching_docs, current_doc_occurances, total_docs)
+        self.assertEqual("{:.2f}".format(relevance), '0.57')
+
     def test_search(self):
         # No query, no results.
         self.assertEqual(self.micro.search(''), {'total_hits': 0, 'results': []})
@@ -449,6 +1551,641 @@ class MicrosearchTestCase(unittest.TestCase):
             ]
         })
 
+    def test_bulk_index(self):
+        self.assertEqual(self.micro.bulk_index([]), 0)
+        self.assertRaises(KeyError, self.micro.bulk_index, [('email_1', {'subject': 'A raw doc.'})])
+
+        # A bad document partway through leaves the rest unwritten.
+        self.assertRaises(AttributeError, self.micro.bulk_index, [
+            ('email_1', {'text': 'My stapler is missing.'}),
+            ('email_2', 'Not a dict'),
+        ])
+        self.assertFalse(os.path.exists(self.micro.make_document_name('email_1')))
+        self.assertEqual(self.micro.get_total_docs(), 0)
+        self.assertEqual(self.micro.check_index()['problems'], [])
+
+        self.assertEqual(self.micro.bulk_index([
+            ('email_1', {'text': "Peter,\n\nI'm going to need those TPS reports on my desk first thing tomorrow! And clean up your desk!\n\nLumbergh"}),
+            ('email_3', {'text': "Peter,\n\nYeah, I'm going to need you to come in on Saturday. Don't forget those reports.\n\nLumbergh"}),
+        ]), 2)
+        self.assertEqual(self.micro.get_total_docs(), 2)
+        self.assertEqual(self.micro.load_segment('desk'), {'email_1': [9, 16]})
+        self.assertEqual(self.micro.load_segment('report'), {'email_1': [7], 'email_3': [12]})
+        self.assertEqual(self.micro.search('peter')['total_hits'], 2)
+
+    def test_bm25_explain(self):
+        terms = ['hello', 'world', 'foo']
+        matching_docs = {
+            'hello': 25,
+            'world': 7,
+            'foo': 0,
+        }
+        current_doc_occurances = {
+            'hello': 5,
+        }
+        total_docs = 175
+        contributions = self.micro.bm25_explain(terms, matching_docs, current_doc_occurances, total_docs)
+        self.assertEqual(list(contributions.keys()), ['hello'])
+        relevance = self.micro.bm25_relevance(terms, matching_docs, current_doc_occurances, total_docs)
+        self.assertAlmostEqual(0.5 + sum(contributions.values()), relevance)
+
+    def test_search_explain(self):
+        self.micro.index('email_1', {'text': "Peter,\n\nI'm going to need those TPS reports on my desk first thing tomorrow! And clean up your desk!\n\nLumbergh"})
+        self.micro.index('email_3', {'text': "Peter,\n\nYeah, I'm going to need you to come in on Saturday. Don't forget those reports.\n\nLumbergh"})
+
+        self.assertFalse('explain' in self.micro.search('peter desk'))
+
+        results = self.micro.search('peter desk', limit=1, explain=True)
+        explained = results['explain']
+        self.assertEqual(sorted(explained['terms'].keys()), ['des', 'desk', 'pet', 'pete', 'peter'])
+        self.assertEqual(explained['terms']['desk']['segment'], self.micro.make_segment_name('desk'))
+        self.assertEqual(explained['terms']['desk']['postings'], 1)
+        self.assertEqual(explained['terms']['peter']['postings'], 2)
+        self.assertEqual(explained['terms']['peter']['idf'], self.micro.bm25_idf(2, 2))
+        self.assertTrue(explained['terms']['peter']['time'] >= 0.0)
+
+        # Only the returned hits get broken down.
+        self.assertEqual(list(explained['hits'].keys()), ['email_1'])
+        self.assertEqual(sorted(explained['hits']['email_1'].keys()), ['des', 'desk', 'pet', 'pete', 'peter'])
+        self.assertAlmostEqual(0.5 + sum(explained['hits']['email_1'].values()), results['results'][0]['score'])
+
+    def test_profiler(self):
+        profiler = microsearch.Profiler()
+
+        with profiler.phase('scoring'):
+            profiler.incr('docs_scored', 25)
+            profiler.incr('docs_scored')
+
+        profile = profiler.as_dict()
+        self.assertEqual(profile['counters'], {'docs_scored': 26})
+        self.assertEqual(list(profile['timings'].keys()), ['scoring'])
+
+        null_profiler = microsearch.NullProfiler()
+
+        with null_profiler.phase('scoring'):
+            null_profiler.incr('docs_scored', 25)
+
+        self.assertEqual(null_profiler.as_dict(), {'timings': {}, 'counters': {}})
+
+    def test_search_profile(self):
+        self.micro.index('email_1', {'text': "Peter,\n\nI'm going to need those TPS reports on my desk first thing tomorrow! And clean up your desk!\n\nLumbergh"})
+        self.micro.index('email_3', {'text': "Peter,\n\nYeah, I'm going to need you to come in on Saturday. Don't forget those reports.\n\nLumbergh"})
+
+        self.assertFalse('profile' in self.micro.search('peter'))
+        self.assertTrue(self.micro.profiler is microsearch.NULL_PROFILER)
+
+        results = self.micro.search('peter', limit=1, profile=True)
+        self.assertEqual(results['total_hits'], 2)
+        self.assertTrue(self.micro.profiler is microsearch.NULL_PROFILER)
+        self.assertEqual(sorted(results['profile']['timings'].keys()), ['collect_results', 'hydration', 'json_decode', 'parse_query', 'scoring', 'segment_io', 'sorting', 'total'])
+        counters = results['profile']['counters']
+        self.assertEqual(counters['segments_opened'], 3)
+        self.assertEqual(counters['postings_decoded'], 6)
+        self.assertEqual(counters['docs_scored'], 2)
+        self.assertEqual(counters['docs_hydrated'], 1)
+        self.assertTrue(counters['bytes_read'] > 0)
+
+    def test_search_profile_threads(self):
+        self.micro.index('email_1', {'text': "Peter,\n\nI'm going to need those TPS reports.\n\nLumbergh"})
+        barrier = threading.Barrier(8)
+
+        def profiled_search(number):
+            barrier.wait()
+            return self.micro.search('peter', profile=True)['profile']['counters']['docs_scored']
+
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            self.assertEqual(list(executor.map(profiled_search, range(8))), [1] * 8)
+
+        self.assertTrue(self.micro.profiler is microsearch.NULL_PROFILER)
+
+    def test_metrics_sink(self):
+        seen = []
+        micro = microsearch.Microsearch(self.base, metrics_sink=lambda operation, data: seen.append((operation, data)))
+        micro.index('email_1', {'text': 'Hello world'})
+        micro.bulk_index([('email_2', {'text': 'Goodbye world'})])
+        results = micro.search('world')
+
+        # Only attached when asked for.
+        self.assertFalse('profile' in results)
+        self.assertEqual([operation for operation, data in seen], ['index', 'bulk_index', 'search'])
+        self.assertEqual(seen[0][1]['counters'], {'terms_written': 6})
+        self.assertEqual(seen[1][1]['counters'], {'docs_indexed': 1, 'terms_written': 7})
+        self.assertEqual(seen[2][1]['counters']['docs_scored'], 2)
+        self.assertTrue('total' in seen[2][1]['timings'])
+
+
+class SqliteMicrosearchTestCase(unittest.TestCase):
+    def setUp(self):
+        super(SqliteMicrosearchTestCase, self).setUp()
+        self.base = os.path.join('/tmp', 'microsearch_sqlite_tests')
+        shutil.rmtree(self.base, ignore_errors=True)
+
+        self.micro = microsearch.SqliteMicrosearch(self.base)
+
+    def tearDown(self):
+        self.micro.close()
+        shutil.rmtree(self.base, ignore_errors=True)
+        super(SqliteMicrosearchTestCase, self).tearDown()
+
+    def test_setup(self):
+        self.assertTrue(os.path.exists(self.micro.db_path))
+        self.assertFalse(os.path.exists(self.micro.index_path))
+        self.assertFalse(os.path.exists(self.micro.docs_path))
+
+    def test_stats(self):
+        self.assertEqual(self.micro.read_stats(), {'total_docs': 0, 'version': '.'.join([str(bit) for bit in microsearch.__version__])})
+        self.assertTrue(self.micro.write_stats({'version': '0.8.0', 'total_docs': 15}))
+        self.micro.increment_total_docs()
+        self.assertEqual(self.micro.read_stats(), {'total_docs': 16, 'version': '0.8.0'})
+
+    def test_segments(self):
+        self.assertEqual(self.micro.load_segment('hello'), {})
+        self.assertTrue(self.micro.save_segment('hello', {'abc': [1, 5]}))
+        self.assertEqual(self.micro.load_segment('hello'), {'abc': [1, 5]})
+        self.assertTrue(self.micro.save_segment('hello', {'abc': [2], 'bcd': [3, 4]}, update=True))
+        self.assertEqual(self.micro.load_segment('hello'), {'abc': [1, 2, 5], 'bcd': [3, 4]})
+        self.assertTrue(self.micro.save_segment('hello', {'bcd': [3]}))
+        self.assertEqual(self.micro.load_segment('hello'), {'bcd': [3]})
+        self.assertTrue(self.micro.save_segment('world', {'abc': [2]}))
+        self.assertEqual(self.micro.load_segments(['world', 'hello', 'nope']), {
+            'world': {'abc': [2]},
+            'hello': {'bcd': [3]},
+            'nope': {},
+        })
+
+    def test_documents(self):
+        self.assertRaises(KeyError, self.micro.load_document, 'hello')
+        self.assertTrue(self.micro.save_document('hello', {'text': 'Hello world'}))
+        self.assertEqual(self.micro.load_document('hello'), {'text': 'Hello world'})
+
+    def test_transaction(self):
+        try:
+            with self.micro.transaction():
+                self.micro.save_document('hello', {'text': 'Hello world'})
+                raise ValueError('Boom.')
+        except ValueError:
+            pass
+
+        self.assertEqual(self.micro.transaction_depth, 0)
+        self.assertRaises(KeyError, self.micro.load_document, 'hello')
+
+    def test_commit(self):
+        with self.micro.transaction():
+            self.micro.index('email_1', {'text': 'My stapler is missing.\n\nMilton'})
+            # Not until the transaction is committed.
+            self.assertEqual(self.micro.read_generation(), 0)
+
+        self.assertEqual(self.micro.read_generation(), 1)
+
+        try:
+            with self.micro.transaction():
+                self.micro.index('email_2', {'text': 'Where is my stapler?'})
+                raise ValueError('Boom.')
+        except ValueError:
+            pass
+
+        self.assertEqual(self.micro.read_generation(), 1)
+        self.assertEqual(self.micro.pending_commits, [])
+
+        with self.micro.batch():
+            self.micro.index('email_2', {'text': 'Where is my stapler?'})
+            self.micro.index('email_3', {'text': 'I found my stapler.'})
+            self.assertEqual(self.micro.transaction_depth, 1)
+
+        self.assertEqual(self.micro.read_generation(), 2)
+
+    def test_connection_per_thread(self):
+        self.micro.index('email_1', {'text': 'My stapler is missing.\n\nMilton'})
+        seen = []
+
+        def search():
+            seen.append((self.micro.connection, self.micro.transaction_depth, self.micro.search('stapler')['total_hits']))
+
+        with self.micro.batch():
+            self.micro.index('email_2', {'text': 'Where is my stapler?'})
+            # Other threads only see what's been committed.
+            thread = threading.Thread(target=search)
+            thread.start()
+            thread.join()
+
+        self.assertNotEqual(seen[0][0], self.micro.connection)
+        self.assertEqual(seen[0][1:], (0, 1))
+        self.assertEqual(self.micro.search('stapler')['total_hits'], 2)
+        self.assertEqual(len(self.micro.open_connections), 2)
+
+        # The finished thread's connection gets closed once another opens.
+        thread = threading.Thread(target=search)
+        thread.start()
+        thread.join()
+        self.assertEqual(seen[1][1:], (0, 2))
+        self.assertEqual(len(self.micro.open_connections), 2)
+
+    def test_reader_cache(self):
+        self.micro.index('email_1', {'text': 'My stapler is missing.\n\nMilton'})
+        reader = microsearch.SqliteMicrosearch(self.base, refresh_interval=60)
+        self.addCleanup(reader.close)
+        self.assertEqual(reader.search('stapler')['total_hits'], 1)
+
+        with reader.profiling('search', enabled=True) as profiler:
+            self.assertEqual(reader.search('stapler')['total_hits'], 1)
+
+        self.assertNotIn('segments_opened', profiler.as_dict()['counters'])
+        self.assertEqual(profiler.as_dict()['counters']['segment_cache_hits'], 4)
+
+        # Kept until the next commit.
+        self.micro.index('email_2', {'text': 'Where is my stapler?'})
+        self.assertEqual(reader.search('stapler')['total_hits'], 1)
+        self.assertTrue(reader.refresh())
+        self.assertEqual(reader.search('stapler')['total_hits'], 2)
+
+    def test_reader_cache_writes(self):
+        # A reader that also writes never updates from its cached postings.
+        micro = microsearch.SqliteMicrosearch(self.base, refresh_interval=0.0)
+        self.addCleanup(micro.close)
+
+        for number, doc_id in enumerate(['a', 'b', 'c']):
+            micro.index(doc_id, {'text': 'alpha'})
+            self.assertEqual(micro.search('alpha')['total_hits'], number + 1)
+
+        self.assertEqual(sorted(micro.read_segment('alpha')), ['a', 'b', 'c'])
+
+    def test_search(self):
+        self.assertEqual(self.micro.search('hello'), {'total_hits': 0, 'results': []})
+
+        self.micro.index('email_1', {'text': "Peter,\n\nI'm going to need those TPS reports on my desk first thing tomorrow! And clean up your desk!\n\nLumbergh"})
+        self.assertEqual(self.micro.bulk_index([
+            ('email_2', {'text': 'Everyone,\n\nM-m-m-m-my red stapler has gone missing. H-h-has a-an-anyone seen it?\n\nMilton'}),
+            ('email_3', {'text': "Peter,\n\nYeah, I'm going to need you to come in on Saturday. Don't forget those reports.\n\nLumbergh"}),
+            ('email_4', {'text': 'How do you feel about becoming Management?\n\nThe Bobs'}),
+        ]), 3)
+        self.assertEqual(self.micro.get_total_docs(), 4)
+
+        results = self.micro.search('peter desk')
+        self.assertEqual(results['total_hits'], 2)
+        self.assertEqual([res['id'] for res in results['results']], ['email_1', 'email_3'])
+        self.assertEqual(results['results'][0]['score'], 0.6420231808473381)
+
+    def test_check_index(self):
+        self.micro.index('email_1', {'text': 'My stapler is missing.\n\nMilton'})
+        self.assertEqual(self.micro.check_index()['problems'], [])
+
+        self.micro.save_segment('staple', {'email_2': [1]}, update=True)
+        report = self.micro.check_index(repair=True)
+        self.assertEqual(report['problems'], [
+            {'segment': self.micro.db_path, 'problem': "'staple' references the missing document 'email_2'."},
+        ])
+        self.assertEqual(report['repaired'], [self.micro.db_path])
+        self.assertEqual(self.micro.load_segment('staple'), {'email_1': [1]})
+        self.assertEqual(self.micro.check_index()['problems'], [])
+        # No segment files for a ``MergeScheduler`` to work through.
+        self.assertRaises(ValueError, microsearch.MergeScheduler, self.micro)
+
+    def test_snapshot_and_restore(self):
+        self.micro.index('email_1', {'text': "Peter,\n\nI'm going to need those TPS reports on my desk first thing tomorrow! And clean up your desk!\n\nLumbergh"})
+        self.micro.index('email_2', {'text': 'Everyone,\n\nM-m-m-m-my red stapler has gone missing. H-h-has a-an-anyone seen it?\n\nMilton'})
+        self.assertNotIn('microsearch.db-wal', self.micro.snapshot_files())
+
+        archive = io.BytesIO()
+        self.micro.snapshot(archive)
+        archive.seek(0)
+
+        restore_base = self.base + '_restored'
+        self.addCleanup(shutil.rmtree, restore_base, True)
+        restored = microsearch.SqliteMicrosearch(restore_base)
+        self.addCleanup(restored.close)
+        restored.restore(archive)
+        self.assertEqual(restored.get_total_docs(), 2)
+        self.assertEqual(restored.search('stapler'), self.micro.search('stapler'))
+
+
+class ShardedMicrosearchTestCase(unittest.TestCase):
+    def setUp(self):
+        super(ShardedMicrosearchTestCase, self).setUp()
+        self.base = os.path.join('/tmp', 'microsearch_sharded_tests')
+        shutil.rmtree(self.base, ignore_errors=True)
+
+        self.micro = microsearch.ShardedMicrosearch(self.base, shards=3)
+        self.documents = [
+            ('email_1', {'text': "Peter,\n\nI'm going to need those TPS reports on my desk first thing tomorrow! And clean up your desk!\n\nLumbergh"}),
+            ('email_2', {'text': 'Everyone,\n\nM-m-m-m-my red stapler has gone missing. H-h-has a-an-anyone seen it?\n\nMilton'}),
+            ('email_3', {'text': "Peter,\n\nYeah, I'm going to need you to come in on Saturday. Don't forget those reports.\n\nLumbergh"}),
+            ('email_4', {'text': 'How do you feel about becoming Management?\n\nThe Bobs'}),
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.base, ignore_errors=True)
+        super(ShardedMicrosearchTestCase, self).tearDown()
+
+    def test_init(self):
+        self.assertEqual(len(self.micro.shards), 3)
+        self.assertTrue(os.path.exists(os.path.join(self.base, 'shard-002', 'index')))
+
+        # The shard count sticks.
+        self.assertEqual(len(microsearch.ShardedMicrosearch(self.base).shards), 3)
+        self.assertRaises(ValueError, microsearch.ShardedMicrosearch, self.base, shards=5)
+
+    def test_shard_number(self):
+        self.assertEqual(self.micro.shard_number('hello'), int('5d4140', 16) % 3)
+        self.assertEqual(self.micro.shard_number('world'), int('7d7930', 16) % 3)
+
+    def test_bulk_index(self):
+        self.assertEqual(self.micro.bulk_index(self.documents), 4)
+        self.assertEqual(self.micro.get_total_docs(), 4)
+
+        for doc_id, document in self.documents:
+            shard = self.micro.shards[self.micro.shard_number(doc_id)]
+            self.assertEqual(shard.load_document(doc_id), document)
+
+    def test_search(self):
+        self.assertEqual(self.micro.search(''), {'total_hits': 0, 'results': []})
+        self.assertEqual(self.micro.search('hello'), {'total_hits': 0, 'results': []})
+
+        for doc_id, document in self.documents:
+            self.micro.index(doc_id, document)
+
+        # Same scores as an unsharded index, thanks to the global stats.
+        results = self.micro.search('peter desk')
+        self.assertEqual(results['total_hits'], 2)
+        self.assertEqual([(res['id'], res['score']) for res in results['results']], [
+            ('email_1', 0.6420231808473381),
+            ('email_3', 0.5343540413289899),
+        ])
+        self.assertEqual(results['results'][0]['text'], self.documents[0][1]['text'])
+
+        results = self.micro.search('you', offset=1, limit=1)
+        self.assertEqual(results['total_hits'], 3)
+        self.assertEqual(len(results['results']), 1)
+        self.assertEqual(results['results'][0]['score'], 0.44274326445168355)
+
+    def test_shard_phases(self):
+        self.micro.bulk_index(self.documents)
+        shard = self.micro.shards[self.micro.shard_number('email_1')]
+        terms = shard.parse_query('peter desk')
+        stats = shard.shard_stats(terms)
+
+        # The second phase reuses what the first one read.
+        with shard.profiling('search', enabled=True) as profiler:
+            results = shard.shard_search(terms, stats['per_term_docs'], stats['total_docs'], 10)
+
+        self.assertNotIn('segments_opened', profiler.as_dict()['counters'])
+        self.assertIn('email_1', [hit[0] for hit in results['hits']])
+
+        # Unless something's been committed since.
+        shard.shard_stats(terms)
+        other = microsearch.Microsearch(shard.base_directory)
+        other.index('email_5', {'text': 'Peter, where is my desk?'})
+
+        with shard.profiling('search', enabled=True) as profiler:
+            results = shard.shard_search(terms, stats['per_term_docs'], stats['total_docs'] + 1, 10)
+
+        self.assertTrue(profiler.as_dict()['counters']['segments_opened'] > 0)
+        self.assertIn('email_5', [hit[0] for hit in results['hits']])
+
+        # Shards opened as readers refresh first.
+        reader = microsearch.Microsearch(shard.base_directory, refresh_interval=0.0)
+        before = reader.shard_stats(terms)['per_term_docs']
+        other.index('email_6', {'text': 'Peter, my desk is gone.'})
+        self.assertEqual(reader.shard_stats(terms)['per_term_docs']['desk'], before['desk'] + 1)
+
+    def test_check_index_and_compact(self):
+        self.micro.bulk_index(self.documents)
+        report = self.micro.check_index()
+        self.assertEqual(report['problems'], [])
+        self.assertEqual(self.micro.compact(), report['segments'])
+
+    def test_json_clients_and_processes(self):
+        shutil.rmtree(self.base, ignore_errors=True)
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=2)
+        self.micro = microsearch.ShardedMicrosearch(self.base, shards=2, client_class=microsearch.JsonShardClient, executor=executor)
+
+        try:
+            self.assertEqual(self.micro.bulk_index(self.documents), 4)
+            results = self.micro.search('peter desk')
+        finally:
+            executor.shutdown()
+
+        self.assertEqual([res['id'] for res in results['results']], ['email_1', 'email_3'])
+        self.assertEqual(results['results'][1]['score'], 0.5343540413289899)
+
+    def test_sqlite_shards_in_processes(self):
+        shutil.rmtree(self.base, ignore_errors=True)
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=2)
+        self.micro = microsearch.ShardedMicrosearch(self.base, shards=2, shard_class=microsearch.SqliteMicrosearch, executor=executor)
+
+        try:
+            self.assertEqual(self.micro.bulk_index(self.documents), 4)
+            results = self.micro.search('peter desk')
+        finally:
+            executor.shutdown()
+
+        self.assertEqual([res['id'] for res in results['results']], ['email_1', 'email_3'])
+
+
+class IndexManagerTestCase(unittest.TestCase):
+    def setUp(self):
+        super(IndexManagerTestCase, self).setUp()
+        self.base = os.path.join('/tmp', 'microsearch_manager_tests')
+        shutil.rmtree(self.base, ignore_errors=True)
+
+        self.manager = microsearch.IndexManager(self.base, max_open=2, document_cache_size=3000, compressed_cache_size=600)
+
+    def tearDown(self):
+        self.manager.close()
+        shutil.rmtree(self.base, ignore_errors=True)
+        super(IndexManagerTestCase, self).tearDown()
+
+    def test_get(self):
+        self.assertEqual(self.manager.tenants(), [])
+        acme = self.manager.get('acme')
+        acme.index('email_1', {'text': 'My stapler is missing.\n\nMilton'})
+        self.assertIs(self.manager.get('acme'), acme)
+        self.assertEqual(self.manager.tenants(), ['acme'])
+        self.assertEqual(acme.base_directory, os.path.join(self.base, 'acme'))
+        self.assertEqual(acme.document_cache.max_bytes, 3000)
+        self.assertRaises(ValueError, self.manager.get, '../elsewhere')
+
+    def test_evict_and_share_caches(self):
+        acme = self.manager.get('acme')
+        initech = self.manager.get('initech')
+        self.assertEqual(acme.document_cache.max_bytes, 1500)
+        self.assertEqual(initech.document_cache.compressed_bytes, 300)
+
+        # ``acme`` is the least recently used.
+        self.manager.get('initrode')
+        self.assertEqual(list(self.manager.open_tenants), ['initech', 'initrode'])
+        self.assertEqual(self.manager.stats()['opened'], 3)
+        self.assertEqual(self.manager.stats()['closed'], 1)
+
+        # Tenants in use don't get closed.
+        with self.manager.using('initech') as index:
+            self.assertIs(index, initech)
+            self.manager.get('acme')
+            self.manager.get('bobs')
+            self.assertIn('initech', self.manager.open_tenants)
+
+        self.assertEqual(self.manager.stats()['open'], 2)
+
+    def test_close_idle(self):
+        self.manager.get('acme')
+
+        with self.manager.using('initech') as index:
+            self.assertEqual(self.manager.close_idle(time.time() + 301), ['acme'])
+
+        self.assertEqual(list(self.manager.open_tenants), ['initech'])
+        self.assertEqual(self.manager.get('initech').document_cache.max_bytes, 3000)
+
+    def test_sqlite(self):
+        manager = microsearch.IndexManager(self.base, index_class=microsearch.SqliteMicrosearch, max_open=1)
+        self.addCleanup(manager.close)
+
+        with manager.using('acme') as index:
+            index.index('email_1', {'text': 'My stapler is missing.\n\nMilton'})
+
+        manager.get('initech')
+        self.assertEqual(manager.stats()['open'], 1)
+        self.assertEqual(manager.get('acme').search('stapler')['total_hits'], 1)
+
+
+class CommandLineTestCase(unittest.TestCase):
+    def setUp(self):
+        super(CommandLineTestCase, self).setUp()
+        self.base = os.path.join('/tmp', 'microsearch_cli_tests')
+        shutil.rmtree(self.base, ignore_errors=True)
+        os.makedirs(os.path.join(self.base, 'maildir', 'lumbergh'))
+        self.index_path = os.path.join(self.base, 'index')
+        self.jsonl_path = os.path.join(self.base, 'docs.jsonl')
+
+        with open(self.jsonl_path, 'w') as jsonl_file:
+            jsonl_file.write('{"id": "email_1", "text": "Peter, I\'m going to need those TPS reports."}\n')
+            jsonl_file.write('\n')
+            jsonl_file.write('{"id": "email_2", "text": "My stapler is missing."}\n')
+
+        with open(os.path.join(self.base, 'maildir', 'lumbergh', '1.'), 'w') as email_file:
+            email_file.write("Yeah, I'm going to need you to come in on Saturday.")
+
+    def tearDown(self):
+        shutil.rmtree(self.base, ignore_errors=True)
+        super(CommandLineTestCase, self).tearDown()
+
+    def run_main(self, *argv):
+        stdout = io.StringIO()
+
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(io.StringIO()):
+            code = microsearch.main(list(argv))
+
+        return code, stdout.getvalue()
+
+    def test_iter_jsonl(self):
+        self.assertEqual(list(microsearch.iter_jsonl(['{"id": 1, "text": "Hi"}\n', '\n', '{"key": "b", "id": "b"}'])), [
+            (1, {'text': 'Hi'}),
+            ('b', {'key': 'b'}),
+        ])
+        self.assertEqual(list(microsearch.iter_jsonl(['{"key": "b", "id": "c"}'], id_field='key')), [('b', {'id': 'c'})])
+        self.assertRaises(KeyError, list, microsearch.iter_jsonl(['{"text": "Hi"}']))
+
+    def test_iter_directory(self):
+        self.assertEqual(list(microsearch.iter_directory(os.path.join(self.base, 'maildir'))), [
+            ('lumbergh.1.', {'text': "Yeah, I'm going to need you to come in on Saturday."}),
+        ])
+
+    def test_iter_mbox(self):
+        mbox = io.BytesIO(
+            b'From lumbergh@initech.com Mon Feb 19 10:00:00 1999\n'
+            b'Message-ID: <tps/1@initech.com>\n'
+            b'From: Bill Lumbergh <lumbergh@initech.com>\n'
+            b'Subject: TPS reports\n'
+            b'\n'
+            b"Peter, I'm going to need those TPS reports.\n"
+            b'>From now on, use the new cover sheets.\n'
+            b'\n'
+            b'From milton@initech.com Mon Feb 19 11:00:00 1999\n'
+            b'Subject: Stapler\n'
+            b'Content-Type: text/plain; charset=utf-8\n'
+            b'\n'
+            b'My stapler is missing. Caf\xc3\xa9?\n'
+        )
+        self.assertEqual(list(microsearch.iter_mbox(mbox)), [
+            ('tps.1@initech.com', {
+                'text': "Peter, I'm going to need those TPS reports.\nFrom now on, use the new cover sheets.\n\n",
+                'subject': 'TPS reports',
+                'from': 'Bill Lumbergh <lumbergh@initech.com>',
+            }),
+            ('message-1', {
+                'text': 'My stapler is missing. Caf\xe9?\n',
+                'subject': 'Stapler',
+            }),
+        ])
+
+    def test_stream_index(self):
+        micro = microsearch.Microsearch(self.index_path)
+        documents = (('email_{0}'.format(i), {'text': 'Memo number {0}'.format(i)}) for i in range(7))
+        progress = []
+        self.assertEqual(microsearch.stream_index(micro, documents, batch_size=3, queue_size=1, progress=progress.append), 7)
+        self.assertEqual(progress, [3, 6, 7])
+        self.assertEqual(micro.get_total_docs(), 7)
+        self.assertEqual(micro.search('memo')['total_hits'], 7)
+
+        # Problems reading the documents make it through.
+        def broken():
+            yield 'email_8', {'text': 'Fine'}
+            raise ValueError('Bad line.')
+
+        self.assertRaises(ValueError, microsearch.stream_index, micro, broken(), batch_size=1)
+        self.assertEqual(micro.get_total_docs(), 8)
+
+        # As do problems indexing them.
+        self.assertRaises(AttributeError, microsearch.stream_index, micro, [('email_9', 'Not a dict')])
+
+        # Even while the reading is stuck waiting on more input.
+        unblock = threading.Event()
+
+        def stuck():
+            yield 'email_9', 'Not a dict'
+            unblock.wait()
+
+        start = time.time()
+        self.assertRaises(AttributeError, microsearch.stream_index, micro, stuck(), batch_size=1)
+        self.assertLess(time.time() - start, 5)
+        unblock.set()
+
+    def test_commands(self):
+        code, output = self.run_main('index', self.index_path, self.jsonl_path, os.path.join(self.base, 'maildir'), '--batch-size', '2')
+        self.assertEqual(code, 0)
+        self.assertEqual(json.loads(output)['indexed'], 3)
+
+        code, output = self.run_main('search', self.index_path, 'going', 'stapler')
+        self.assertEqual(code, 0)
+        self.assertEqual([line.split('\t')[1] for line in output.splitlines()], ['email_1', 'lumbergh.1.', 'email_2'])
+
+        code, output = self.run_main('search', self.index_path, 'stapler', '--json')
+        results = json.loads(output)
+        self.assertEqual(results['query'], 'stapler')
+        self.assertEqual(results['total_hits'], 1)
+
+        code, output = self.run_main('stats', self.index_path)
+        stats = json.loads(output)
+        self.assertEqual(stats['total_docs'], 3)
+        self.assertTrue(stats['disk_usage'] > 0)
+
+        code, output = self.run_main('compact', self.index_path)
+        self.assertEqual(json.loads(output)['segments'], stats['segments'])
+
+        code, output = self.run_main('check', self.index_path)
+        self.assertEqual(code, 0)
+        self.assertEqual(json.loads(output)['problems'], [])
+
+    def test_sharded_commands(self):
+        code, output = self.run_main('index', self.index_path, self.jsonl_path, '--shards', '2', '--backend', 'sqlite')
+        self.assertEqual(json.loads(output)['indexed'], 2)
+        self.assertTrue(os.path.exists(os.path.join(self.index_path, 'shard-001', 'microsearch.db')))
+
+        # The shards are remembered, as is the backend.
+        code, output = self.run_main('stats', self.index_path)
+        stats = json.loads(output)
+        self.assertEqual(stats['shards'], 2)
+        self.assertEqual(stats['total_docs'], 2)
+        self.assertRaises(ValueError, self.run_main, 'stats', self.index_path, '--backend', 'file')
+
 
 if __name__ == '__main__':
     unittest.main()